@@ -0,0 +1,400 @@
+"""
+Потоковая распаковка архивов с защитой от архивных бомб.
+
+Файлы архива читаются по одному блоками, поэтому в памяти находится не больше
+одного распакованного файла (при параллельной распаковке zip - не больше окна
+пула). Вложенные архивы (zip, tar, 7z - по расширению или сигнатуре)
+распаковываются рекурсивно до заданной глубины. Ограничения ArchiveLimits
+проверяются по фактически распакованным байтам, а не по размерам из
+заголовков: файл больше max_member_size пропускается, а при превышении общего
+объёма, числа файлов или коэффициента сжатия распаковка прекращается с
+ArchiveLimitError.
+"""
+
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import py7zr
+
+import metrics
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = int(os.environ.get('NIR_ARCHIVE_MAX_DEPTH', '3'))
+MAX_MEMBER_SIZE = int(
+    os.environ.get('NIR_ARCHIVE_MAX_MEMBER_SIZE', str(64 * 1024 * 1024))
+)
+MAX_TOTAL_SIZE = int(
+    os.environ.get('NIR_ARCHIVE_MAX_TOTAL_SIZE', str(1024 * 1024 * 1024))
+)
+MAX_RATIO = float(os.environ.get('NIR_ARCHIVE_MAX_RATIO', '200'))
+MAX_MEMBERS = 100_000
+# Коэффициент сжатия проверяется, только когда распаковано больше этого объёма:
+# маленькие файлы из повторяющихся строк сжимаются сильнее любого порога
+RATIO_MIN_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+# По началу файла определяется, архив это, текст или двоичные данные
+SNIFF_SIZE = 8192
+# Zip-архивы больше этого размера распаковываются в пуле потоков
+PARALLEL_ARCHIVE_MIN_SIZE = 16 * 1024 * 1024
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ZIP_MAGIC = b'PK\x03\x04'
+SEVEN_ZIP_MAGIC = b"7z\xbc\xaf'\x1c"
+# Байты, которые встречаются в тексте (как в утилите file): всё, кроме
+# управляющих символов, не используемых в текстовых файлах
+TEXT_BYTES = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7F})
+
+# None в любом поле - без ограничения
+ArchiveLimits = namedtuple(
+    'ArchiveLimits',
+    ['max_depth', 'max_member_size', 'max_total_size', 'max_ratio', 'max_members'],
+    defaults=(MAX_DEPTH, MAX_MEMBER_SIZE, MAX_TOTAL_SIZE, MAX_RATIO, MAX_MEMBERS),
+)
+DEFAULT_LIMITS = ArchiveLimits()
+
+# name - путь файла в архиве (для вложенных архивов - через путь архива),
+# is_text - определено по первым SNIFF_SIZE байтам
+ArchiveMember = namedtuple('ArchiveMember', ['name', 'data', 'is_text'])
+
+# Ошибки повреждённого или неподдерживаемого вложенного архива
+NESTED_ARCHIVE_ERRORS = (
+    zipfile.BadZipFile,
+    tarfile.TarError,
+    py7zr.exceptions.ArchiveError,
+    py7zr.PasswordRequired,
+    RuntimeError,
+    EOFError,
+    OSError,
+)
+
+
+class ArchiveLimitError(Exception):
+    """Архив превышает ограничения распаковки (вероятно, архивная бомба)."""
+
+
+def archive_format(name: str, prefix: bytes = b'') -> str | None:
+    """
+    Определяет формат архива по расширению, а если оно неизвестно - по сигнатуре.
+
+    :param prefix: Начало содержимого файла.
+    :return: 'zip', 'tar', '7z' или None, если файл не архив.
+    """
+    lowered = name.lower()
+    if lowered.endswith('.zip'):
+        return 'zip'
+    if lowered.endswith(TAR_EXTENSIONS):
+        return 'tar'
+    if lowered.endswith('.7z'):
+        return '7z'
+    if prefix.startswith(ZIP_MAGIC):
+        return 'zip'
+    if prefix.startswith(SEVEN_ZIP_MAGIC):
+        return '7z'
+    if prefix[257:262] == b'ustar':
+        return 'tar'
+    return None
+
+
+def is_text(prefix: bytes) -> bool:
+    """Похоже ли начало файла на текст (нет нулевых байтов и управляющих символов)."""
+    if b'\x00' in prefix:
+        return False
+    return len(prefix.translate(None, TEXT_BYTES)) <= len(prefix) // 10
+
+
+def _read_member(file, limit: int | None) -> bytes | None:
+    """Читает файл архива блоками; None, если он больше limit."""
+    chunks = []
+    size = 0
+    while chunk := file.read(READ_CHUNK_SIZE):
+        size += len(chunk)
+        if limit is not None and size > limit:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class _CountingReader:
+    """Файловый объект для потокового чтения, считающий прочитанные байты."""
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.count += len(data)
+        return data
+
+
+def _ordered_map(function, items, workers: int):
+    """
+    Как ThreadPoolExecutor.map, но в работе одновременно не больше 2 * workers
+    задач, поэтому результаты не накапливаются, пока потребитель занят.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(function, item)))
+            if len(pending) >= 2 * workers:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+class _Extractor:
+    """Общий для всего дерева вложенных архивов учёт ограничений."""
+
+    def __init__(self, limits: ArchiveLimits, compressed_size, workers: int):
+        """
+        :param compressed_size: Функция, возвращающая число прочитанных байтов
+            внешнего архива (для коэффициента сжатия).
+        """
+        self.limits = limits
+        self.compressed_size = compressed_size
+        self.workers = workers
+        self.total = 0
+        self.members = 0
+
+    def _account(self, name: str, size: int):
+        limits = self.limits
+        self.total += size
+        self.members += 1
+        if limits.max_total_size is not None and self.total > limits.max_total_size:
+            raise ArchiveLimitError(
+                f'распаковано больше {limits.max_total_size} байт (на файле {name})'
+            )
+        if limits.max_members is not None and self.members > limits.max_members:
+            raise ArchiveLimitError(f'больше {limits.max_members} файлов')
+        if limits.max_ratio is not None and self.total > RATIO_MIN_SIZE:
+            ratio = self.total / max(self.compressed_size(), 1)
+            if ratio > limits.max_ratio:
+                raise ArchiveLimitError(
+                    f'коэффициент сжатия {ratio:.0f} больше {limits.max_ratio:g}'
+                )
+
+    def _fits(self, name: str, size: int) -> bool:
+        limit = self.limits.max_member_size
+        if limit is not None and size > limit:
+            logger.warning(f'Файл {name} больше {limit} байт, пропускаем')
+            return False
+        return True
+
+    def members_of(
+        self, archive_type: str, source, depth: int, name_filter=None, tar_mode='r|*'
+    ):
+        """Отдаёт ArchiveMember архива и вложенных в него архивов."""
+        if archive_type == 'zip':
+            entries = self._zip_entries(source, depth, name_filter)
+        elif archive_type == 'tar':
+            entries = self._tar_entries(source, name_filter, tar_mode)
+        elif archive_type == '7z':
+            entries = self._7z_entries(source, name_filter)
+        else:
+            raise ValueError(f'Неизвестный формат архива: {archive_type}')
+        for name, data in entries:
+            yield from self._expand(name, data, depth)
+
+    def _expand(self, name: str, data: bytes, depth: int):
+        self._account(name, len(data))
+        prefix = data[:SNIFF_SIZE]
+        archive_type = archive_format(name, prefix)
+        if archive_type is None:
+            yield ArchiveMember(name, data, is_text(prefix))
+            return
+        if self.limits.max_depth is not None and depth >= self.limits.max_depth:
+            logger.warning(f'Архив {name} вложен глубже {depth} уровней, пропускаем')
+            return
+        try:
+            for member in self.members_of(archive_type, io.BytesIO(data), depth + 1):
+                yield member._replace(name=f'{name}/{member.name}')
+        except NESTED_ARCHIVE_ERRORS as e:
+            logger.error(f'Ошибка при распаковке вложенного архива {name}: {e}')
+
+    def _zip_entries(self, source, depth: int, name_filter):
+        with zipfile.ZipFile(source) as archive:
+
+            def read(entry):
+                name, info = entry
+                try:
+                    with metrics.timer('extract', format='zip'):
+                        with archive.open(info) as file:
+                            data = _read_member(file, self.limits.max_member_size)
+                except Exception as e:
+                    logger.error(f'Ошибка при обработке файла {info.filename}: {e}')
+                    return None
+                if data is None:
+                    logger.warning(
+                        f'Файл {name} больше заявленного размера, пропускаем'
+                    )
+                return data
+
+            entries = []
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                name = info.filename
+                if name_filter is not None:
+                    name = name_filter(name)
+                    if name is None:
+                        continue
+                if not self._fits(name, info.file_size):
+                    continue
+                ratio_limit = self.limits.max_ratio
+                if (
+                    ratio_limit is not None
+                    and info.file_size > RATIO_MIN_SIZE
+                    and info.file_size > ratio_limit * max(info.compress_size, 1)
+                ):
+                    logger.warning(
+                        f'Файл {name} сжат в {info.file_size // max(info.compress_size, 1)} '
+                        'раз, пропускаем'
+                    )
+                    continue
+                entries.append((name, info))
+
+            # Один файл - один поток: zlib, bz2 и lzma отпускают GIL
+            size = sum(info.compress_size for _, info in entries)
+            if depth == 1 and self.workers > 1 and size >= PARALLEL_ARCHIVE_MIN_SIZE:
+                results = _ordered_map(read, entries, self.workers)
+            else:
+                results = ((entry, read(entry)) for entry in entries)
+            for (name, _), data in results:
+                if data is not None:
+                    yield name, data
+
+    def _tar_entries(self, source, name_filter, mode: str):
+        with tarfile.open(fileobj=source, mode=mode) as archive:
+            for info in archive:
+                if not info.isfile():
+                    continue
+                name = info.name
+                if name_filter is not None:
+                    name = name_filter(name)
+                    if name is None:
+                        continue
+                if not self._fits(name, info.size):
+                    continue
+                try:
+                    with metrics.timer('extract', format='tar'):
+                        file = archive.extractfile(info)
+                        data = (
+                            _read_member(file, self.limits.max_member_size)
+                            if file
+                            else None
+                        )
+                except Exception as e:
+                    logger.error(f'Ошибка при распаковке файла {info.name}: {e}')
+                    continue
+                if data is not None:
+                    yield name, data
+
+    def _7z_entries(self, source, name_filter):
+        # py7zr не умеет отдавать файлы по одному без распаковки всего
+        # архива в память, поэтому файлы распаковываются во временный каталог
+        # и читаются с диска; объём проверяется по заголовкам заранее
+        with py7zr.SevenZipFile(source, mode='r') as archive:
+            entries = {}
+            for info in archive.list():
+                if info.is_directory:
+                    continue
+                name = info.filename
+                if name_filter is not None:
+                    name = name_filter(name)
+                    if name is None:
+                        continue
+                if self._fits(name, info.uncompressed):
+                    entries[info.filename] = name
+            declared = sum(
+                info.uncompressed for info in archive.list() if info.filename in entries
+            )
+            limit = self.limits.max_total_size
+            if limit is not None and self.total + declared > limit:
+                raise ArchiveLimitError(f'распаковка займёт больше {limit} байт')
+            if not entries:
+                return
+
+            with tempfile.TemporaryDirectory() as directory:
+                with metrics.timer('extract', format='7z'):
+                    archive.extract(path=directory, targets=list(entries))
+                root = os.path.realpath(directory)
+                for filename, name in entries.items():
+                    path = os.path.realpath(os.path.join(directory, filename))
+                    # Символьные ссылки и пути за пределами каталога не читаем
+                    if (
+                        not path.startswith(root + os.sep)
+                        or os.path.islink(os.path.join(directory, filename))
+                        or not os.path.isfile(path)
+                    ):
+                        continue
+                    with open(path, 'rb') as file:
+                        data = _read_member(file, self.limits.max_member_size)
+                    os.remove(path)
+                    if data is not None:
+                        yield name, data
+
+
+def _source_size(source):
+    """Размер seekable файлового объекта (позиция не меняется)."""
+    position = source.tell()
+    size = source.seek(0, io.SEEK_END)
+    source.seek(position)
+    return size - position
+
+
+def iter_archive(
+    source,
+    name: str = '',
+    archive_type: str | None = None,
+    limits: ArchiveLimits = DEFAULT_LIMITS,
+    name_filter=None,
+    workers: int = DEFAULT_WORKERS,
+    tar_mode: str = 'r|*',
+):
+    """
+    Распаковывает архив (и вложенные архивы), отдавая файлы по одному.
+
+    :param source: Содержимое архива (bytes) или файловый объект; tar-архив
+        читается потоково и не требует перемотки, zip и 7z - требуют.
+    :param name: Имя архива (для определения формата).
+    :param archive_type: 'zip', 'tar' или '7z'; по умолчанию по имени и
+        сигнатуре.
+    :param limits: Ограничения распаковки; max_depth=1 - не распаковывать
+        вложенные архивы.
+    :param name_filter: Функция, возвращающая новое имя файла архива верхнего
+        уровня или None, если файл нужно пропустить.
+    :param workers: Число потоков для распаковки больших zip-архивов.
+    :param tar_mode: Режим tarfile.open (например, 'r:gz' для архива с
+        произвольным доступом).
+    :return: Генератор ArchiveMember (кроме самих вложенных архивов).
+    :raises ArchiveLimitError: Превышены ограничения; уже отданные файлы
+        остаются корректными.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    if archive_type is None:
+        if not source.seekable():
+            raise ValueError('Формат потокового архива нужно указать явно')
+        prefix = source.read(SNIFF_SIZE)
+        source.seek(-len(prefix), io.SEEK_CUR)
+        archive_type = archive_format(name, prefix)
+        if archive_type is None:
+            raise ValueError(f'Файл {name} не является архивом')
+
+    if source.seekable():
+        size = _source_size(source)
+        extractor = _Extractor(limits, lambda: size, workers)
+    else:
+        source = _CountingReader(source)
+        extractor = _Extractor(limits, lambda: source.count, workers)
+    yield from extractor.members_of(archive_type, source, 1, name_filter, tar_mode)
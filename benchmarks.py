@@ -0,0 +1,819 @@
+"""
+Офлайн-бенчмарки этапов сканирования.
+
+Бенчмарки не обращаются к сети и не загружают модели: корпус (файлы Python,
+вложенные архивы, выгрузка хешей на миллионы строк) генерируется, эмбеддинги
+считает маленькая модель-заглушка на NumPy, а ответы GitHub API отдаёт
+локальный HTTP-сервер. Для каждого этапа измеряются пропускная способность,
+перцентили задержки на единицу работы (файл, архив, пакет запросов) и пиковый
+объём памяти (tracemalloc, отдельным прогоном).
+
+Запуск:
+    python benchmarks.py [--output FILE] [--quick] [--stages a,b] [--repeat N]
+    python benchmarks.py compare base.json new.json
+"""
+
+import argparse
+import gc
+import hashlib
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import re
+import resource
+import statistics
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import zipfile
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from logging_config import logging
+
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+logger = logging.getLogger(__name__)
+
+RESULT_FORMAT_VERSION = 1
+BENCH_BACKEND = 'bench-tiny'
+BENCH_OWNER = 'bench'
+BENCH_REPO = 'corpus'
+DEFAULT_FILES = 400
+DEFAULT_HASH_ROWS = 2_000_000
+DEFAULT_REPEAT = 3
+DEFAULT_EMBEDDINGS = 20_000
+QUICK_SETTINGS = {'files': 60, 'hash_rows': 100_000, 'embeddings': 2_000, 'repeat': 1}
+# Запросов к DataFrame в search_hash_in_dataset (каждый - полный проход по столбцу)
+LEGACY_HASH_QUERIES = 20
+HASH_QUERY_BATCH = 64
+# Этап считается замедлившимся при падении пропускной способности больше чем на
+COMPARE_TOLERANCE = 0.1
+
+Corpus = namedtuple('Corpus', ['files', 'archives', 'csv_path', 'hash_queries'])
+BenchmarkContext = namedtuple(
+    'BenchmarkContext', ['corpus', 'workdir', 'server', 'embeddings', 'hash_rows']
+)
+
+_WORDS = (
+    'data value item result buffer config payload client server token path '
+    'name index count total offset chunk record entry state handler'
+).split()
+
+
+class TinyTokenizer:
+    """
+    Токенизатор-заглушка с тем подмножеством интерфейса быстрого токенизатора
+    transformers, которое использует chunking.chunk_code.
+    """
+
+    _token_re = re.compile(r'\w+|[^\w\s]')
+
+    def __init__(self, vocab_size: int):
+        self.vocab_size = vocab_size
+
+    def num_special_tokens_to_add(self, pair: bool = False) -> int:
+        return 2
+
+    def build_inputs_with_special_tokens(self, input_ids: list[int]) -> list[int]:
+        return [1, *input_ids, 2]
+
+    def encode(self, text: str) -> tuple[list[int], list[tuple[int, int]]]:
+        ids = []
+        offsets = []
+        for match in self._token_re.finditer(text):
+            ids.append(3 + zlib.crc32(match.group().encode()) % (self.vocab_size - 3))
+            offsets.append(match.span())
+        return ids, offsets
+
+    def __call__(
+        self, text, add_special_tokens=True, return_offsets_mapping=False, **_
+    ):
+        ids, offsets = self.encode(text)
+        if add_special_tokens:
+            ids = self.build_inputs_with_special_tokens(ids)
+        encoding = {'input_ids': ids}
+        if return_offsets_mapping:
+            encoding['offset_mapping'] = offsets
+        return encoding
+
+
+class TinyBackend:
+    """
+    Модель-заглушка: таблица эмбеддингов токенов, один плотный слой и mean
+    pooling. Стоимость forward растёт с числом токенов, как у настоящей модели,
+    но на порядки меньше, поэтому бенчмарк измеряет накладные расходы
+    конвейера, а не модели.
+    """
+
+    def __init__(self, dim: int = 64, vocab_size: int = 4096, max_length: int = 512):
+        generator = np.random.default_rng(0)
+        self.max_length = max_length
+        self.tokenizer = TinyTokenizer(vocab_size)
+        self._table = generator.standard_normal((vocab_size, dim)).astype(np.float32)
+        self._weights = generator.standard_normal((dim, dim)).astype(np.float32)
+
+    @property
+    def name(self) -> str:
+        return BENCH_BACKEND
+
+    def tokenize(self, texts: list[str], max_length: int) -> list[list[int]]:
+        limit = min(max_length, self.max_length)
+        return [self.tokenizer(text)['input_ids'][:limit] for text in texts]
+
+    def forward(self, input_ids: list[list[int]]) -> np.ndarray:
+        return np.vstack(
+            [
+                np.tanh(self._table[np.asarray(ids or [0])] @ self._weights).mean(
+                    axis=0
+                )
+                for ids in input_ids
+            ]
+        )
+
+
+def _random_function(rng: random.Random, index: int) -> str:
+    name = f'{rng.choice(_WORDS)}_{rng.choice(_WORDS)}_{index}'
+    args = ', '.join(rng.sample(_WORDS, rng.randint(1, 4)))
+    lines = [f'def {name}({args}):', f'    """Process {rng.choice(_WORDS)}."""']
+    for _ in range(rng.randint(3, 25)):
+        target, source = rng.choice(_WORDS), rng.choice(_WORDS)
+        lines.append(
+            rng.choice(
+                (
+                    f'    {target} = {source} + {rng.randint(0, 999)}',
+                    f'    if {source} > {rng.randint(0, 99)}:\n        return {target}',
+                    f"    {target} = '{rng.choice(_WORDS)}-{rng.randint(0, 9999)}'",
+                    f'    for {target} in range({rng.randint(1, 50)}):\n'
+                    f'        {source} = {target} * {rng.randint(2, 9)}',
+                    f'    # {" ".join(rng.sample(_WORDS, 4))}',
+                )
+            )
+        )
+    lines.append(f'    return {rng.choice(_WORDS)}')
+    return '\n'.join(lines)
+
+
+def _random_module(rng: random.Random) -> str:
+    imports = '\n'.join(
+        f'import {module}' for module in rng.sample(['os', 'sys', 're', 'json'], 2)
+    )
+    functions = '\n\n\n'.join(
+        _random_function(rng, i) for i in range(rng.randint(2, 20))
+    )
+    return f'{imports}\n\n\n{functions}\n'
+
+
+def _make_zip(members: list[tuple[str, bytes]]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _make_tar(members: list[tuple[str, bytes]]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def _make_7z(members: list[tuple[str, bytes]]) -> bytes | None:
+    if py7zr is None:
+        return None
+    buffer = io.BytesIO()
+    with py7zr.SevenZipFile(buffer, 'w') as archive:
+        for name, data in members:
+            archive.writestr(data, name)
+    return buffer.getvalue()
+
+
+def _write_hash_csv(path: str, rows: int, known: list[bytes], seed: int):
+    """
+    Пишет выгрузку в формате MalwareBazaar (закомментированный заголовок,
+    значения в кавычках через ", "). Хеши файлов known попадают в выгрузку.
+    """
+    generator = np.random.default_rng(seed)
+    block = 100_000
+    with open(path, 'w') as file:
+        file.write(
+            '# "first_seen_utc", "sha256_hash", "md5_hash", "sha1_hash", '
+            '"file_name", "signature"\n'
+        )
+        for data in known:
+            file.write(
+                f'"2024-01-01 00:00:00", "{hashlib.sha256(data).hexdigest()}", '
+                f'"{hashlib.md5(data).hexdigest()}", "{hashlib.sha1(data).hexdigest()}", '
+                '"known.py", "Bench"\n'
+            )
+        for start in range(0, rows - len(known), block):
+            count = min(block, rows - len(known) - start)
+            digests = generator.bytes(count * 68).hex()
+            lines = []
+            for i in range(count):
+                row = digests[i * 136 : (i + 1) * 136]
+                lines.append(
+                    f'"2024-01-01 00:00:00", "{row[:64]}", "{row[64:96]}", '
+                    f'"{row[96:136]}", "sample{start + i}.exe", "Bench"\n'
+                )
+            file.write(''.join(lines))
+        file.write(f'# Number of entries: {rows}\n')
+
+
+def generate_corpus(
+    directory: str, num_files: int, hash_rows: int, seed: int = 0
+) -> Corpus:
+    """
+    Генерирует синтетический корпус.
+
+    :param directory: Каталог для выгрузки хешей.
+    :param num_files: Число файлов репозитория.
+    :param hash_rows: Число строк выгрузки хешей.
+    :return: Corpus: файлы (путь, байты), архивы (имя -> байты; вложенный zip
+        содержит tar.gz с ещё одним zip внутри), путь к CSV и хеши для поиска
+        (половина есть в выгрузке).
+    """
+    rng = random.Random(seed)
+    files = []
+    for i in range(num_files):
+        package = f'pkg{i % 8}'
+        if i % 10 == 9:
+            # Не-Python файлы для этапа определения языка
+            files.append((f'{package}/static_{i}.js', b'function f(a) { return a; }\n'))
+        else:
+            files.append((f'{package}/module_{i}.py', _random_module(rng).encode()))
+
+    members = files[: max(num_files // 4, 1)]
+    inner_zip = _make_zip(members[: len(members) // 2])
+    inner_tar = _make_tar(
+        members[len(members) // 2 :] + [('deep/inner.zip', inner_zip)]
+    )
+    archives = {
+        'nested.zip': _make_zip(members + [('inner/payload.tar.gz', inner_tar)]),
+        'nested.tar.gz': _make_tar(members + [('inner/payload.zip', inner_zip)]),
+    }
+    archive_7z = _make_7z(members)
+    if archive_7z is not None:
+        archives['plain.7z'] = archive_7z
+
+    known = [data for _, data in files[::2]]
+    csv_path = os.path.join(directory, 'bench_hashes.csv')
+    _write_hash_csv(csv_path, hash_rows, known, seed)
+    queries = [hashlib.sha256(data).hexdigest() for _, data in files]
+    return Corpus(files, archives, csv_path, queries)
+
+
+class FakeGitHubServer:
+    """
+    Локальный HTTP-сервер с подмножеством GitHub API: листинги каталогов
+    (contents), загрузка файлов по download_url, tarball и zipball.
+    """
+
+    def __init__(self, files: list[tuple[str, bytes]], latency: float = 0.0):
+        """
+        :param files: Файлы репозитория (путь, байты).
+        :param latency: Задержка каждого ответа в секундах (имитация сети).
+        """
+        self.files = dict(files)
+        self.latency = latency
+        self._listings = {}
+        for path in self.files:
+            parts = path.split('/')
+            for depth in range(len(parts)):
+                directory = '/'.join(parts[:depth])
+                kind = 'file' if depth == len(parts) - 1 else 'dir'
+                self._listings.setdefault(directory, {})[parts[depth]] = kind
+        root = f'{BENCH_OWNER}-{BENCH_REPO}-0000000'
+        members = [(f'{root}/{path}', data) for path, data in files]
+        self._archives = {'tarball': _make_tar(members), 'zipball': _make_zip(members)}
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), self._handler()
+        )
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def _listing(self, directory: str) -> list[dict]:
+        items = []
+        for name, kind in sorted(self._listings.get(directory, {}).items()):
+            path = f'{directory}/{name}' if directory else name
+            items.append(
+                {
+                    'name': name,
+                    'path': path,
+                    'type': kind,
+                    'sha': hashlib.sha1(path.encode()).hexdigest(),
+                    'download_url': f'{self.url}/raw/{path}'
+                    if kind == 'file'
+                    else None,
+                }
+            )
+        return items
+
+    def _handler(self):
+        server = self
+        prefix = f'/repos/{BENCH_OWNER}/{BENCH_REPO}/'
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят одним пакетом, иначе keep-alive упирается
+            # в задержку подтверждений TCP и замер показывает её, а не клиент
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                status, body, content_type = 404, b'', 'text/plain'
+                if self.path.startswith(prefix + 'contents'):
+                    directory = self.path[len(prefix + 'contents') :].strip('/')
+                    directory = re.sub('/+', '/', directory)
+                    if directory in server._listings:
+                        status, content_type = 200, 'application/json'
+                        body = json.dumps(server._listing(directory)).encode()
+                elif self.path[len(prefix) :] in server._archives:
+                    status, content_type = 200, 'application/octet-stream'
+                    body = server._archives[self.path[len(prefix) :]]
+                elif self.path.startswith('/raw/') and self.path[5:] in server.files:
+                    status, content_type = 200, 'application/octet-stream'
+                    body = server.files[self.path[5:]]
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def install_offline_environment():
+    """
+    Настраивает проект на работу без сети: бэкенд-заглушка, кэш эмбеддингов
+    выключен, индикаторы tqdm скрыты. Вызывается до импорта модулей проекта.
+    """
+    os.environ['NIR_EMBEDDING_BACKEND'] = BENCH_BACKEND
+    os.environ['NIR_EMBEDDING_CACHE'] = '0'
+    os.environ['TQDM_DISABLE'] = '1'
+    # Токены GitHub (source.py) не нужны локальному серверу
+    if 'source' not in sys.modules:
+        try:
+            import source  # noqa: F401
+        except ImportError:
+            sys.modules['source'] = types.SimpleNamespace(TOKEN='')
+
+    from embedding_backends import register_backend
+
+    register_backend(BENCH_BACKEND, lambda model_path, precision: TinyBackend())
+
+
+def _use_server(server: FakeGitHubServer):
+    import get_directory_contents
+    import github_client
+
+    get_directory_contents.GITHUB_API_URL = server.url
+    scheduler = github_client.RequestScheduler(tokens=[])
+    # Переменные окружения с прокси не должны перехватывать запросы к localhost
+    scheduler.session.trust_env = False
+    github_client._scheduler = scheduler
+
+
+def _file_data(corpus: Corpus):
+    from get_directory_contents import FileData
+
+    return [
+        FileData(BENCH_OWNER, BENCH_REPO, path, data.decode(), raw_content=data)
+        for path, data in corpus.files
+    ]
+
+
+def _sizes(items):
+    for item in items:
+        yield len(item.raw_content or b'')
+
+
+# Этапы: функция готовит данные (вне замера) и возвращает генератор, который
+# отдаёт по элементу на единицу работы: размер в байтах или (число, байты)
+
+
+def stage_language_detection(context):
+    import language_detection
+
+    language_detection._cache.clear()
+    files = context.corpus.files
+
+    def run():
+        for path, data in files:
+            language_detection.should_process_file(path, data.decode())
+            yield len(data)
+
+    return run()
+
+
+def _extract_stage(name: str):
+    def stage(context):
+        import get_directory_contents
+
+        archive = context.corpus.archives.get(name)
+        if archive is None:
+            return iter(())
+        if name.endswith('.zip'):
+            files = get_directory_contents.extract_zip(
+                archive, BENCH_OWNER, BENCH_REPO, nested=True
+            )
+        elif name.endswith('.tar.gz'):
+            files = get_directory_contents.extract_tar(
+                archive, BENCH_OWNER, BENCH_REPO, nested=True
+            )
+        else:
+            files = get_directory_contents.extract_7z(archive, BENCH_OWNER, BENCH_REPO)
+        return _sizes(files)
+
+    return stage
+
+
+def stage_hash_files(context):
+    from search_hash import get_file_hashes
+
+    def run():
+        for _, data in context.corpus.files:
+            get_file_hashes(data)
+            yield len(data)
+
+    return run()
+
+
+def stage_hash_database_build(context):
+    from search_hash import build_hash_database
+
+    directory = os.path.join(context.workdir, 'hash_db')
+
+    def run():
+        build_hash_database(context.corpus.csv_path, directory, append=False)
+        yield context.hash_rows, os.path.getsize(context.corpus.csv_path)
+
+    return run()
+
+
+def stage_search_hash_in_dataset(context):
+    import pandas as pd
+
+    from search_hash import _read_dataset_chunks, search_hash_in_dataset
+
+    dataset = pd.concat(_read_dataset_chunks(context.corpus.csv_path))
+    queries = context.corpus.hash_queries[:LEGACY_HASH_QUERIES]
+
+    def run():
+        for query in queries:
+            search_hash_in_dataset(dataset, query)
+            yield 0
+
+    return run()
+
+
+def stage_hash_index_lookup(context):
+    from search_hash import build_hash_database, HashDatabase
+
+    directory = os.path.join(context.workdir, 'hash_db')
+    if not os.path.exists(os.path.join(directory, 'meta.json')):
+        build_hash_database(context.corpus.csv_path, directory, append=False)
+    database = HashDatabase(directory)
+    queries = context.corpus.hash_queries
+
+    def run():
+        for start in range(0, len(queries), HASH_QUERY_BATCH):
+            batch = queries[start : start + HASH_QUERY_BATCH]
+            database.find_rows(batch, 'sha256')
+            yield len(batch), 0
+
+    return run()
+
+
+def stage_minhash(context):
+    from minhash_lsh import minhash_signature
+
+    def run():
+        for _, data in context.corpus.files:
+            minhash_signature(data.decode())
+            yield len(data)
+
+    return run()
+
+
+def stage_get_code_embeddings(context):
+    from cluster_analysis import get_code_embeddings
+
+    def run():
+        for _, data in context.corpus.files:
+            get_code_embeddings(data.decode())
+            yield len(data)
+
+    return run()
+
+
+def stage_embed_files(context):
+    from pipeline import embed_files
+
+    files = _file_data(context.corpus)
+
+    def run():
+        for file_data, _ in embed_files(files):
+            yield len(file_data.raw_content)
+
+    return run()
+
+
+def stage_cluster_embeddings(context):
+    from cluster_analysis import cluster_embeddings
+
+    def run():
+        cluster_embeddings(context.embeddings, num_clusters=10, visualize=False)
+        yield len(context.embeddings), context.embeddings.nbytes
+
+    return run()
+
+
+def stage_streaming_kmeans(context):
+    from incremental_clustering import StreamingKMeans
+
+    batch_size = 1024
+    clusterer = StreamingKMeans(
+        num_clusters=10, sample_size=batch_size * 2, batch_size=batch_size
+    )
+
+    def run():
+        for start in range(0, len(context.embeddings), batch_size):
+            batch = context.embeddings[start : start + batch_size]
+            clusterer.partial_fit(batch)
+            yield len(batch), batch.nbytes
+        clusterer.flush()
+
+    return run()
+
+
+def _fetch_stage(mode: str):
+    def stage(context):
+        from get_directory_contents import iter_directory_contents
+
+        _use_server(context.server)
+        return _sizes(iter_directory_contents(BENCH_OWNER, BENCH_REPO, mode=mode))
+
+    return stage
+
+
+STAGES = {
+    'language_detection': stage_language_detection,
+    'extract_zip': _extract_stage('nested.zip'),
+    'extract_tar': _extract_stage('nested.tar.gz'),
+    'extract_7z': _extract_stage('plain.7z'),
+    'hash_files': stage_hash_files,
+    'hash_database_build': stage_hash_database_build,
+    'search_hash_in_dataset': stage_search_hash_in_dataset,
+    'hash_index_lookup': stage_hash_index_lookup,
+    'minhash': stage_minhash,
+    'get_code_embeddings': stage_get_code_embeddings,
+    'embed_files': stage_embed_files,
+    'cluster_embeddings': stage_cluster_embeddings,
+    'streaming_kmeans': stage_streaming_kmeans,
+    'fetch_serial': _fetch_stage('serial'),
+    'fetch_async': _fetch_stage('async'),
+    'fetch_archive': _fetch_stage('archive'),
+}
+
+
+def _run_once(stage, context, trace: bool = False):
+    gc.collect()
+    work = stage(context)
+    if trace:
+        tracemalloc.start()
+    items = total_bytes = 0
+    latencies = []
+    try:
+        start = last = time.perf_counter()
+        for result in work:
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+            count, size = result if isinstance(result, tuple) else (1, result)
+            items += count
+            total_bytes += size
+        peak = tracemalloc.get_traced_memory()[1] if trace else None
+    finally:
+        if trace:
+            tracemalloc.stop()
+    return items, total_bytes, last - start, latencies, peak
+
+
+def run_stage(stage, context, repeat: int = DEFAULT_REPEAT, memory: bool = True):
+    """
+    Замеряет этап.
+
+    :param repeat: Число прогонов для замера времени (берётся медиана).
+    :param memory: Сделать дополнительный прогон под tracemalloc для пика памяти
+        (под трассировкой код работает медленнее, поэтому время в нём не
+        учитывается).
+    :return: Словарь с метриками этапа.
+    """
+    durations = []
+    latencies = []
+    items = total_bytes = 0
+    for _ in range(repeat):
+        items, total_bytes, duration, run_latencies, _ = _run_once(stage, context)
+        durations.append(duration)
+        latencies.extend(run_latencies)
+
+    seconds = statistics.median(durations)
+    result = {
+        'items': items,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'items_per_second': items / seconds if seconds > 0 else None,
+        'mb_per_second': total_bytes / 2**20 / seconds if seconds > 0 else None,
+        'latency_ms': None,
+        'peak_memory_mb': None,
+    }
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        result['latency_ms'] = {
+            'p50': p50,
+            'p90': p90,
+            'p99': p99,
+            'max': max(latencies) * 1000,
+        }
+    if memory:
+        peak = _run_once(stage, context, trace=True)[4]
+        result['peak_memory_mb'] = peak / 2**20
+    return result
+
+
+def run_benchmarks(
+    stages: list[str] | None = None,
+    num_files: int = DEFAULT_FILES,
+    hash_rows: int = DEFAULT_HASH_ROWS,
+    num_embeddings: int = DEFAULT_EMBEDDINGS,
+    repeat: int = DEFAULT_REPEAT,
+    memory: bool = True,
+    server_latency: float = 0.0,
+    seed: int = 0,
+) -> dict:
+    """
+    Генерирует корпус и замеряет выбранные этапы.
+
+    :param stages: Имена этапов из STAGES (по умолчанию все).
+    :param server_latency: Задержка ответов локального сервера GitHub в секундах.
+    :return: Результаты в формате, пригодном для сравнения запусков (compare).
+    """
+    stages = stages or list(STAGES)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f'Неизвестные этапы: {", ".join(sorted(unknown))}')
+
+    install_offline_environment()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='nir-bench-') as workdir:
+        logger.info('Генерация синтетического корпуса...')
+        corpus = generate_corpus(workdir, num_files, hash_rows, seed)
+        embeddings = (
+            np.random.default_rng(seed)
+            .standard_normal((num_embeddings, 64))
+            .astype(np.float32)
+        )
+        with FakeGitHubServer(corpus.files, server_latency) as server:
+            context = BenchmarkContext(corpus, workdir, server, embeddings, hash_rows)
+            for name in stages:
+                logger.info(f'Этап {name}...')
+                # Предупреждения этапов (например, о неподдерживаемом языке) не
+                # нужны в отчёте и искажают время
+                level = logging.root.level
+                logging.root.setLevel(logging.ERROR)
+                try:
+                    results[name] = run_stage(STAGES[name], context, repeat, memory)
+                finally:
+                    logging.root.setLevel(level)
+
+    return {
+        'format_version': RESULT_FORMAT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+        },
+        'config': {
+            'files': num_files,
+            'hash_rows': hash_rows,
+            'embeddings': num_embeddings,
+            'repeat': repeat,
+            'server_latency': server_latency,
+            'seed': seed,
+        },
+        'stages': results,
+        # ru_maxrss в Linux - в килобайтах
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compare(base: dict, new: dict, tolerance: float = COMPARE_TOLERANCE) -> list[dict]:
+    """
+    Сравнивает два запуска по этапам, присутствующим в обоих.
+
+    :return: Для каждого этапа отношение пропускной способности и p50 задержки
+        (новый / базовый) и признак замедления больше чем на tolerance.
+    """
+    if base.get('config') != new.get('config'):
+        logger.warning('Запуски сделаны с разными параметрами корпуса')
+    rows = []
+    for name, new_stage in new['stages'].items():
+        base_stage = base['stages'].get(name)
+        if base_stage is None or not base_stage['items_per_second']:
+            continue
+        throughput = (new_stage['items_per_second'] or 0) / base_stage[
+            'items_per_second'
+        ]
+        latency = None
+        if base_stage['latency_ms'] and new_stage['latency_ms']:
+            latency = new_stage['latency_ms']['p50'] / max(
+                base_stage['latency_ms']['p50'], 1e-9
+            )
+        rows.append(
+            {
+                'stage': name,
+                'throughput_ratio': throughput,
+                'latency_p50_ratio': latency,
+                'regression': throughput < 1 - tolerance,
+            }
+        )
+    return rows
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарки этапов сканирования')
+    parser.add_argument('--output', help='Файл для результатов (по умолчанию stdout)')
+    parser.add_argument('--stages', help='Этапы через запятую: ' + ', '.join(STAGES))
+    parser.add_argument('--files', type=int, default=DEFAULT_FILES)
+    parser.add_argument('--hash-rows', type=int, default=DEFAULT_HASH_ROWS)
+    parser.add_argument('--embeddings', type=int, default=DEFAULT_EMBEDDINGS)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument(
+        '--server-latency', type=float, default=0.0, help='Задержка ответов, мс'
+    )
+    parser.add_argument('--no-memory', action='store_true', help='Без замера памяти')
+    parser.add_argument('--quick', action='store_true', help='Маленький корпус')
+    args = parser.parse_args(argv)
+    if args.quick:
+        for name, value in QUICK_SETTINGS.items():
+            setattr(args, name, value)
+    return args
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['compare']:
+        with open(sys.argv[2]) as base_file, open(sys.argv[3]) as new_file:
+            rows = compare(json.load(base_file), json.load(new_file))
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+        sys.exit(1 if any(row['regression'] for row in rows) else 0)
+
+    args = _parse_args(sys.argv[1:])
+    report = run_benchmarks(
+        stages=args.stages.split(',') if args.stages else None,
+        num_files=args.files,
+        hash_rows=args.hash_rows,
+        num_embeddings=args.embeddings,
+        repeat=args.repeat,
+        memory=not args.no_memory,
+        server_latency=args.server_latency / 1000,
+    )
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -1,66 +1,168 @@
 import os
-from get_directory_contents import get_directory_contents
-from cluster_analysis import (
-    analyze_code,
-    load_reference_clusters,
-    compare_clusters,
-)
+
+import metrics
+from cluster_analysis import preprocess_code, preprocessing_params
+from crawl_state import CrawlState
+from embedding_backends import get_backend
 from logging_config import logging
-from language_detection import should_process_file
+from minhash_lsh import NEAR_MATCH_THRESHOLD, MinHashLSHIndex
+from parallel import analyze_parallel
+from pipeline import (
+    embed_files,
+    fetch_files,
+    filter_files,
+    prefilter_files,
+    score_files,
+)
+from reference_index import REFERENCE_INDEX_DIR, ReferenceIndex
+from result_store import Deduplicator, ResultStore
 
 logger = logging.getLogger(__name__)
 
 TERMINAL_WIDTH = os.get_terminal_size().columns
+SIMILARITY_STATE_FILE = 'similarity_scan_state.sqlite3'
+# Число процессов анализа; 1 - анализ в текущем процессе
+WORKERS = int(os.environ.get('NIR_WORKERS', '1'))
 
 
-def check_new_code(threshold_value: float = 0.5):
-    logger.info('Загружаем эталонные кластеры...')
-    reference_clusters_file = 'reference_clusters.pkl'
-    reference_df = load_reference_clusters(reference_clusters_file)
+def _format_matches(matches: list[tuple[str, float]]) -> str:
+    return ', '.join(f'{source} ({score:.2f})' for source, score in matches)
+
+
+def check_new_code(
+    threshold_value: float = 0.9,
+    top_k: int = 5,
+    lsh_threshold: float = NEAR_MATCH_THRESHOLD,
+    workers: int = WORKERS,
+):
+    logger.info('Загружаем эталонный индекс...')
+    reference_index = ReferenceIndex.load(REFERENCE_INDEX_DIR)
+    model = get_backend().name
+    if reference_index.model not in (None, model):
+        logger.error(
+            f'Эталонный индекс построен моделью {reference_index.model}, '
+            f'а проверка использует {model}: перестройте индекс '
+            '(collect_reference_clusters.py) или выберите ту же модель '
+            '(NIR_EMBEDDING_BACKEND)'
+        )
+        return
+    # Должны совпадать с параметрами построения (collect_reference_clusters)
+    preprocessing = preprocessing_params(strip_comments=True)
+    if reference_index.preprocessing != preprocessing:
+        logger.error(
+            f'Эталонный индекс построен с предобработкой {reference_index.preprocessing}, '
+            f'проверка использует {preprocessing}: перестройте индекс '
+            '(collect_reference_clusters.py)'
+        )
+        return
+    lsh_index = MinHashLSHIndex.load(REFERENCE_INDEX_DIR)
+    if lsh_index is None:
+        logger.warning('LSH-индекс не найден, все файлы проверяются моделью')
 
     logger.info('Загружаем файлы для анализа...')
-    new_code_contents = get_directory_contents(
-        'vxunderground', 'MalwareSourceCode', 'Python'
+    repositories = [('vxunderground', 'MalwareSourceCode', 'Python')]
+    # Файлы, не изменившиеся с прошлой проверки, не загружаются повторно;
+    # их результаты берутся из состояния обхода
+    state = CrawlState(SIMILARITY_STATE_FILE, deferred=True)
+    run_id = state.start_run(resume=True)
+    new_code_contents = filter_files(
+        fetch_files(repositories, state=state, run_id=run_id)
     )
 
-    repo_results = []
-    # Анализируем каждый новый файл отдельно и сравниваем с эталонными кластерами
-    for file_data in new_code_contents:
-        if not should_process_file(file_data.file_name, file_data.file_content):
-            continue
-        logger.info(
-            f'Analyzing code file: {file_data.file_name} from {file_data.owner}/{file_data.repo_name}'
+    def save_skipped(file_data, lsh_similarity):
+        # Файл не похож ни на один эталонный - модель для него не запускается
+        state.save_result(
+            file_data,
+            {
+                'owner': file_data.owner,
+                'repo_name': file_data.repo_name,
+                'file_name': file_data.file_name,
+                'similarity_score': 0.0,
+                'lsh_similarity': lsh_similarity,
+                'matches': [],
+                'is_malicious': False,
+            },
+        )
+
+    if lsh_index is not None:
+        new_code_contents = prefilter_files(
+            new_code_contents, lsh_index, lsh_threshold, on_skip=save_skipped
+        )
+
+    # Копии уже проверенного содержимого получают сохранённый результат; он
+    # зависит от эталонного индекса и параметров проверки
+    result_store = ResultStore(
+        analysis=(
+            f'similarity:{reference_index.model}:{len(reference_index)}'
+            f':{top_k}:{threshold_value}'
         )
-        new_df = analyze_code(file_data.file_content, visualize=False)
-        if not new_df.empty:
-            similarity_score, common_clusters = compare_clusters(new_df, reference_df)
-
-            repo_results.append(
-                {
-                    'file_name': file_data.file_name,
-                    'similarity_score': similarity_score,
-                    'common_clusters': common_clusters,
-                    'is_malicious': similarity_score > threshold_value,
-                }
+    )
+    # Файлы, анализ которых не удался, и их копии не отмечаются обработанными
+    deduplicator = Deduplicator(
+        result_store, on_duplicate=state.save_result, on_failed=state.skip_blob
+    )
+    new_code_contents = deduplicator.filter(new_code_contents)
+
+    # Файлы анализируются по мере загрузки и сравниваются с эталонным индексом
+    if workers > 1:
+        # Эталонный индекс загружает каждый воркер; отметки о файлах
+        # записываются, когда сохранены результаты всех более ранних задач
+        results = analyze_parallel(
+            new_code_contents,
+            workers,
+            top_k=top_k,
+            threshold=threshold_value,
+            checkpoint=state.checkpoint,
+            on_task_done=state.commit,
+            on_failed=deduplicator.fail,
+        )
+    else:
+        results = score_files(
+            # Предобработка та же, что при построении эталонного индекса
+            embed_files(
+                new_code_contents,
+                preprocess=preprocess_code,
+                on_batch_done=state.commit,
+                on_failed=deduplicator.fail,
+            ),
+            reference_index,
+            top_k=top_k,
+            threshold=threshold_value,
+        )
+
+    with metrics.profiled('check_new_code'):
+        for file_data, result in deduplicator.resolve(results):
+            logger.info(
+                f'Analyzed code file: {result["file_name"]} from {result["owner"]}/{result["repo_name"]}'
             )
+            state.save_result(file_data, result)
+            similarity_score = result['similarity_score']
+            matches = result['matches']
+            file_name = result['file_name']
 
             if similarity_score > threshold_value:  # Пороговое значение
                 print(f'{" Similarity Analysis RESULT ":*^{TERMINAL_WIDTH}}')
                 print(f'Similarity score: {similarity_score:.2f}')
                 print(
-                    f'⚠️ File "{file_data.file_name}" is potentially malicious.\n'
-                    f'🔍 Common clusters detected: {", ".join(map(str, common_clusters))}'
+                    f'⚠️ File "{file_name}" is potentially malicious.\n'
+                    f'🔍 Closest reference files: {_format_matches(matches)}'
                 )
                 print(f'{" ALERT ":*^{TERMINAL_WIDTH}}')
             else:
                 print(f'{" Similarity Analysis RESULT ":*^{TERMINAL_WIDTH}}')
                 print(f'Similarity score: {similarity_score:.2f}')
                 print(
-                    f'✅ File "{file_data.file_name}" is not malicious based on the current analysis.'
+                    f'✅ File "{file_name}" is not malicious based on the current analysis.'
                 )
                 print(f'{" SAFE ":*^{TERMINAL_WIDTH}}')
 
-    # Финальный отчет для всего репозитория
+    state.finish_run(run_id)
+    logger.info(f'Копий уже проверенных файлов: {deduplicator.skipped}')
+
+    # Финальный отчет для всего репозитория (включая файлы без изменений)
+    repo_results = []
+    for owner, repo_name, _ in repositories:
+        repo_results.extend(state.get_results(owner, repo_name))
     print(f'{" Repository Analysis Summary ":*^{TERMINAL_WIDTH}}')
 
     total_files = len(repo_results)
@@ -78,9 +180,27 @@ def check_new_code(threshold_value: float = 0.5):
                 print(
                     f'⚠️ File: {result["file_name"]}, '
                     f'Similarity Score: {result["similarity_score"]:.2f}, '
-                    f'Common Clusters: {", ".join(map(str, result["common_clusters"]))}'
+                    f'Closest Reference Files: {_format_matches(result["matches"])}'
                 )
 
+    duplicates = result_store.duplicates()
+    if duplicates:
+        print(f'\nDuplicated files: {len(duplicates)}')
+        for duplicate in duplicates:
+            result = duplicate['result']
+            verdict = (
+                'not analyzed'
+                if result is None
+                else 'malicious'
+                if result['is_malicious']
+                else 'safe'
+            )
+            print(
+                f'{duplicate["content_hash"][:12]} ({verdict}), '
+                f'{duplicate["copies"]} copies: {", ".join(duplicate["locations"])}'
+            )
+
 
 if __name__ == '__main__':
+    metrics.configure_from_env()
     check_new_code()
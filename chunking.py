@@ -0,0 +1,125 @@
+import ast
+import bisect
+import io
+from collections import namedtuple
+
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OVERLAP = 64
+
+# text - исходный фрагмент кода, input_ids - его токены вместе со служебными
+Chunk = namedtuple('Chunk', ['text', 'input_ids'])
+
+
+def _top_level_starts(code: str) -> list[int] | None:
+    """
+    Возвращает смещения (в символах) начала функций, классов и прочих
+    инструкций верхнего уровня или None, если код не разбирается как Python.
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+
+    line_offsets = [0]
+    for line in io.StringIO(code, newline='').readlines():
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    starts = []
+    for node in tree.body:
+        # Декораторы относятся к определению функции/класса
+        decorators = getattr(node, 'decorator_list', [])
+        lineno = min([node.lineno] + [d.lineno for d in decorators])
+        starts.append(line_offsets[lineno - 1])
+    return starts
+
+
+def _window_bounds(
+    num_tokens: int, budget: int, overlap: int, boundaries: list[int] | None
+) -> list[tuple[int, int]]:
+    """
+    Возвращает границы окон [start, end) в индексах токенов.
+
+    Без boundaries окна идут подряд с перекрытием overlap. С boundaries окно
+    заканчивается на последней границе верхнеуровневого узла AST, которая
+    помещается в бюджет; если узел сам длиннее бюджета, он режется окнами.
+    """
+    step = max(budget - overlap, 1)
+    bounds = []
+    start = 0
+    while start < num_tokens:
+        end = min(start + budget, num_tokens)
+        if boundaries and end < num_tokens:
+            position = bisect.bisect_right(boundaries, end) - 1
+            if position >= 0 and boundaries[position] > start:
+                end = boundaries[position]
+                bounds.append((start, end))
+                start = end
+                continue
+        bounds.append((start, end))
+        if end == num_tokens:
+            break
+        start += step
+    return bounds
+
+
+def chunk_code(
+    code: str,
+    tokenizer,
+    max_tokens: int,
+    overlap: int = DEFAULT_OVERLAP,
+    split_on_ast: bool = False,
+) -> list[Chunk]:
+    """
+    Разбивает код на чанки, заполняющие бюджет токенов модели.
+
+    Код токенизируется один раз, после чего нарезается на окна по max_tokens
+    токенов (с учётом служебных токенов модели) с перекрытием overlap.
+
+    :param code: Исходный код.
+    :param tokenizer: Быстрый (fast) токенизатор transformers.
+    :param max_tokens: Максимальная длина чанка в токенах.
+    :param overlap: Число токенов, общих для соседних окон.
+    :param split_on_ast: Резать по границам функций/классов верхнего уровня.
+    :return: Список чанков с исходным текстом и готовыми input_ids.
+    """
+    if not code:
+        return []
+
+    budget = max(max_tokens - tokenizer.num_special_tokens_to_add(), 1)
+    overlap = min(max(overlap, 0), budget - 1)
+
+    encoding = tokenizer(
+        code,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        verbose=False,
+    )
+    input_ids = encoding['input_ids']
+    token_starts = [start for start, _ in encoding['offset_mapping']]
+    if not input_ids:
+        return []
+
+    boundaries = None
+    if split_on_ast:
+        starts = _top_level_starts(code)
+        if starts is None:
+            logger.debug('Код не разбирается как Python, используем скользящее окно')
+        else:
+            boundaries = sorted(
+                {bisect.bisect_left(token_starts, start) for start in starts[1:]}
+            )
+
+    chunks = []
+    for start, end in _window_bounds(len(input_ids), budget, overlap, boundaries):
+        text_start = token_starts[start] if start else 0
+        text_end = token_starts[end] if end < len(input_ids) else len(code)
+        chunks.append(
+            Chunk(
+                code[text_start:text_end],
+                tokenizer.build_inputs_with_special_tokens(input_ids[start:end]),
+            )
+        )
+    return chunks
@@ -1,79 +1,283 @@
 import logging
-from transformers import AutoTokenizer, AutoModel
-import torch
-from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
+import re
+from collections import namedtuple
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 
+import metrics
+from chunking import DEFAULT_OVERLAP, Chunk, chunk_code
+from embedding_backends import get_backend
+from embedding_cache import get_default_cache, make_key
+from incremental_clustering import choose_num_clusters
+
 logger = logging.getLogger(__name__)
 
-model_name = 'Salesforce/codegen-2B-mono'
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-tokenizer.pad_token = tokenizer.eos_token
-model = AutoModel.from_pretrained(model_name)
 
+MAX_LENGTH = 2048
+DEFAULT_BATCH_SIZE = 8
+# Верхняя граница числа токенов в батче (batch_size * длина самой длинной строки)
+DEFAULT_MAX_BATCH_TOKENS = 16384
+# Увеличивается при любом изменении разбиения кода на чанки (инвалидирует кэш)
+PREPROCESSING_VERSION = 2
 
-def _get_embeddings(code: str):
-    # Токенизация кода с использованием токенизатора модели
-    inputs = tokenizer(
-        code, return_tensors='pt', truncation=True, padding=True, max_length=2048
+# Соответствие строки матрицы эмбеддингов исходному файлу и номеру чанка
+EmbeddingRef = namedtuple('EmbeddingRef', ['source_index', 'chunk_index'])
+
+
+def _make_batches(
+    lengths: list[int], batch_size: int, max_batch_tokens: int
+) -> list[list[int]]:
+    """
+    Группирует индексы чанков в батчи.
+
+    Чанки сортируются по длине, чтобы в одном батче оказывались строки близкой
+    длины и на padding тратилось как можно меньше вычислений.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    current = []
+    for index in order:
+        # Первый элемент батча самый длинный, по нему считается объём после padding
+        padded_len = lengths[current[0]] if current else lengths[index]
+        if current and (
+            len(current) >= batch_size
+            or (len(current) + 1) * padded_len > max_batch_tokens
+        ):
+            batches.append(current)
+            current = []
+        current.append(index)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def embed_chunks(
+    chunks: list[Chunk],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_length: int = MAX_LENGTH,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    use_cache: bool = True,
+) -> tuple[np.ndarray, list[int]]:
+    """
+    Возвращает эмбеддинги для уже токенизированных чанков, обрабатывая их батчами.
+
+    :param chunks: Чанки кода (см. chunking.chunk_code).
+    :param batch_size: Максимальное число чанков в одном forward pass.
+    :param max_length: Максимальная длина чанка в токенах.
+    :param max_batch_tokens: Максимальный объём батча в токенах с учётом padding.
+    :param use_cache: Искать эмбеддинги в дисковом кэше перед вызовом модели.
+    :return: Матрица эмбеддингов и индексы чанков, которым соответствуют её строки
+        (чанки из упавших батчей пропускаются).
+    """
+    if not chunks:
+        return np.array([]), []
+
+    backend = get_backend()
+    max_length = min(max_length, backend.max_length)
+    cache = get_default_cache(backend.name) if use_cache else None
+    vectors = {}
+    keys = []
+    if cache is not None:
+        keys = [
+            make_key(backend.name, max_length, PREPROCESSING_VERSION, chunk.text)
+            for chunk in chunks
+        ]
+        for i, key in enumerate(keys):
+            vector = cache.get(key)
+            if vector is not None:
+                vectors[i] = vector
+        metrics.inc(
+            'nir_cache_requests_total', len(vectors), cache='embedding', result='hit'
+        )
+        metrics.inc(
+            'nir_cache_requests_total',
+            len(chunks) - len(vectors),
+            cache='embedding',
+            result='miss',
+        )
+
+    pending = [i for i in range(len(chunks)) if i not in vectors]
+    if pending:
+        input_ids = [chunks[i].input_ids[:max_length] for i in pending]
+        lengths = [max(len(ids), 1) for ids in input_ids]
+        batches = _make_batches(lengths, batch_size, max(max_batch_tokens, max_length))
+
+        for batch in tqdm(batches, desc='Processing Batches'):
+            metrics.observe('nir_batch_chunks', len(batch), metrics.SIZE_BUCKETS)
+            metrics.observe(
+                'nir_batch_tokens',
+                len(batch) * lengths[batch[0]],
+                metrics.TOKEN_BUCKETS,
+            )
+            try:
+                with metrics.timer('forward'):
+                    embeddings = backend.forward([input_ids[i] for i in batch])
+            except Exception as e:
+                logger.warning(
+                    f'Ошибка при обработке батча из {len(batch)} чанков: {e}'
+                )
+                continue
+            for i, embedding in zip(batch, embeddings):
+                vectors[pending[i]] = embedding
+                if cache is not None:
+                    cache.put(keys[pending[i]], embedding)
+
+        if cache is not None:
+            cache.flush()
+
+    indices = sorted(vectors)
+    if not indices:
+        return np.array([]), []
+    return np.vstack([vectors[i] for i in indices]), indices
+
+
+def embed_texts(
+    texts: list[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_length: int = MAX_LENGTH,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    use_cache: bool = True,
+) -> tuple[np.ndarray, list[int]]:
+    """Как embed_chunks, но для произвольных текстов (обрезаются до max_length)."""
+    if not texts:
+        return np.array([]), []
+
+    backend = get_backend()
+    input_ids = backend.tokenize(texts, max_length)
+    return embed_chunks(
+        [Chunk(text, ids) for text, ids in zip(texts, input_ids)],
+        batch_size=batch_size,
+        max_length=max_length,
+        max_batch_tokens=max_batch_tokens,
+        use_cache=use_cache,
     )
 
-    # Получение эмбеддингов
-    with torch.no_grad():
-        outputs = model(**inputs)
 
-    # Эмбеддинги из последнего слоя модели
-    embeddings = outputs.last_hidden_state.mean(dim=1)
+def _get_embeddings(code: str):
+    embeddings, _ = embed_texts([code], batch_size=1)
+    return embeddings.squeeze()
+
+
+def split_code(
+    code: str,
+    max_tokens: int = MAX_LENGTH,
+    overlap: int = DEFAULT_OVERLAP,
+    split_on_ast: bool = False,
+) -> list[Chunk]:
+    """Разбивает код на чанки по токенам модели."""
+    backend = get_backend()
+    with metrics.timer('tokenize'):
+        return chunk_code(
+            code,
+            backend.tokenizer,
+            min(max_tokens, backend.max_length),
+            overlap=overlap,
+            split_on_ast=split_on_ast,
+        )
+
+
+def embed_code_batch(
+    codes: list[str],
+    max_tokens: int = MAX_LENGTH,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    overlap: int = DEFAULT_OVERLAP,
+    split_on_ast: bool = False,
+    on_failed=None,
+) -> tuple[np.ndarray, list[EmbeddingRef]]:
+    """
+    Возвращает эмбеддинги чанков сразу для нескольких файлов.
 
-    return embeddings.squeeze().cpu().numpy()
+    Чанки всех файлов упаковываются в общие батчи, после чего каждая строка
+    результата сопоставляется с исходным файлом и номером чанка.
 
+    :param codes: Содержимое файлов.
+    :param on_failed: Вызывается со списком номеров файлов, часть чанков
+        которых попала в упавшие батчи модели.
+    :return: Матрица эмбеддингов и список EmbeddingRef той же длины.
+    """
+    chunks = []
+    refs = []
+    for source_index, code in enumerate(codes):
+        for chunk_index, chunk in enumerate(
+            split_code(code, max_tokens, overlap, split_on_ast)
+        ):
+            chunks.append(chunk)
+            refs.append(EmbeddingRef(source_index, chunk_index))
+
+    embeddings, indices = embed_chunks(
+        chunks,
+        batch_size=batch_size,
+        max_length=max_tokens,
+        max_batch_tokens=max_batch_tokens,
+    )
+    if on_failed is not None and len(indices) < len(chunks):
+        done = set(indices)
+        failed = {ref.source_index for i, ref in enumerate(refs) if i not in done}
+        on_failed(sorted(failed))
+    return embeddings, [refs[i] for i in indices]
+
+
+def split_embeddings_by_source(
+    embeddings: np.ndarray, refs: list[EmbeddingRef], num_sources: int
+) -> list[np.ndarray]:
+    """Раскладывает результат embed_code_batch обратно по исходным файлам."""
+    rows = [[] for _ in range(num_sources)]
+    for row, ref in enumerate(refs):
+        rows[ref.source_index].append((ref.chunk_index, row))
+
+    result = []
+    for source_rows in rows:
+        if source_rows:
+            result.append(embeddings[[row for _, row in sorted(source_rows)]])
+        else:
+            result.append(np.array([]))
+    return result
+
+
+def _determine_optimal_clusters(data, max_k=10, plot=False):
+    """
+    Выбирает число кластеров методом локтя (кандидаты обучаются параллельно).
 
-def _determine_optimal_clusters(data, max_k=10):
+    :param plot: Сохранить график SSE в elbow_method.png.
+    """
     if len(data) < 2:
         return 1  # Минимум 1 кластер
 
-    max_k = min(max_k, len(data))
-    sse = []
-    for k in range(1, max_k + 1):
-        kmeans = KMeans(n_clusters=k, random_state=0)
-        kmeans.fit(data)
-        sse.append(kmeans.inertia_)
-
-    plt.figure()
-    plt.plot(range(1, 11), sse)
-    plt.xlabel('Number of Clusters')
-    plt.ylabel('SSE')
-    plt.title('Elbow Method For Optimal k')
-    plt.savefig('elbow_method.png')
-    plt.close()
-
-    optimal_k = 3
-    for i in range(1, len(sse) - 1):
-        if sse[i] - sse[i + 1] < sse[i - 1] - sse[i]:
-            optimal_k = i + 1
-            break
+    optimal_k, sse = choose_num_clusters(data, range(1, max_k + 1))
 
-    return optimal_k
+    if plot and sse:
+        import matplotlib.pyplot as plt
 
+        plt.figure()
+        plt.plot(list(sse), list(sse.values()))
+        plt.xlabel('Number of Clusters')
+        plt.ylabel('SSE')
+        plt.title('Elbow Method For Optimal k')
+        plt.savefig('elbow_method.png')
+        plt.close()
 
-def get_code_embeddings(code: str, max_tokens: int = 2048) -> np.ndarray:
-    """Возвращает эмбеддинги для кода."""
-    # Токенизация и разбиение на чанки
-    code_chunks = [code[i : i + max_tokens] for i in range(0, len(code), max_tokens)]
+    return optimal_k
 
-    all_embeddings = []
-    for code_chunk in tqdm(code_chunks, desc='Processing Chunks'):
-        try:
-            embedding = _get_embeddings(code_chunk)
-            all_embeddings.append(embedding)
-        except Exception as e:
-            logger.warning(f'Ошибка при обработке чанка: {e}')
 
-    return np.vstack(all_embeddings) if all_embeddings else np.array([])
+def get_code_embeddings(
+    code: str,
+    max_tokens: int = MAX_LENGTH,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    overlap: int = DEFAULT_OVERLAP,
+    split_on_ast: bool = False,
+) -> np.ndarray:
+    """Возвращает эмбеддинги для кода."""
+    embeddings, _ = embed_code_batch(
+        [code],
+        max_tokens,
+        batch_size=batch_size,
+        overlap=overlap,
+        split_on_ast=split_on_ast,
+    )
+    return embeddings
 
 
 def cluster_embeddings(
@@ -84,6 +288,8 @@ def cluster_embeddings(
     filename: str = 'clusters.csv',
 ) -> pd.DataFrame:
     """Кластеризует эмбеддинги и возвращает результаты."""
+    from sklearn.cluster import KMeans
+
     if embeddings.size == 0:
         logger.warning('Нет данных для кластеризации.')
         return pd.DataFrame()
@@ -96,10 +302,14 @@ def cluster_embeddings(
 
     # Кластеризация
     kmeans = KMeans(n_clusters=num_clusters)
-    clusters = kmeans.fit_predict(embeddings)
+    with metrics.timer('clustering'):
+        clusters = kmeans.fit_predict(embeddings)
 
     # Визуализация
     if visualize and len(embeddings) >= 2:
+        import matplotlib.pyplot as plt
+        from sklearn.decomposition import PCA
+
         pca = PCA(n_components=2)
         reduced_embeddings = pca.fit_transform(embeddings)
         plt.scatter(
@@ -166,19 +376,37 @@ def analyze_code(
     return df
 
 
-def save_reference_clusters(df: pd.DataFrame, filename: str):
-    df.to_pickle(filename)
+def cluster_centroids(embeddings: np.ndarray, clusters: np.ndarray) -> np.ndarray:
+    """Возвращает центроиды кластеров (строка i - центр кластера i)."""
+    return np.vstack(
+        [embeddings[clusters == label].mean(axis=0) for label in np.unique(clusters)]
+    )
+
+
+def preprocess_code(code: str) -> str:
+    """
+    Удаляем комментарии и лишние пробелы.
 
+    Применяется и при построении эталонного индекса, и при проверке нового
+    кода: эмбеддинги сравнимы, только если предобработка одинакова.
+    """
+    code = re.sub(r'#.*', '', code)  # Удаляем однострочные комментарии
+    code = re.sub(r'\n\s*\n', '\n', code)  # Удаляем пустые строки
+    return code.strip()
 
-def load_reference_clusters(filename: str) -> pd.DataFrame:
-    return pd.read_pickle(filename)
 
+def preprocessing_params(**extra) -> dict:
+    """
+    Параметры разбиения кода на чанки, от которых зависят эмбеддинги.
 
-def compare_clusters(new_df: pd.DataFrame, reference_df: pd.DataFrame) -> float:
-    if 'cluster' not in new_df.columns or 'cluster' not in reference_df.columns:
-        logger.error("Столбец 'cluster' отсутствует в DataFrame.")
-        return 0.0, set()
+    Сохраняются в эталонном индексе, чтобы проверка нового кода могла
+    обнаружить несовместимый индекс.
 
-    common_clusters = set(new_df['cluster']).intersection(set(reference_df['cluster']))
-    similarity_score = len(common_clusters) / len(set(reference_df['cluster']))
-    return similarity_score, common_clusters
+    :param extra: Дополнительные параметры (например, предобработка кода).
+    """
+    return {
+        'version': PREPROCESSING_VERSION,
+        'max_tokens': MAX_LENGTH,
+        'overlap': DEFAULT_OVERLAP,
+        **extra,
+    }
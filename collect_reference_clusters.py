@@ -1,21 +1,29 @@
 import os
-import re
+import sys
+import numpy as np
 import pandas as pd
+
+import metrics
 from logging_config import logging
-from get_directory_contents import get_directory_contents
-from cluster_analysis import analyze_code, save_reference_clusters
-from language_detection import should_process_file
+from cluster_analysis import analyze_code, preprocess_code, preprocessing_params
+from embedding_backends import get_backend
+from incremental_clustering import StreamingKMeans
+from minhash_lsh import MinHashLSHIndex
+from pipeline import (
+    collect_embeddings,
+    embed_files,
+    fetch_files,
+    filter_files,
+    fit_clusters,
+    index_signatures,
+)
+from reference_index import REFERENCE_INDEX_DIR, ReferenceIndex
 
 logger = logging.getLogger(__name__)
 
 MAX_FILE_SIZE = 1024 * 1024  # 1MB limit
-
-
-def preprocess_code(code: str) -> str:
-    """Удаляем комментарии и лишние пробелы"""
-    code = re.sub(r'#.*', '', code)  # Удаляем однострочные комментарии
-    code = re.sub(r'\n\s*\n', '\n', code)  # Удаляем пустые строки
-    return code.strip()
+# Тип хранения эмбеддингов в эталонном индексе (float16 - вдвое меньше места)
+REFERENCE_DTYPE = os.environ.get('NIR_REFERENCE_DTYPE', 'float32')
 
 
 def process_file(file_data, save_dir: str) -> pd.DataFrame:
@@ -42,43 +50,72 @@ def process_file(file_data, save_dir: str) -> pd.DataFrame:
         return pd.DataFrame()
 
 
-def collect_reference_clusters(repositories: list[tuple[str, str, str]]):
-    """Collect clusters from repositories with improved error handling"""
-    all_code = []
-    save_dir = 'cluster_results'
-    os.makedirs(save_dir, exist_ok=True)
-
-    # Сбор всего кода из репозиториев
-    for owner, repo_name, path in repositories:
-        try:
-            logger.info(f'Processing repository: {owner}/{repo_name}')
-            contents = get_directory_contents(owner, repo_name, path)
-
-            # Фильтрация и объединение кода
-            filtered = [
-                file_data.file_content
-                for file_data in contents
-                if should_process_file(file_data.file_name, file_data.file_content)
-            ]
-            all_code.extend(filtered)
+def collect_reference_clusters(
+    repositories: list[tuple[str, str, str]], update: bool = False
+):
+    """
+    Collect clusters from repositories with improved error handling
 
-        except Exception as e:
-            logger.error(f'Error processing {owner}/{repo_name}: {str(e)}')
-            continue
-
-    # Объединяем весь код в одну строку
-    full_code = preprocess_code('\n'.join(all_code))
-
-    # Анализ всего кода
+    :param update: Добавить репозитории к уже построенному эталонному индексу,
+        дообучив кластеризацию, а не строить всё заново.
+    """
+    # Файлы загружаются, фильтруются и превращаются в эмбеддинги потоком;
+    # кластеризация дообучается по мере вычисления эмбеддингов, в памяти
+    # накапливаются только эмбеддинги для индекса
     try:
-        df = analyze_code(
-            full_code,
-            num_clusters=10,  # Увеличиваем количество кластеров для больших данных
-            save_clusters=True,
-            clusters_filename=f'{save_dir}/{owner}_{repo_name}.csv',
+        if update:
+            previous = ReferenceIndex.load(REFERENCE_INDEX_DIR)
+            clusterer = StreamingKMeans.load(REFERENCE_INDEX_DIR)
+            lsh_index = MinHashLSHIndex.load(REFERENCE_INDEX_DIR)
+            if lsh_index is None:
+                # Без сигнатур прежних эталонных файлов LSH отсеивал бы похожие
+                # на них файлы
+                logger.error(
+                    'LSH-индекс не найден или несовместим: '
+                    'постройте эталонный индекс заново (без --update)'
+                )
+                return
+        else:
+            previous = None
+            clusterer = StreamingKMeans()
+            lsh_index = MinHashLSHIndex()
+
+        files = index_signatures(filter_files(fetch_files(repositories)), lsh_index)
+        with metrics.profiled('collect_reference_clusters'):
+            embeddings, chunk_sources, sources = collect_embeddings(
+                fit_clusters(embed_files(files, preprocess=preprocess_code), clusterer)
+            )
+        clusterer.flush()
+        if embeddings.size == 0:
+            logger.error('Не удалось получить эмбеддинги эталонного кода')
+            return
+
+        if previous is not None:
+            chunk_sources = np.concatenate(
+                [
+                    previous.chunk_sources,
+                    np.asarray(chunk_sources) + len(previous.sources),
+                ]
+            )
+            embeddings = np.vstack([previous.embeddings, embeddings])
+            sources = previous.sources + sources
+
+        index = ReferenceIndex(
+            embeddings,
+            chunk_sources,
+            sources,
+            centroids=clusterer.centers,
+            labels=clusterer.predict(embeddings).astype(np.int32),
+            model=get_backend().name,
+            preprocessing=preprocessing_params(strip_comments=True),
+        )
+        index.save(REFERENCE_INDEX_DIR, dtype=REFERENCE_DTYPE)
+        clusterer.save(REFERENCE_INDEX_DIR)
+        lsh_index.save(REFERENCE_INDEX_DIR)
+        logger.info(
+            f'Reference index saved successfully: {len(index)} chunks '
+            f'from {len(sources)} files, {len(clusterer.centers)} clusters'
         )
-        save_reference_clusters(df, 'reference_clusters.pkl')
-        logger.info('Reference clusters saved successfully')
     except Exception as e:
         logger.error(f'Clustering failed: {str(e)}')
 
@@ -87,4 +124,6 @@ if __name__ == '__main__':
     repositories = [
         ('vxunderground', 'MalwareSourceCode', 'Python'),
     ]
-    collect_reference_clusters(repositories)
+    # --update: добавить репозитории к существующему эталонному индексу
+    metrics.configure_from_env()
+    collect_reference_clusters(repositories, update='--update' in sys.argv)
@@ -0,0 +1,284 @@
+import json
+import sqlite3
+import threading
+import time
+
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+CRAWL_STATE_FILE = 'crawl_state.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (owner, repo, path)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (owner, repo, path)
+);
+CREATE TABLE IF NOT EXISTS results (
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (owner, repo, path, file_name)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS run_repos (
+    run_id INTEGER NOT NULL,
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    PRIMARY KEY (run_id, owner, repo)
+);
+"""
+
+
+class CrawlState:
+    """
+    Состояние инкрементального обхода репозиториев в SQLite.
+
+    Хранит ETag листингов каталогов (для условных запросов If-None-Match),
+    git blob SHA полностью обработанных файлов, результаты анализа и список
+    репозиториев, обработанных в текущем запуске (для продолжения прерванного
+    запуска).
+
+    Если потребитель обрабатывает файлы батчами, передайте deferred=True и
+    вызывайте commit() после обработки каждого батча: тогда файл не будет
+    отмечен обработанным, пока его результат не сохранён. Отметка о
+    репозитории (mark_repo_done) в этом режиме тоже откладывается и
+    записывается вместе с отметками о его файлах. Файл, который не удалось
+    обработать, передайте в skip_blob().
+    """
+
+    def __init__(self, path: str = CRAWL_STATE_FILE, deferred: bool = False):
+        self.path = path
+        self.deferred = deferred
+        # Отложенные отметки: пары (таблица, строка); None - отменённая отметка
+        self._pending = []
+        # Сколько отложенных отметок уже записано (см. checkpoint)
+        self._committed = 0
+        # Файлы, отменённые skip_blob до того, как их отметили обработанными
+        self._skipped_blobs = set()
+        # Репозитории с файлами, отменёнными skip_blob: в этом запуске они не
+        # отмечаются обработанными
+        self._failed_repos = set()
+        # Краулер в режиме async обращается к состоянию из своего потока
+        # Один файл состояния могут одновременно использовать воркеры
+        # распределённого сканирования (см. distributed_scan)
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, query: str, params=()):
+        with self._lock, self._connection:
+            return self._connection.execute(query, params).fetchall()
+
+    def get_listing(self, owner: str, repo: str, path: str):
+        """Возвращает (etag, листинг) каталога или None."""
+        rows = self._execute(
+            'SELECT etag, body FROM listings WHERE owner=? AND repo=? AND path=?',
+            (owner, repo, path),
+        )
+        if not rows:
+            return None
+        etag, body = rows[0]
+        return etag, json.loads(body)
+
+    def save_listing(self, owner: str, repo: str, path: str, etag: str, listing):
+        if not etag:
+            return
+        self._execute(
+            'INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+            (owner, repo, path, etag, json.dumps(listing)),
+        )
+
+    def is_unchanged(self, owner: str, repo: str, path: str, sha: str) -> bool:
+        """Проверяет, был ли файл с таким blob SHA уже полностью обработан."""
+        rows = self._execute(
+            'SELECT sha FROM blobs WHERE owner=? AND repo=? AND path=?',
+            (owner, repo, path),
+        )
+        return bool(rows) and rows[0][0] == sha
+
+    def forget_blob(self, owner: str, repo: str, path: str):
+        """Удаляет сведения об изменившемся файле и его старые результаты."""
+        with self._lock, self._connection:
+            for table in ('blobs', 'results'):
+                self._connection.execute(
+                    f'DELETE FROM {table} WHERE owner=? AND repo=? AND path=?',
+                    (owner, repo, path),
+                )
+
+    def mark_blob(self, owner: str, repo: str, path: str, sha: str):
+        """Отмечает файл (со всем содержимым, если это архив) как обработанный."""
+        with self._lock:
+            if (owner, repo, path) in self._skipped_blobs:
+                self._skipped_blobs.remove((owner, repo, path))
+                return
+            if self.deferred:
+                self._pending.append(('blobs', (owner, repo, path, sha, time.time())))
+                return
+        self._execute(
+            'INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)',
+            (owner, repo, path, sha, time.time()),
+        )
+
+    def skip_blob(self, file_data):
+        """
+        Не отмечает файл обработанным, хотя обход его уже отдал (например, упал
+        батч модели с его чанками): при следующем обходе файл загрузится снова.
+
+        Отметка могла ещё не поступить - файл отдаётся потребителю до неё, -
+        тогда она будет пропущена при поступлении. Уже записанная отметка
+        (например, о копии файла, анализ оригинала которого не удался)
+        удаляется вместе с отметкой о репозитории.
+        """
+        if file_data.path is None:
+            return
+        key = (file_data.owner, file_data.repo_name, file_data.path)
+        with self._lock, self._connection:
+            self._failed_repos.add(key[:2])
+            found = False
+            for i, entry in enumerate(self._pending):
+                if entry is not None and entry[0] == 'blobs' and entry[1][:3] == key:
+                    # Позиции отметок (см. checkpoint) не должны сдвигаться
+                    self._pending[i] = None
+                    found = True
+            if found:
+                return
+            if self._connection.execute(
+                'DELETE FROM blobs WHERE owner=? AND repo=? AND path=?', key
+            ).rowcount:
+                self._connection.execute(
+                    'DELETE FROM run_repos WHERE owner=? AND repo=?', key[:2]
+                )
+            else:
+                self._skipped_blobs.add(key)
+
+    def checkpoint(self) -> int:
+        """Возвращает позицию для commit(upto): все отмеченные к этому моменту файлы."""
+        with self._lock:
+            return self._committed + len(self._pending)
+
+    def commit(self, upto: int | None = None):
+        """
+        Записывает отложенные отметки об обработанных файлах.
+
+        :param upto: Записать только отметки, сделанные до checkpoint() с этим
+            значением (когда файлы обрабатываются параллельно и результаты
+            более поздних ещё не сохранены).
+        """
+        with self._lock, self._connection:
+            count = len(self._pending)
+            if upto is not None:
+                count = min(max(upto - self._committed, 0), count)
+            pending = self._pending[:count]
+            del self._pending[:count]
+            self._committed += count
+            for entry in pending:
+                if entry is None:
+                    continue
+                table, row = entry
+                if table == 'run_repos' and row[1:] in self._failed_repos:
+                    continue
+                self._connection.execute(
+                    f'INSERT OR REPLACE INTO {table} VALUES ({", ".join("?" * len(row))})',
+                    row,
+                )
+
+    def save_result(self, file_data, result: dict):
+        """Сохраняет результат анализа FileData (для файлов с известным path)."""
+        if file_data.path is None:
+            return
+        self._execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+            (
+                file_data.owner,
+                file_data.repo_name,
+                file_data.path,
+                file_data.file_name,
+                json.dumps(result),
+            ),
+        )
+
+    def get_results(self, owner: str, repo: str) -> list[dict]:
+        rows = self._execute(
+            'SELECT result FROM results WHERE owner=? AND repo=? ORDER BY path, file_name',
+            (owner, repo),
+        )
+        return [json.loads(result) for (result,) in rows]
+
+    def start_run(self, resume: bool = True) -> int:
+        """
+        Начинает запуск обхода.
+
+        :param resume: Продолжить последний незавершённый запуск, если он есть.
+        :return: Идентификатор запуска.
+        """
+        if resume:
+            rows = self._execute(
+                'SELECT run_id FROM runs WHERE finished_at IS NULL '
+                'ORDER BY run_id DESC LIMIT 1'
+            )
+            if rows:
+                logger.info(f'Продолжаем прерванный запуск #{rows[0][0]}')
+                return rows[0][0]
+
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO runs (started_at) VALUES (?)', (time.time(),)
+            )
+            return cursor.lastrowid
+
+    def finish_run(self, run_id: int):
+        self.commit()
+        self._execute(
+            'UPDATE runs SET finished_at=? WHERE run_id=?', (time.time(), run_id)
+        )
+
+    def is_repo_done(self, run_id: int, owner: str, repo: str) -> bool:
+        return bool(
+            self._execute(
+                'SELECT 1 FROM run_repos WHERE run_id=? AND owner=? AND repo=?',
+                (run_id, owner, repo),
+            )
+        )
+
+    def mark_repo_done(self, run_id: int, owner: str, repo: str):
+        """
+        Отмечает репозиторий обработанным в запуске run_id.
+
+        В режиме deferred отметка записывается следующим commit(), после
+        отметок обо всех файлах, отданных до неё. Репозиторий, файл которого
+        передан в skip_blob, не отмечается: продолжение запуска обойдёт его снова.
+        """
+        with self._lock:
+            if self.deferred:
+                self._pending.append(('run_repos', (run_id, owner, repo)))
+                return
+            if (owner, repo) in self._failed_repos:
+                return
+        self._execute(
+            'INSERT OR IGNORE INTO run_repos VALUES (?, ?, ?)', (run_id, owner, repo)
+        )
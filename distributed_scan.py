@@ -0,0 +1,227 @@
+"""
+Распределённая проверка хешей репозиториев из repositories.json.
+
+Координатор раскладывает репозитории по очереди задач (work_queue), воркеры
+независимо берут задачи в аренду и обрабатывают их, а отчёт собирается из
+результатов, сохранённых в очереди.
+
+Воркеры на машине координатора могут работать с файлом очереди напрямую.
+Воркеры других машин подключаются к координатору по HTTP (coordinator
+--serve): адрес координатора передаётся в переменной NIR_WORK_QUEUE. Каждая
+машина хранит свои файлы состояния обхода и результатов; все файлы - базы
+SQLite в режиме WAL, поэтому они должны лежать на локальном диске: на сетевых
+файловых системах (NFS, SMB) блокировки SQLite ненадёжны.
+
+    python distributed_scan.py coordinator [--restart] [--serve [адрес]]
+    python distributed_scan.py worker [id]              # обрабатывать задачи
+    python distributed_scan.py report                   # собрать отчёт
+    python distributed_scan.py local N                  # всё сразу, N процессов
+
+    # на машине координатора
+    python distributed_scan.py coordinator --serve http://0.0.0.0:8765
+    # на остальных машинах
+    NIR_WORK_QUEUE=http://coordinator:8765 python distributed_scan.py worker
+"""
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import metrics
+from crawl_state import CrawlState
+from logging_config import logging
+from main import HASH_SCAN_STATE_FILE, load_repos, scan_repository
+from result_store import RESULT_STORE_FILE, ResultStore
+from search_hash import load_hash_index
+from work_queue import (
+    DEFAULT_ADDRESS,
+    WORK_QUEUE_FILE,
+    LeaseKeeper,
+    RemoteWorkQueue,
+    WorkQueue,
+    default_worker_id,
+    serve,
+)
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILE = 'scan_report.json'
+# Как часто свободный воркер проверяет, не освободились ли задачи умерших воркеров
+POLL_INTERVAL = 5.0
+# Очередь воркера: файл очереди или адрес координатора http://хост:порт
+WORKER_QUEUE = os.environ.get('NIR_WORK_QUEUE', WORK_QUEUE_FILE)
+
+
+def _open_queue(queue: str):
+    if queue.startswith(('http://', 'https://')):
+        return RemoteWorkQueue(queue)
+    return WorkQueue(queue)
+
+
+def run_coordinator(
+    queue_path: str = WORK_QUEUE_FILE,
+    restart: bool = False,
+    address: str | None = None,
+) -> int:
+    """
+    Заполняет очередь репозиториями из repositories.json.
+
+    :param restart: Начать новое сканирование, удалив задачи и результаты
+        предыдущего.
+    :param address: Адрес, на котором координатор обслуживает воркеров
+        других машин до прерывания (None - только заполнить очередь).
+    :return: Число добавленных задач.
+    """
+    repositories = load_repos()
+    queue = WorkQueue(queue_path)
+    added = queue.enqueue(
+        [(repo['owner'], repo['name']) for repo in repositories], restart=restart
+    )
+    logger.info(f'В очередь добавлено репозиториев: {added}, статус: {queue.counts()}')
+    if address is not None:
+        serve(queue, address)
+    return added
+
+
+def run_worker(
+    queue_path: str = WORKER_QUEUE,
+    worker_id: str | None = None,
+    state_path: str = HASH_SCAN_STATE_FILE,
+    wait: bool = True,
+    result_store_path: str = RESULT_STORE_FILE,
+) -> int:
+    """
+    Обрабатывает задачи из очереди, пока они не закончатся.
+
+    :param queue_path: Файл очереди или адрес координатора (http://хост:порт).
+    :param worker_id: Имя воркера (по умолчанию хост и PID).
+    :param state_path: Файл CrawlState для инкрементального обхода.
+    :param wait: Не завершаться, пока другие воркеры выполняют задачи: если
+        воркер умрёт, его задача достанется этому.
+    :param result_store_path: Общее для воркеров хранилище результатов по хешу
+        содержимого (см. result_store).
+    :return: Число выполненных задач.
+    """
+    worker_id = worker_id or default_worker_id()
+    hash_index = load_hash_index('full.csv')
+    if hash_index is None:
+        logger.error('Не удалось открыть базу данных вирусов, воркер завершается')
+        return 0
+
+    queue = _open_queue(queue_path)
+    state = CrawlState(state_path, deferred=True)
+    result_store = ResultStore(result_store_path, analysis='hash')
+    processed = 0
+    while True:
+        task = queue.lease(worker_id)
+        if task is None:
+            if wait and not queue.is_finished():
+                time.sleep(POLL_INTERVAL)
+                continue
+            break
+
+        task_id, owner, repo_name = task
+        logger.info(f'Воркер {worker_id} взял задачу {task_id}: {owner}/{repo_name}')
+        try:
+            with (
+                LeaseKeeper(queue, task_id, worker_id),
+                metrics.profiled(f'scan-{task_id}'),
+            ):
+                scan_repository(owner, repo_name, hash_index, state, result_store)
+                state.commit()
+        except Exception as e:
+            logger.error(f'Ошибка при обработке {owner}/{repo_name}: {e}')
+            queue.fail(task_id, worker_id, str(e))
+            continue
+
+        # Результаты включают файлы, не изменившиеся с прошлого сканирования
+        if queue.complete(task_id, worker_id, state.get_results(owner, repo_name)):
+            processed += 1
+        else:
+            logger.warning(f'Задача {task_id} уже выполнена другим воркером')
+
+    logger.info(f'Воркер {worker_id} завершён, выполнено задач: {processed}')
+    return processed
+
+
+def merge_report(queue_path: str = WORK_QUEUE_FILE, output: str = REPORT_FILE) -> dict:
+    """
+    Собирает результаты всех воркеров в один отчёт.
+
+    :param output: Файл для сохранения отчёта в JSON (None - не сохранять).
+    :return: Отчёт с результатами по репозиториям, проваленными задачами и сводкой.
+    """
+    queue = WorkQueue(queue_path)
+    with metrics.timer('report'):
+        repositories = {
+            f'{owner}/{repo_name}': results
+            for owner, repo_name, results in queue.results()
+        }
+        failed = [
+            {'repository': f'{owner}/{repo_name}', 'error': error}
+            for owner, repo_name, error in queue.failures()
+        ]
+        files = [result for results in repositories.values() for result in results]
+        report = {
+            'summary': {
+                'tasks': queue.counts(),
+                'repositories': len(repositories),
+                'files': len(files),
+                'files_with_matches': sum(1 for result in files if result['found']),
+            },
+            'failed': failed,
+            'repositories': repositories,
+        }
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        logger.info(f'Отчёт сохранён в {output}: {report["summary"]}')
+    return report
+
+
+def _run_local_worker(queue_path: str, worker_id: str):
+    # Эндпоинт Prometheus остаётся за родительским процессом
+    metrics.configure_from_env(http=False)
+    run_worker(queue_path, worker_id)
+
+
+def run_local(workers: int, queue_path: str = WORK_QUEUE_FILE) -> dict:
+    """Запускает новое сканирование с workers локальными процессами."""
+    run_coordinator(queue_path, restart=True)
+    # База хешей строится один раз до запуска воркеров
+    if load_hash_index('full.csv') is None:
+        return {}
+
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=_run_local_worker, args=(queue_path, f'local-{i}'))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return merge_report(queue_path)
+
+
+if __name__ == '__main__':
+    metrics.configure_from_env()
+    command = sys.argv[1] if len(sys.argv) > 1 else 'local'
+    if command == 'coordinator':
+        address = None
+        if '--serve' in sys.argv[2:]:
+            position = sys.argv.index('--serve') + 1
+            address = DEFAULT_ADDRESS
+            if position < len(sys.argv) and not sys.argv[position].startswith('--'):
+                address = sys.argv[position]
+        run_coordinator(restart='--restart' in sys.argv[2:], address=address)
+    elif command == 'worker':
+        run_worker(worker_id=sys.argv[2] if len(sys.argv) > 2 else None)
+    elif command == 'report':
+        merge_report()
+    elif command == 'local':
+        run_local(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    else:
+        print(__doc__)
@@ -0,0 +1,407 @@
+"""
+Реестр бэкендов для получения эмбеддингов кода.
+
+Модель загружается лениво при первом обращении, поэтому сценарии, которым
+эмбеддинги не нужны (поиск по хешам, загрузка репозиториев), не тратят память
+и время на инициализацию torch/transformers.
+
+Выбор бэкенда через переменные окружения:
+    NIR_EMBEDDING_BACKEND - имя зарегистрированного бэкенда (по умолчанию codegen-2b);
+    NIR_EMBEDDING_MODEL_PATH - путь к локальной копии модели вместо имени в HF Hub;
+    NIR_EMBEDDING_PRECISION - fp32, bf16 или int8 (динамическая квантизация на CPU);
+    NIR_EMBEDDING_SERVICE - адрес сервиса эмбеддингов (см. embedding_service):
+        модель не загружается в процессе, forward выполняется в сервисе.
+
+Бэкенды *-onnx при первом обращении экспортируют энкодер (вместе с mean
+pooling) в ONNX с динамическими осями батча и длины, для int8 квантизуют его
+и выполняют через ONNX Runtime на CPU:
+    NIR_ONNX_DIR - каталог экспортированных моделей (по умолчанию onnx_models);
+    NIR_ONNX_THREADS - число потоков внутри оператора (0 - по числу ядер);
+    NIR_ONNX_INTER_THREADS - число параллельно выполняемых операторов.
+Зависимости ставятся через pip install .[onnx]. Совпадение с исходной моделью
+проверяет python embedding_backends.py parity (и тест tests/test_onnx_parity.py
+на маленькой модели).
+"""
+
+import argparse
+import fcntl
+import inspect
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from functools import cached_property
+
+import numpy as np
+
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'codegen-2b'
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+ONNX_DIR = os.environ.get('NIR_ONNX_DIR', 'onnx_models')
+ONNX_PRECISIONS = ('fp32', 'int8')
+ONNX_OPSET = 17
+# Допустимое отклонение (1 - косинусное сходство) от эмбеддингов исходной модели
+PARITY_TOLERANCE = {'fp32': 1e-4, 'int8': 2e-2}
+PARITY_SAMPLES = (
+    'def add(a, b):\n    return a + b\n',
+    'import os\n\nfor name in os.listdir("."):\n    print(name)\n',
+    'class Client:\n    def __init__(self, url):\n        self.url = url\n\n'
+    '    def get(self, path):\n        return requests.get(self.url + path)\n',
+    'x = 1',
+)
+
+
+def mean_pool(last_hidden_state, attention_mask):
+    """Усреднение скрытых состояний только по реальным (не padding) токенам."""
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+    summed = (last_hidden_state * mask).sum(dim=1)
+    counts = mask.sum(dim=1).clamp(min=1)
+    return summed / counts
+
+
+class TransformerBackend:
+    """Энкодер на базе transformers.AutoModel с mean pooling по attention mask."""
+
+    def __init__(
+        self,
+        model_path: str,
+        max_length: int,
+        precision: str = 'fp32',
+        pad_with_eos: bool = False,
+    ):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Неизвестная точность вычислений: {precision}')
+        self.model_path = model_path
+        self.max_length = max_length
+        self.precision = precision
+        self.pad_with_eos = pad_with_eos
+
+    @property
+    def name(self) -> str:
+        """Идентификатор модели, используемый в ключах кэша эмбеддингов."""
+        return f'{self.model_path}:{self.precision}'
+
+    @cached_property
+    def tokenizer(self):
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        if self.pad_with_eos or tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        return tokenizer
+
+    @cached_property
+    def model(self):
+        import torch
+        from transformers import AutoModel
+
+        logger.info(f'Загрузка модели {self.model_path} ({self.precision})...')
+        model = AutoModel.from_pretrained(self.model_path)
+        model.eval()
+
+        if self.precision == 'bf16':
+            model = model.to(torch.bfloat16)
+        elif self.precision == 'int8':
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    def tokenize(self, texts: list[str], max_length: int) -> list[list[int]]:
+        return self.tokenizer(
+            list(texts), truncation=True, max_length=min(max_length, self.max_length)
+        )['input_ids']
+
+    def forward(self, input_ids: list[list[int]]) -> np.ndarray:
+        """Прогоняет через модель один батч токенов, дополняя его до общей длины."""
+        import torch
+
+        inputs = self.tokenizer.pad({'input_ids': input_ids}, return_tensors='pt')
+
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+
+        embeddings = mean_pool(outputs.last_hidden_state, inputs['attention_mask'])
+        return embeddings.float().cpu().numpy()
+
+
+class OnnxBackend(TransformerBackend):
+    """
+    Тот же энкодер, экспортированный в ONNX и выполняемый через ONNX Runtime.
+
+    Экспорт (и квантизация для int8) выполняется один раз и сохраняется в
+    ONNX_DIR; процессы, одновременно загружающие модель, ждут друг друга на
+    файловой блокировке.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        max_length: int,
+        precision: str = 'fp32',
+        pad_with_eos: bool = False,
+        export_dir: str = ONNX_DIR,
+    ):
+        if precision not in ONNX_PRECISIONS:
+            raise ValueError(f'Точность {precision} не поддерживается для ONNX')
+        super().__init__(model_path, max_length, precision, pad_with_eos)
+        self.export_dir = os.path.join(
+            export_dir, re.sub(r'[^\w.-]+', '--', model_path.strip('/'))
+        )
+
+    @property
+    def name(self) -> str:
+        return f'{self.model_path}:onnx-{self.precision}'
+
+    @property
+    def model(self):
+        raise AttributeError('ONNX-бэкенд не загружает модель PyTorch')
+
+    def _export(self, path: str):
+        import torch
+        from transformers import AutoModel
+
+        logger.info(f'Экспорт модели {self.model_path} в ONNX...')
+        model = AutoModel.from_pretrained(self.model_path)
+        model.eval()
+        # Кэш ключей и значений для эмбеддингов не нужен
+        model.config.use_cache = False
+
+        class Encoder(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, input_ids, attention_mask):
+                outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
+                return mean_pool(outputs.last_hidden_state, attention_mask)
+
+        inputs = self.tokenizer.pad(
+            {'input_ids': self.tokenize(PARITY_SAMPLES[:2], self.max_length)},
+            return_tensors='pt',
+        )
+        axes = {0: 'batch', 1: 'sequence'}
+        # Новые версии torch по умолчанию используют экспорт через dynamo
+        # (нужен onnxscript); графы проверены с экспортом через TorchScript
+        options = (
+            {'dynamo': False}
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters
+            else {}
+        )
+        with torch.no_grad():
+            # Модели больше 2 ГБ сохраняются с весами в отдельных файлах рядом
+            torch.onnx.export(
+                Encoder(model),
+                (inputs['input_ids'], inputs['attention_mask']),
+                path,
+                input_names=['input_ids', 'attention_mask'],
+                output_names=['embeddings'],
+                dynamic_axes={
+                    'input_ids': axes,
+                    'attention_mask': axes,
+                    'embeddings': {0: 'batch'},
+                },
+                opset_version=ONNX_OPSET,
+                do_constant_folding=True,
+                **options,
+            )
+
+    def _quantize(self, source: str, path: str):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        logger.info(f'Квантизация модели {self.model_path} в int8...')
+        quantize_dynamic(
+            source,
+            path,
+            weight_type=QuantType.QInt8,
+            use_external_data_format=True,
+        )
+
+    @cached_property
+    def model_file(self) -> str:
+        """Путь к ONNX-модели нужной точности (экспортируется при отсутствии)."""
+        fp32_path = os.path.join(self.export_dir, 'fp32', 'model.onnx')
+        path = os.path.join(self.export_dir, self.precision, 'model.onnx')
+        os.makedirs(self.export_dir, exist_ok=True)
+        with open(os.path.join(self.export_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(fp32_path):
+                self._build(fp32_path, self._export)
+            if not os.path.exists(path):
+                self._build(path, lambda target: self._quantize(fp32_path, target))
+        return path
+
+    @staticmethod
+    def _build(path: str, build):
+        # Каталог модели появляется целиком: прерванный экспорт не оставит
+        # файла, который примут за готовую модель
+        directory = os.path.dirname(path)
+        temporary = tempfile.mkdtemp(dir=os.path.dirname(directory))
+        try:
+            build(os.path.join(temporary, os.path.basename(path)))
+            os.replace(temporary, directory)
+        finally:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    @cached_property
+    def session(self):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.intra_op_num_threads = int(os.environ.get('NIR_ONNX_THREADS', '0'))
+        inter_op_threads = int(os.environ.get('NIR_ONNX_INTER_THREADS', '1'))
+        if inter_op_threads > 1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+            options.inter_op_num_threads = inter_op_threads
+        logger.info(f'Загрузка ONNX-модели {self.model_file}...')
+        return onnxruntime.InferenceSession(
+            self.model_file, options, providers=['CPUExecutionProvider']
+        )
+
+    def forward(self, input_ids: list[list[int]]) -> np.ndarray:
+        inputs = self.tokenizer.pad({'input_ids': input_ids}, return_tensors='np')
+        (embeddings,) = self.session.run(
+            ['embeddings'],
+            {
+                'input_ids': inputs['input_ids'].astype(np.int64),
+                'attention_mask': inputs['attention_mask'].astype(np.int64),
+            },
+        )
+        return embeddings.astype(np.float32, copy=False)
+
+
+def check_parity(reference, candidate, texts=PARITY_SAMPLES) -> float:
+    """
+    Сравнивает эмбеддинги двух бэкендов с одним токенизатором.
+
+    Тексты подаются одним батчем, поэтому проверяется и обработка padding.
+
+    :return: Наибольшее по текстам отклонение 1 - косинусное сходство.
+    """
+    input_ids = reference.tokenize(texts, reference.max_length)
+    expected = reference.forward(input_ids)
+    actual = candidate.forward(input_ids)
+    similarity = np.sum(expected * actual, axis=1) / np.maximum(
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1), 1e-12
+    )
+    return float(np.max(1.0 - similarity))
+
+
+_factories = {}
+_instances = {}
+_lock = threading.Lock()
+
+
+def register_backend(name: str, factory):
+    """
+    Регистрирует бэкенд.
+
+    :param name: Имя бэкенда.
+    :param factory: Вызываемый объект factory(model_path, precision), возвращающий
+        бэкенд; model_path равен None, если путь не переопределён.
+    """
+    _factories[name] = factory
+
+
+def available_backends() -> list[str]:
+    return sorted(_factories)
+
+
+def get_backend(
+    name: str | None = None, precision: str | None = None, remote: bool = True
+):
+    """
+    Возвращает экземпляр бэкенда, создавая его при первом обращении.
+
+    Сама модель загружается ещё позже - при первом вызове tokenize/forward.
+
+    :param remote: Если задан NIR_EMBEDDING_SERVICE, вернуть клиент сервиса
+        эмбеддингов с этим бэкендом (False - для самого сервиса).
+    """
+    name = name or os.environ.get('NIR_EMBEDDING_BACKEND', DEFAULT_BACKEND)
+    precision = precision or os.environ.get('NIR_EMBEDDING_PRECISION', 'fp32')
+    if name not in _factories:
+        raise ValueError(
+            f'Неизвестный бэкенд эмбеддингов: {name}. '
+            f'Доступные: {", ".join(available_backends())}'
+        )
+
+    service = os.environ.get('NIR_EMBEDDING_SERVICE') if remote else None
+    with _lock:
+        key = (name, precision)
+        if key not in _instances:
+            model_path = os.environ.get('NIR_EMBEDDING_MODEL_PATH')
+            _instances[key] = _factories[name](model_path, precision)
+        if not service:
+            return _instances[key]
+
+        remote_key = (name, precision, service)
+        if remote_key not in _instances:
+            from embedding_service import ServiceBackend
+
+            _instances[remote_key] = ServiceBackend(_instances[key], service)
+        return _instances[remote_key]
+
+
+register_backend(
+    'codegen-2b',
+    lambda model_path, precision: TransformerBackend(
+        model_path or 'Salesforce/codegen-2B-mono',
+        max_length=2048,
+        precision=precision,
+        pad_with_eos=True,
+    ),
+)
+register_backend(
+    'codebert',
+    lambda model_path, precision: TransformerBackend(
+        model_path or 'microsoft/codebert-base',
+        max_length=512,
+        precision=precision,
+    ),
+)
+register_backend(
+    'codegen-2b-onnx',
+    lambda model_path, precision: OnnxBackend(
+        model_path or 'Salesforce/codegen-2B-mono',
+        max_length=2048,
+        precision=precision,
+        pad_with_eos=True,
+    ),
+)
+register_backend(
+    'codebert-onnx',
+    lambda model_path, precision: OnnxBackend(
+        model_path or 'microsoft/codebert-base',
+        max_length=512,
+        precision=precision,
+    ),
+)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Проверка совпадения эмбеддингов ONNX-бэкенда с исходной моделью'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parity = subparsers.add_parser('parity')
+    parity.add_argument('backend', nargs='?', default=f'{DEFAULT_BACKEND}-onnx')
+    parity.add_argument('--precision', choices=ONNX_PRECISIONS, default='fp32')
+    parity.add_argument('--tolerance', type=float)
+    args = parser.parse_args()
+
+    candidate = get_backend(args.backend, args.precision, remote=False)
+    reference = get_backend(args.backend.removesuffix('-onnx'), 'fp32', remote=False)
+    tolerance = args.tolerance or PARITY_TOLERANCE[args.precision]
+    deviation = check_parity(reference, candidate)
+    print(f'{candidate.name}: отклонение {deviation:.2e}, допустимо {tolerance:.0e}')
+    sys.exit(0 if deviation <= tolerance else 1)
@@ -0,0 +1,337 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get('NIR_EMBEDDING_CACHE_DIR', 'embedding_cache')
+CACHE_ENABLED = os.environ.get('NIR_EMBEDDING_CACHE', '1') != '0'
+DEFAULT_MAX_ENTRIES = 200_000
+DEFAULT_MAX_BYTES = 2 * 1024**3  # 2GB
+MAX_PENDING = 4096  # записей в памяти до принудительного flush
+
+FORMAT_VERSION = 2
+KEY_SIZE = 32
+
+
+def make_key(
+    model_name: str, max_length: int, preprocessing_version: int, chunk: str
+) -> bytes:
+    """
+    Возвращает ключ кэша для чанка.
+
+    :param model_name: Имя модели, которой получен эмбеддинг.
+    :param max_length: Максимальная длина чанка в токенах.
+    :param preprocessing_version: Версия разбиения/предобработки кода.
+    :param chunk: Текст чанка.
+    :return: 32-байтовый SHA-256 дайджест.
+    """
+    chunk_hash = hashlib.sha256(chunk.encode('utf-8', errors='surrogatepass'))
+    hasher = hashlib.sha256()
+    hasher.update(f'{model_name}\0{max_length}\0{preprocessing_version}\0'.encode())
+    hasher.update(chunk_hash.digest())
+    return hasher.digest()
+
+
+class EmbeddingCache:
+    """
+    Дисковый кэш эмбеддингов с адресацией по содержимому.
+
+    Все векторы каталога одной размерности, поэтому у каждой модели свой
+    каталог (см. get_default_cache). Векторы хранятся в memory-mapped файле float32 фиксированной ёмкости,
+    индекс (ключ -> номер слота в порядке LRU) - в отдельном .npz файле.
+    При переполнении вытесняются давно не использованные записи.
+
+    Каталог могут одновременно использовать несколько процессов: новые
+    векторы копятся в памяти процесса и записываются в flush под блокировкой
+    каталога, после перечитывания индекса, изменённого другими процессами.
+    Рядом с каждым вектором хранится его ключ, поэтому слот, вытесненный
+    другим процессом, при чтении по устаревшему индексу даёт промах, а не
+    чужой вектор.
+    """
+
+    def __init__(
+        self,
+        directory: str = CACHE_DIR,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.dim = None
+        self.capacity = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()  # ключ -> слот, последние использованные в конце
+        self._pending = OrderedDict()  # ключ -> вектор, ещё не записанный на диск
+        self._touched = OrderedDict()  # ключи, прочитанные после последнего flush
+        self._vectors = None
+        self._keys = None
+        self._index_stat = None
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        with self._file_lock(fcntl.LOCK_SH):
+            self._load()
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.directory, 'meta.json')
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, 'index.npz')
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, 'vectors.f32')
+
+    @property
+    def _keys_path(self) -> str:
+        return os.path.join(self.directory, 'keys.u8')
+
+    @contextmanager
+    def _file_lock(self, operation: int):
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, operation)
+            yield
+
+    def _stat_index(self):
+        try:
+            stat = os.stat(self._index_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        """Перечитывает индекс с диска. Вызывается под блокировкой каталога."""
+        self._index_stat = self._stat_index()
+        self._entries = OrderedDict()
+        if not os.path.exists(self._meta_path):
+            return
+        try:
+            with open(self._meta_path) as file:
+                meta = json.load(file)
+            if meta.get('format_version') != FORMAT_VERSION:
+                logger.warning('Формат кэша эмбеддингов устарел, кэш будет пересоздан')
+                self._close_vectors()
+                return
+            if (meta['dim'], meta['capacity']) != (self.dim, self.capacity):
+                self._open_vectors(meta['dim'], meta['capacity'])
+            if self._index_stat is None:
+                return
+            with np.load(self._index_path) as index:
+                keys = index['keys']
+                slots = index['slots']
+        except Exception as e:
+            logger.error(f'Ошибка при загрузке кэша эмбеддингов: {e}')
+            self._close_vectors()
+            return
+
+        for key, slot in zip(keys, slots):
+            self._entries[key.tobytes()] = int(slot)
+        logger.info(f'Загружен кэш эмбеддингов: {len(self._entries)} записей')
+
+    def _open_vectors(self, dim: int, capacity: int):
+        mode = 'r+' if os.path.exists(self._vectors_path) else 'w+'
+        self._vectors = np.memmap(
+            self._vectors_path, dtype=np.float32, mode=mode, shape=(capacity, dim)
+        )
+        mode = 'r+' if os.path.exists(self._keys_path) else 'w+'
+        self._keys = np.memmap(
+            self._keys_path, dtype=np.uint8, mode=mode, shape=(capacity, KEY_SIZE)
+        )
+        self.dim = dim
+        self.capacity = capacity
+
+    def _close_vectors(self):
+        self._vectors = None
+        self._keys = None
+        self.dim = None
+        self.capacity = 0
+        self._entries = OrderedDict()
+
+    def _init_storage(self, dim: int):
+        capacity = max(1, min(self.max_entries, self.max_bytes // (dim * 4)))
+        for path in (self._vectors_path, self._keys_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._open_vectors(dim, capacity)
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._pending)
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self._pending or key in self._entries
+
+    def get(self, key: bytes) -> np.ndarray | None:
+        with self._lock:
+            vector = self._pending.get(key)
+            if vector is not None:
+                self.hits += 1
+                return vector.copy()
+            slot = self._entries.get(key)
+            if slot is not None:
+                vector = np.array(self._vectors[slot])
+                # Ключ проверяется после чтения: put обнуляет его перед записью
+                # вектора, так что перезаписанный слот не пройдёт проверку
+                if self._keys[slot].tobytes() == key:
+                    self._entries.move_to_end(key)
+                    self._touched[key] = None
+                    self.hits += 1
+                    return vector
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, np.ndarray]:
+        """Возвращает найденные в кэше векторы, ключи без записей пропускаются."""
+        found = {}
+        for key in keys:
+            vector = self.get(key)
+            if vector is not None:
+                found[key] = vector
+        return found
+
+    def put(self, key: bytes, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        with self._lock:
+            dim = self.dim
+            if dim is None and self._pending:
+                dim = next(iter(self._pending.values())).shape[0]
+            if dim is not None and vector.shape[0] != dim:
+                logger.warning(
+                    f'Размерность эмбеддинга {vector.shape[0]} не совпадает с кэшем ({dim})'
+                )
+                return
+            self._pending[key] = vector
+            self._pending.move_to_end(key)
+            full = len(self._pending) >= MAX_PENDING
+        if full:
+            self.flush()
+
+    def put_many(self, items: dict[bytes, np.ndarray]):
+        for key, vector in items.items():
+            self.put(key, vector)
+
+    def flush(self):
+        """
+        Записывает накопленные векторы и индекс на диск.
+
+        Под блокировкой каталога индекс перечитывается, если его изменил
+        другой процесс, и новые записи получают слоты уже по нему.
+        """
+        with self._lock:
+            if not self._pending and not self._touched:
+                return
+            with self._file_lock(fcntl.LOCK_EX):
+                if self._stat_index() != self._index_stat or self._vectors is None:
+                    self._load()
+                if self._vectors is None:
+                    if not self._pending:
+                        self._touched.clear()
+                        return
+                    self._init_storage(next(iter(self._pending.values())).shape[0])
+                if any(v.shape[0] != self.dim for v in self._pending.values()):
+                    logger.warning(
+                        f'Размерность эмбеддингов не совпадает с кэшем ({self.dim}), '
+                        'несовместимые записи отброшены'
+                    )
+
+                for key in self._touched:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                used = set(self._entries.values())
+                free_slots = [
+                    s for s in range(self.capacity - 1, -1, -1) if s not in used
+                ]
+                for key, vector in self._pending.items():
+                    if vector.shape[0] != self.dim:
+                        continue
+                    slot = self._entries.get(key)
+                    if slot is None:
+                        if free_slots:
+                            slot = free_slots.pop()
+                        else:
+                            _, slot = self._entries.popitem(last=False)
+                            self.evictions += 1
+                    self._keys[slot] = 0
+                    self._vectors[slot] = vector
+                    self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                    self._entries[key] = slot
+                    self._entries.move_to_end(key)
+                self._vectors.flush()
+                self._keys.flush()
+                self._write_index()
+            self._pending.clear()
+            self._touched.clear()
+
+    def _write_index(self):
+        keys = np.frombuffer(b''.join(self._entries.keys()), dtype=np.uint8)
+        tmp_index = self._index_path + '.tmp.npz'
+        np.savez(
+            tmp_index,
+            keys=keys.reshape(-1, KEY_SIZE),
+            slots=np.fromiter(self._entries.values(), dtype=np.int64),
+        )
+        os.replace(tmp_index, self._index_path)
+
+        tmp_meta = self._meta_path + '.tmp'
+        with open(tmp_meta, 'w') as file:
+            json.dump(
+                {
+                    'format_version': FORMAT_VERSION,
+                    'dim': self.dim,
+                    'capacity': self.capacity,
+                },
+                file,
+            )
+        os.replace(tmp_meta, self._meta_path)
+        self._index_stat = self._stat_index()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+_default_caches = {}
+
+
+def cache_directory(model_name: str) -> str:
+    """Каталог кэша модели: CACHE_DIR/<имя модели, пригодное для пути>."""
+    return os.path.join(CACHE_DIR, re.sub(r'[^\w.-]+', '_', model_name).strip('_.'))
+
+
+def get_default_cache(model_name: str) -> EmbeddingCache | None:
+    """
+    Возвращает общий для процесса кэш модели или None, если кэш отключён.
+
+    :param model_name: Имя модели (backend.name): у моделей разная размерность
+        эмбеддингов, и каждая хранит их в своём каталоге.
+    """
+    if not CACHE_ENABLED:
+        return None
+    directory = cache_directory(model_name)
+    if directory not in _default_caches:
+        _default_caches[directory] = EmbeddingCache(directory)
+    return _default_caches[directory]
@@ -0,0 +1,427 @@
+"""
+Локальный сервис эмбеддингов.
+
+Сервис один раз загружает модель и обслуживает все сканеры на машине: запросы
+клиентов (батчи токенов) собираются в общую очередь, и поток батчинга
+забирает их, дождавшись max_delay после первого запроса или набрав
+max_batch_size последовательностей. Собранные последовательности заново
+группируются в батчи по длине, поэтому короткие чанки разных клиентов
+попадают в один forward pass. Если в очереди больше max_queue
+последовательностей, новые запросы получают 503 и клиент повторяет их с
+задержкой.
+
+    python embedding_service.py [--address unix:/path | http://127.0.0.1:PORT]
+
+Клиенты подключаются, если задана переменная NIR_EMBEDDING_SERVICE с адресом
+сервиса: get_backend() возвращает ServiceBackend, который токенизирует код
+локально, а forward выполняет в сервисе. Если сервис недоступен, модель
+загружается в процессе клиента.
+"""
+
+import argparse
+import http.client
+import http.server
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections import deque
+from functools import cached_property
+
+import numpy as np
+
+import metrics
+from cluster_analysis import DEFAULT_MAX_BATCH_TOKENS, _make_batches
+from embedding_backends import get_backend
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = 'unix:/tmp/nir-embeddings.sock'
+# Сколько ждать других клиентов после первого запроса в очереди
+DEFAULT_MAX_DELAY = float(os.environ.get('NIR_SERVICE_MAX_DELAY', '0.01'))
+DEFAULT_MAX_BATCH_SIZE = int(os.environ.get('NIR_SERVICE_BATCH_SIZE', '32'))
+DEFAULT_MAX_QUEUE = int(os.environ.get('NIR_SERVICE_MAX_QUEUE', '1024'))
+REQUEST_TIMEOUT = 600
+# Повторы запроса, отклонённого из-за переполненной очереди
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 2.0
+# Очередь подключений: при маленькой клиенты unix-сокета получают EAGAIN
+LISTEN_BACKLOG = 128
+
+
+class ServiceBusyError(Exception):
+    """Очередь сервиса переполнена, запрос нужно повторить позже."""
+
+
+class _Request:
+    def __init__(self, input_ids: list[list[int]]):
+        self.input_ids = input_ids
+        self.rows = [None] * len(input_ids)
+        self.error = None
+        self.done = threading.Event()
+
+
+class DynamicBatcher:
+    """Очередь запросов и поток, выполняющий их общими батчами."""
+
+    def __init__(
+        self,
+        backend,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+    ):
+        """
+        :param max_delay: Сколько секунд ждать других запросов после первого.
+        :param max_batch_size: Максимальное число последовательностей в батче.
+        :param max_batch_tokens: Максимальный объём батча в токенах с учётом padding.
+        :param max_queue: Сколько последовательностей может ждать и выполняться
+            одновременно; больше - запрос отклоняется с ServiceBusyError.
+        """
+        self.backend = backend
+        self.max_delay = max_delay
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max(max_batch_tokens, backend.max_length)
+        self.max_queue = max_queue
+        self._queue = deque()
+        self._waiting = 0  # последовательности в очереди (ещё не в батче)
+        self._in_flight = 0  # последовательности в очереди и в работе
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        metrics.register_collector(self._metrics)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _metrics(self):
+        yield 'nir_service_queue_sequences', self._in_flight, {}
+
+    def submit(self, input_ids: list[list[int]]) -> np.ndarray:
+        """
+        Ставит запрос в очередь и ждёт результата.
+
+        :return: Матрица эмбеддингов (строка на последовательность).
+        :raises ServiceBusyError: Очередь переполнена.
+        """
+        if not input_ids:
+            return np.empty((0, 0), dtype=np.float32)
+        max_length = self.backend.max_length
+        request = _Request([ids[:max_length] for ids in input_ids])
+        with self._condition:
+            # Запрос больше всей очереди принимается, только когда она пуста
+            if self._in_flight and self._in_flight + len(input_ids) > self.max_queue:
+                metrics.inc('nir_service_rejected_total')
+                raise ServiceBusyError('очередь сервиса переполнена')
+            self._queue.append(request)
+            self._waiting += len(input_ids)
+            self._in_flight += len(input_ids)
+            self._condition.notify()
+        request.done.wait()
+        with self._condition:
+            self._in_flight -= len(input_ids)
+        if request.error is not None:
+            raise request.error
+        return np.vstack(request.rows)
+
+    def _collect(self) -> list[_Request]:
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            deadline = time.monotonic() + self.max_delay
+            while self._waiting < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            requests = list(self._queue)
+            self._queue.clear()
+            self._waiting = 0
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            try:
+                self._process(requests)
+            except Exception as e:
+                for request in requests:
+                    request.error = request.error or e
+            for request in requests:
+                request.done.set()
+
+    def _process(self, requests: list[_Request]):
+        sequences = [
+            (request, row, ids)
+            for request in requests
+            for row, ids in enumerate(request.input_ids)
+        ]
+        lengths = [max(len(ids), 1) for _, _, ids in sequences]
+        for batch in _make_batches(lengths, self.max_batch_size, self.max_batch_tokens):
+            metrics.observe('nir_batch_chunks', len(batch), metrics.SIZE_BUCKETS)
+            metrics.observe(
+                'nir_batch_tokens',
+                len(batch) * lengths[batch[0]],
+                metrics.TOKEN_BUCKETS,
+            )
+            try:
+                with metrics.timer('forward'):
+                    embeddings = self.backend.forward([sequences[i][2] for i in batch])
+            except Exception as e:
+                logger.warning(
+                    f'Ошибка при обработке батча из {len(batch)} чанков: {e}'
+                )
+                for i in batch:
+                    sequences[i][0].error = RuntimeError(str(e))
+                continue
+            for i, embedding in zip(batch, embeddings):
+                request, row, _ = sequences[i]
+                request.rows[row] = embedding
+
+
+def _make_handler(batcher: DynamicBatcher, tcp: bool):
+    info = json.dumps(
+        {
+            'backend': batcher.backend.name,
+            'max_length': batcher.backend.max_length,
+        }
+    ).encode()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Заголовки и тело уходят одним пакетом (см. задержку подтверждений TCP)
+        wbufsize = -1
+        disable_nagle_algorithm = tcp
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, body: bytes, content_type: str, headers=()):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/info':
+                self._reply(200, info, 'application/json')
+            elif self.path == '/metrics':
+                body = metrics.render_prometheus().encode('utf-8')
+                self._reply(200, body, 'text/plain; version=0.0.4; charset=utf-8')
+            else:
+                self._reply(404, b'', 'text/plain')
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path != '/embed':
+                self._reply(404, b'', 'text/plain')
+                return
+            try:
+                input_ids = json.loads(body)['input_ids']
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, str(e).encode(), 'text/plain; charset=utf-8')
+                return
+            try:
+                embeddings = batcher.submit(input_ids)
+            except ServiceBusyError as e:
+                self._reply(
+                    503,
+                    str(e).encode(),
+                    'text/plain; charset=utf-8',
+                    [('Retry-After', '1')],
+                )
+                return
+            except Exception as e:
+                self._reply(500, str(e).encode(), 'text/plain; charset=utf-8')
+                return
+            output = io.BytesIO()
+            np.save(output, embeddings.astype(np.float32, copy=False))
+            self._reply(200, output.getvalue(), 'application/x-npy')
+
+    return Handler
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def server_bind(self):
+        # Сокет, оставшийся от прошлого запуска, мешает bind
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+class _TCPHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+def serve(
+    address: str = DEFAULT_ADDRESS,
+    backend=None,
+    **batcher_options,
+):
+    """
+    Запускает сервис и обслуживает запросы до прерывания.
+
+    :param address: 'unix:/путь/к/сокету' или 'http://127.0.0.1:порт'.
+    :param backend: Бэкенд эмбеддингов (по умолчанию get_backend(remote=False)).
+    :param batcher_options: Параметры DynamicBatcher.
+    """
+    backend = backend or get_backend(remote=False)
+    # Модель загружается до приёма запросов
+    backend.forward(backend.tokenize(['pass'], backend.max_length))
+    batcher = DynamicBatcher(backend, **batcher_options).start()
+
+    if address.startswith('unix:'):
+        server = _UnixHTTPServer(address[5:], _make_handler(batcher, tcp=False))
+    else:
+        parsed = urllib.parse.urlsplit(address)
+        server = _TCPHTTPServer(
+            (parsed.hostname, parsed.port), _make_handler(batcher, tcp=True)
+        )
+    logger.info(f'Сервис эмбеддингов ({backend.name}) слушает {address}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if address.startswith('unix:') and os.path.exists(address[5:]):
+            os.unlink(address[5:])
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _connect(address: str, timeout: float) -> http.client.HTTPConnection:
+    if address.startswith('unix:'):
+        return _UnixHTTPConnection(address[5:], timeout)
+    parsed = urllib.parse.urlsplit(address)
+    return http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+
+
+class ServiceBackend:
+    """
+    Клиент сервиса эмбеддингов с интерфейсом бэкенда.
+
+    Токенизатор (и имя модели для кэша) берутся у локального бэкенда, сама
+    модель загружается локально, только если сервис недоступен.
+    """
+
+    def __init__(self, backend, address: str, timeout: float = REQUEST_TIMEOUT):
+        self.backend = backend
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def name(self) -> str:
+        return self.backend.name
+
+    @property
+    def max_length(self) -> int:
+        return self.backend.max_length
+
+    @property
+    def tokenizer(self):
+        return self.backend.tokenizer
+
+    def tokenize(self, texts: list[str], max_length: int) -> list[list[int]]:
+        return self.backend.tokenize(texts, max_length)
+
+    def _request(self, method: str, path: str, body: bytes | None = None):
+        # Соединение на поток переиспользуется между запросами (keep-alive)
+        connection = getattr(self._local, 'connection', None)
+        for attempt in range(2):
+            if connection is None:
+                connection = self._local.connection = _connect(
+                    self.address, self.timeout
+                )
+            try:
+                connection.request(method, path, body=body)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                # Сервис перезапущен или закрыл соединение - пробуем новое
+                connection.close()
+                connection = self._local.connection = None
+                if attempt:
+                    raise
+
+    @cached_property
+    def service_available(self) -> bool:
+        try:
+            status, body = self._request('GET', '/info')
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning(
+                f'Сервис эмбеддингов {self.address} недоступен ({e}), '
+                'модель будет загружена в этом процессе'
+            )
+            return False
+        info = json.loads(body) if status == 200 else {}
+        if info.get('backend') != self.backend.name:
+            raise ValueError(
+                f'Сервис эмбеддингов {self.address} использует модель '
+                f'{info.get("backend")}, а не {self.backend.name}'
+            )
+        return True
+
+    def forward(self, input_ids: list[list[int]]) -> np.ndarray:
+        """Выполняет батч в сервисе (или локально, если сервис недоступен)."""
+        if not self.service_available:
+            return self.backend.forward(input_ids)
+
+        body = json.dumps({'input_ids': input_ids}, separators=(',', ':')).encode()
+        delay = RETRY_DELAY
+        deadline = time.monotonic() + self.timeout
+        while True:
+            status, response = self._request('POST', '/embed', body)
+            if status == 200:
+                return np.load(io.BytesIO(response))
+            if status != 503 or time.monotonic() > deadline:
+                raise RuntimeError(
+                    f'Сервис эмбеддингов вернул {status}: '
+                    f'{response.decode("utf-8", errors="replace")}'
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальный сервис эмбеддингов')
+    parser.add_argument(
+        '--address',
+        default=os.environ.get('NIR_EMBEDDING_SERVICE', DEFAULT_ADDRESS),
+        help='unix:/путь/к/сокету или http://127.0.0.1:порт',
+    )
+    parser.add_argument('--backend', help='Имя бэкенда (по умолчанию из окружения)')
+    parser.add_argument('--precision')
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE)
+    args = parser.parse_args()
+
+    serve(
+        args.address,
+        get_backend(args.backend, args.precision, remote=False),
+        max_delay=args.max_delay,
+        max_batch_size=args.batch_size,
+        max_queue=args.max_queue,
+    )
@@ -1,20 +1,83 @@
+import asyncio
+import aiohttp
+import json
 import requests
 from collections import namedtuple
 import zipfile
 import tarfile
 import py7zr
-import io
 import os
+import queue
+import shutil
+import tempfile
+import threading
 import logging
 
 from collections import defaultdict
 
-from source import TOKEN
+import metrics
+from archive_extraction import (
+    DEFAULT_LIMITS,
+    SNIFF_SIZE,
+    ArchiveLimitError,
+    archive_format,
+    iter_archive,
+)
+from github_client import RateLimitedError, get_scheduler
 
 logger = logging.getLogger(__name__)
 
 
-FileData = namedtuple('FileData', ['owner', 'repo_name', 'file_name', 'file_content'])
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+DEFAULT_FETCH_MODE = os.environ.get('NIR_FETCH_MODE', 'async')
+DEFAULT_CONCURRENCY = 16
+REQUEST_TIMEOUT = 60
+# Zipball до этого размера держится в памяти, больше - сбрасывается на диск
+ARCHIVE_SPOOL_SIZE = 64 * 1024 * 1024
+# Архив всего репозитория - не архив из репозитория: его объём не ограничен, а
+# вложенные в него архивы распаковываются на ту же глубину, что и при обходе
+# по файлам
+REPOSITORY_ARCHIVE_LIMITS = DEFAULT_LIMITS._replace(
+    max_depth=DEFAULT_LIMITS.max_depth + 1,
+    max_total_size=None,
+    max_members=None,
+    max_ratio=None,
+)
+# Сколько готовых FileData может ждать потребителя, пока загрузка приостановлена
+STREAM_QUEUE_SIZE = 64
+
+
+class FetchError(Exception):
+    """
+    Листинг каталога или архив репозитория не получен и после повторов: обход
+    репозитория не завершён, и он не должен считаться обработанным.
+    """
+
+
+def _listing_failed(owner: str, repo_name: str, directory_path, status: int):
+    """
+    Обрабатывает неудачный ответ на запрос листинга каталога.
+
+    :raises FetchError: Для любого ответа, кроме 404 (каталога нет - повторный
+        обход ничего не изменит).
+    """
+    message = (
+        f'Ошибка при получении содержимого репозитория {owner}/{repo_name} '
+        f'(каталог "{directory_path}"): {status}'
+    )
+    if status != 404:
+        raise FetchError(message)
+    logger.error(message)
+
+
+# path и sha - путь и git blob SHA файла репозитория, из которого получены данные
+# (для файлов из архива - путь и SHA самого архива), если они известны;
+# raw_content - исходные байты файла до декодирования (для хешей)
+FileData = namedtuple(
+    'FileData',
+    ['owner', 'repo_name', 'file_name', 'file_content', 'path', 'sha', 'raw_content'],
+    defaults=(None, None, None),
+)
 
 
 def get_extension(filename: str) -> str:
@@ -33,155 +96,594 @@ def count_extensions(results: list[FileData]) -> dict[str, int]:
     return dict(counts)
 
 
-def get_directory_contents(owner: str, repo_name: str, directory_path='', results=None):
+def get_directory_contents(
+    owner: str, repo_name: str, directory_path='', results=None, mode=None, state=None
+):
+    """
+    Загружает все файлы каталога репозитория (рекурсивно).
+
+    :param mode: Способ загрузки: 'async' - параллельно через aiohttp,
+        'serial' - последовательно через requests, 'archive' - одним
+        tarball-архивом репозитория. По умолчанию NIR_FETCH_MODE.
+    :param state: CrawlState для инкрементального обхода: листинги каталогов
+        запрашиваются с If-None-Match, а файлы, blob SHA которых не изменился
+        с прошлой обработки, пропускаются.
+    :return: Список FileData.
+    """
     if results is None:
         results = []
 
-    headers = {'Authorization': f'Bearer {TOKEN}'}
+    results.extend(
+        iter_directory_contents(owner, repo_name, directory_path, mode, state)
+    )
+
+    logger.debug(count_extensions(results))
+    return results
+
+
+def iter_directory_contents(
+    owner: str, repo_name: str, directory_path='', mode=None, state=None
+):
+    """
+    Потоковый вариант get_directory_contents: отдаёт FileData по мере загрузки,
+    не накапливая содержимое всего репозитория в памяти.
+    """
+    mode = mode or DEFAULT_FETCH_MODE
+    if mode == 'async':
+        files = _iter_directory_contents_async(
+            owner, repo_name, directory_path, state=state
+        )
+    elif mode == 'serial':
+        files = _iter_directory_contents_serial(owner, repo_name, directory_path, state)
+    elif mode == 'archive':
+        if state is not None:
+            logger.warning('Режим archive не поддерживает инкрементальный обход')
+        files = iter_repository_archive(owner, repo_name, directory_path)
+    else:
+        raise ValueError(f'Неизвестный режим загрузки: {mode}')
+    return _count_fetched(files, mode)
+
+
+def _count_fetched(files, mode: str):
+    try:
+        for file_data in files:
+            metrics.count_files(
+                'fetch',
+                size=len(file_data.raw_content or b''),
+                mode=mode,
+            )
+            yield file_data
+    finally:
+        # Закрываем источник сразу (async-обход останавливает свой поток)
+        files.close()
+
+
+def _process_file(file_name: str, file_content: bytes, owner, repo_name, encoding=None):
+    """Распаковывает архив или декодирует файл, отдавая получившиеся FileData."""
+    archive_type = archive_format(file_name, file_content[:SNIFF_SIZE])
+    if archive_type is None:
+        try:
+            yield FileData(
+                owner,
+                repo_name,
+                file_name,
+                file_content.decode(encoding or 'utf-8', errors='replace'),
+                raw_content=file_content,
+            )
+        except Exception as e:
+            logger.error(f'Ошибка при обработке файла {file_name}: {e}')
+        return
+
+    try:
+        yield from _extract_archive(
+            archive_type, file_content, owner, repo_name, nested=True
+        )
+    except ArchiveLimitError as e:
+        logger.error(f'Архив {file_name} превышает ограничения распаковки: {e}')
+    except zipfile.BadZipFile:
+        logger.error(f'Файл {file_name} не является корректным zip-архивом')
+    except tarfile.ReadError:
+        logger.error(f'Файл {file_name} не является корректным tar-архивом')
+    except py7zr.PasswordRequired:
+        logger.error(f'Файл {file_name} требует пароль для распаковки')
+    except py7zr.Bad7zFile:
+        logger.error(f'Файл {file_name} не является корректным 7z-архивом')
+    except py7zr.UnsupportedCompressionMethodError:
+        logger.error(f'Файл {file_name} использует неподдерживаемый метод сжатия')
+    except Exception as e:
+        logger.error(f'Ошибка при обработке архива {file_name}: {e}')
+
+
+def _archive_name_filter(directory_path: str):
+    """
+    Возвращает фильтр для архива репозитория: отрезает корневой каталог
+    вида {owner}-{repo}-{sha}/ и оставляет только файлы из directory_path.
+    """
+    prefix = directory_path.strip('/')
+    if prefix:
+        prefix += '/'
+
+    def name_filter(name: str) -> str | None:
+        _, _, relative_name = name.partition('/')
+        if not relative_name or not relative_name.startswith(prefix):
+            return None
+        return relative_name
+
+    return name_filter
+
+
+def get_repository_archive(
+    owner: str,
+    repo_name: str,
+    directory_path='',
+    results=None,
+    archive_format: str = 'tarball',
+):
+    """
+    Загружает репозиторий одним архивом (tarball/zipball) вместо отдельного
+    запроса на каждый файл и каталог.
+
+    :param archive_format: 'tarball' или 'zipball'.
+    :return: Список FileData с путями файлов относительно корня репозитория.
+    """
+    if results is None:
+        results = []
+    results.extend(
+        iter_repository_archive(owner, repo_name, directory_path, archive_format)
+    )
+    return results
+
+
+def iter_repository_archive(
+    owner: str, repo_name: str, directory_path='', archive_format: str = 'tarball'
+):
+    """
+    Потоковый вариант get_repository_archive.
+
+    Tarball читается прямо из ответа; zipball требует произвольного доступа,
+    поэтому сначала сохраняется во временный файл.
+
+    :raises FetchError: Если архив не получен (кроме 404: репозитория нет).
+    """
+    if archive_format not in ('tarball', 'zipball'):
+        raise ValueError(f'Неизвестный формат архива: {archive_format}')
+
+    url = f'{GITHUB_API_URL}/repos/{owner}/{repo_name}/{archive_format}'
+    name_filter = _archive_name_filter(directory_path)
+
+    try:
+        with get_scheduler().get(url, stream=True) as response:
+            if response.status_code != 200:
+                message = (
+                    f'Ошибка при получении архива репозитория {owner}/{repo_name}: '
+                    f'{response.status_code}'
+                )
+                # 404 - репозитория нет или он пуст, повторная загрузка не поможет
+                if response.status_code != 404:
+                    raise FetchError(message)
+                logger.error(message)
+                return
+            response.raw.decode_content = True
+
+            if archive_format == 'tarball':
+                yield from extract_tar(
+                    response.raw,
+                    owner,
+                    repo_name,
+                    name_filter=name_filter,
+                    nested=True,
+                    mode='r|gz',
+                    limits=REPOSITORY_ARCHIVE_LIMITS,
+                )
+            else:
+                with tempfile.SpooledTemporaryFile(
+                    max_size=ARCHIVE_SPOOL_SIZE
+                ) as archive_file:
+                    shutil.copyfileobj(response.raw, archive_file)
+                    archive_file.seek(0)
+                    yield from extract_zip(
+                        archive_file,
+                        owner,
+                        repo_name,
+                        name_filter=name_filter,
+                        nested=True,
+                        limits=REPOSITORY_ARCHIVE_LIMITS,
+                    )
+    except (requests.RequestException, tarfile.TarError, zipfile.BadZipFile) as e:
+        logger.error(f'Ошибка при загрузке архива репозитория {owner}/{repo_name}: {e}')
+        raise
+
+
+def _listing_headers(state, owner: str, repo_name: str, directory_path):
+    """Возвращает заголовки запроса листинга и сохранённый листинг (или None)."""
+    headers = {}
+    cached = None
+    if state is not None:
+        cached = state.get_listing(owner, repo_name, directory_path)
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+    return headers, cached
+
+
+def _should_fetch(state, owner: str, repo_name: str, content_item) -> bool:
+    """Проверяет по blob SHA, нужно ли загружать и анализировать файл заново."""
+    if state is None:
+        return True
+    if state.is_unchanged(owner, repo_name, content_item['path'], content_item['sha']):
+        logger.debug(f'Файл {content_item["path"]} не изменился, пропускаем')
+        return False
+    state.forget_blob(owner, repo_name, content_item['path'])
+    return True
+
+
+def _iter_directory_contents_serial(
+    owner: str, repo_name: str, directory_path, state=None
+):
+    headers, cached = _listing_headers(state, owner, repo_name, directory_path)
 
-    url = f'https://api.github.com/repos/{owner}/{repo_name}/contents/{directory_path}'
-    response = requests.get(url, headers=headers)
+    url = f'{GITHUB_API_URL}/repos/{owner}/{repo_name}/contents/{directory_path}'
+    response = get_scheduler().get(url, headers=headers)
 
-    if response.status_code == 200:
+    if response.status_code == 304 and cached is not None:
+        content_data = cached[1]
+    elif response.status_code == 200:
         content_data = response.json()
+        if state is not None:
+            state.save_listing(
+                owner,
+                repo_name,
+                directory_path,
+                response.headers.get('ETag'),
+                content_data,
+            )
+    else:
+        _listing_failed(owner, repo_name, directory_path, response.status_code)
+        return
 
-        for content_item in content_data:
-            if content_item['type'] == 'file':
-                file_name = content_item['name']
-                file_content_url = content_item['download_url']
-                file_response = requests.get(file_content_url)
-
-                if file_response.status_code == 200:
-                    file_content = file_response.content
-                    if file_name.endswith('.zip'):
-                        try:
-                            extract_zip(file_content, owner, repo_name, results)
-                        except zipfile.BadZipFile:
-                            logger.error(
-                                f'Файл {file_name} не является корректным zip-архивом'
-                            )
-                        except RuntimeError as e:
-                            logger.error(
-                                f'Ошибка при обработке zip-архива {file_name}: {e}'
-                            )
-                    elif file_name.endswith('.tar.gz') or file_name.endswith('.tgz'):
-                        try:
-                            extract_tar(file_content, owner, repo_name, results)
-                        except tarfile.ReadError:
-                            logger.error(
-                                f'Файл {file_name} не является корректным tar-архивом'
-                            )
-                    elif file_name.endswith('.7z'):
-                        try:
-                            extract_7z(file_content, owner, repo_name, results)
-                        except py7zr.PasswordRequired:
-                            logger.error(
-                                f'Файл {file_name} требует пароль для распаковки'
-                            )
-                        except py7zr.Bad7zFile:
-                            logger.error(
-                                f'Файл {file_name} не является корректным 7z-архивом'
-                            )
-                        except py7zr.UnsupportedCompressionMethodError:
-                            logger.error(
-                                f'Файл {file_name} использует неподдерживаемый метод сжатия'
-                            )
-                    else:
-                        try:
-                            file_data = FileData(
-                                owner, repo_name, file_name, file_response.text
-                            )
-                            results.append(file_data)
-                        except UnicodeDecodeError:
-                            logger.error(f'Ошибка при декодировании файла {file_name}')
-                        except Exception as e:
-                            logger.error(f'Ошибка при обработке файла {file_name}: {e}')
-                else:
-                    logger.error(
-                        f'Ошибка при получении файла {file_name}: {file_response.status_code}'
+    for content_item in content_data:
+        if content_item['type'] == 'file':
+            if not _should_fetch(state, owner, repo_name, content_item):
+                continue
+            file_name = content_item['name']
+            file_content_url = content_item['download_url']
+            file_response = get_scheduler().get(file_content_url, authorize=False)
+
+            if file_response.status_code == 200:
+                for file_data in _process_file(
+                    file_name,
+                    file_response.content,
+                    owner,
+                    repo_name,
+                    encoding=file_response.encoding,
+                ):
+                    yield file_data._replace(
+                        path=content_item['path'], sha=content_item['sha']
+                    )
+                # Генератор возобновился - все данные файла уже обработаны
+                if state is not None:
+                    state.mark_blob(
+                        owner, repo_name, content_item['path'], content_item['sha']
                     )
+            else:
+                logger.error(
+                    f'Ошибка при получении файла {file_name}: {file_response.status_code}'
+                )
+
+        elif content_item['type'] == 'dir':
+            dir_name = content_item['name']
+            yield from _iter_directory_contents_serial(
+                owner, repo_name, f'{directory_path}/{dir_name}', state
+            )
+
+
+# Маркер в потоке async-краулера: все FileData файла path уже отданы
+_BlobDone = namedtuple('_BlobDone', ['path', 'sha'])
+
+
+class _AsyncCrawler:
+    """
+    Параллельный обход репозитория через aiohttp.
+
+    Каталоги и файлы обрабатывают concurrency воркеров из общей очереди, все
+    запросы идут через общий пул соединений. Воркер занят файлом, пока тот не
+    передан в emit, поэтому в памяти одновременно не больше concurrency
+    загруженных файлов, а медленный потребитель останавливает загрузку.
+    Распаковка архивов выполняется в пуле потоков, чтобы не блокировать
+    event loop. Если emit вернул False, обход прекращается. При заданном
+    state после всех FileData каждого файла в emit передаётся маркер _BlobDone.
+    """
 
+    def __init__(self, owner: str, repo_name: str, emit, concurrency: int, state=None):
+        self.owner = owner
+        self.repo_name = repo_name
+        self.emit = emit
+        self.concurrency = concurrency
+        self.state = state
+        self.stopped = False
+        self.errors = []
+
+    async def run(self, directory_path=''):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            self.session = session
+            self.pending = asyncio.Queue()
+            self.pending.put_nowait(('dir', directory_path))
+            workers = [
+                asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+            ]
+            try:
+                await self.pending.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        if self.errors:
+            raise self.errors[0]
+
+    async def _worker(self):
+        while True:
+            kind, item = await self.pending.get()
+            try:
+                if self.stopped:
+                    continue
+                if kind == 'dir':
+                    await self._walk(item)
+                else:
+                    await self._fetch_file(item)
+            except Exception as e:
+                # Обход не завершён: остальные элементы очереди только снимаются
+                self.errors.append(e)
+                self.stopped = True
+            finally:
+                self.pending.task_done()
+
+    async def _walk(self, directory_path):
+        headers, cached = _listing_headers(
+            self.state, self.owner, self.repo_name, directory_path
+        )
+        url = f'{GITHUB_API_URL}/repos/{self.owner}/{self.repo_name}/contents/{directory_path}'
+
+        response = await get_scheduler().fetch_async(self.session, url, headers=headers)
+        if response.status == 304 and cached is not None:
+            content_data = cached[1]
+        elif response.status == 200:
+            content_data = json.loads(response.body)
+            if self.state is not None:
+                self.state.save_listing(
+                    self.owner,
+                    self.repo_name,
+                    directory_path,
+                    response.headers.get('ETag'),
+                    content_data,
+                )
+        else:
+            _listing_failed(self.owner, self.repo_name, directory_path, response.status)
+            return
+
+        for content_item in content_data:
+            if content_item['type'] == 'file':
+                self.pending.put_nowait(('file', content_item))
             elif content_item['type'] == 'dir':
-                dir_name = content_item['name']
-                get_directory_contents(
-                    owner, repo_name, f'{directory_path}/{dir_name}', results
+                self.pending.put_nowait(
+                    ('dir', f'{directory_path}/{content_item["name"]}')
                 )
-    else:
-        logger.error(
-            f'Ошибка при получении содержимого репозитория {owner}/{repo_name}: {response.status_code}'
+
+    async def _fetch_file(self, content_item):
+        if not _should_fetch(self.state, self.owner, self.repo_name, content_item):
+            return
+        file_name = content_item['name']
+        try:
+            response = await get_scheduler().fetch_async(
+                self.session, content_item['download_url'], authorize=False
+            )
+        except RateLimitedError as e:
+            logger.error(f'Ошибка при получении файла {file_name}: {e}')
+            return
+        if response.status != 200:
+            logger.error(f'Ошибка при получении файла {file_name}: {response.status}')
+            return
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            self._emit_file,
+            content_item,
+            response.body,
+            requests.utils.get_encoding_from_headers(response.headers),
         )
 
-    logger.debug(count_extensions(results))
+    def _emit_file(self, content_item, file_content, encoding):
+        path, sha = content_item['path'], content_item['sha']
+        for file_data in _process_file(
+            content_item['name'], file_content, self.owner, self.repo_name, encoding
+        ):
+            if self.stopped or not self.emit(file_data._replace(path=path, sha=sha)):
+                self.stopped = True
+                return
+        if self.state is not None and not self.emit(_BlobDone(path, sha)):
+            self.stopped = True
+
+
+async def get_directory_contents_async(
+    owner: str,
+    repo_name: str,
+    directory_path='',
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> list[FileData]:
+    """Параллельно загружает листинги каталогов и файлы репозитория."""
+    results = []
+
+    def emit(file_data):
+        results.append(file_data)
+        return True
+
+    await _AsyncCrawler(owner, repo_name, emit, concurrency).run(directory_path)
     return results
 
 
-def extract_zip(file_content, owner, repo_name, results):
-    with zipfile.ZipFile(io.BytesIO(file_content)) as zip_ref:
-        for zip_info in zip_ref.infolist():
-            if not zip_info.is_dir():
-                try:
-                    with zip_ref.open(zip_info) as file:
-                        try:
-                            file_data = FileData(
-                                owner,
-                                repo_name,
-                                zip_info.filename,
-                                file.read().decode('utf-8'),
-                            )
-                            results.append(file_data)
-                        except UnicodeDecodeError:
-                            logger.warning(
-                                f'Ошибка при декодировании файла {zip_info.filename}'
-                            )
-                        except Exception as e:
-                            logger.error(
-                                f'Ошибка при обработке файла {zip_info.filename}: {e}'
-                            )
-                except RuntimeError as e:
-                    logger.error(f'Ошибка при обработке файла {zip_info.filename}: {e}')
-
-
-def extract_tar(file_content, owner, repo_name, results):
-    with tarfile.open(fileobj=io.BytesIO(file_content), mode='r:gz') as tar_ref:
-        for tar_info in tar_ref.getmembers():
-            if tar_info.isfile():
-                try:
-                    file = tar_ref.extractfile(tar_info)
-                    if file:
-                        try:
-                            file_data = FileData(
-                                owner,
-                                repo_name,
-                                tar_info.name,
-                                file.read().decode('utf-8'),
-                            )
-                            results.append(file_data)
-                        except UnicodeDecodeError:
-                            logger.warning(
-                                f'Ошибка при декодировании файла {tar_info.name}'
-                            )
-                        except Exception as e:
-                            logger.error(
-                                f'Ошибка при обработке файла {tar_info.name}: {e}'
-                            )
-                except Exception as e:
-                    logger.error(f'Ошибка при распаковке файла {tar_info.name}: {e}')
-
-
-def extract_7z(file_content, owner, repo_name, results):
+_STREAM_END = object()
+
+
+def _iter_directory_contents_async(
+    owner: str,
+    repo_name: str,
+    directory_path='',
+    concurrency: int = DEFAULT_CONCURRENCY,
+    state=None,
+):
+    """
+    Запускает _AsyncCrawler в отдельном потоке и отдаёт FileData через
+    ограниченную очередь: пока потребитель не забрал данные, загрузка
+    приостанавливается, а обработка может начинаться до окончания обхода.
+    """
+    stream = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    closed = threading.Event()
+    errors = []
+
+    def emit(item) -> bool:
+        while not closed.is_set():
+            try:
+                stream.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            asyncio.run(
+                _AsyncCrawler(owner, repo_name, emit, concurrency, state).run(
+                    directory_path
+                )
+            )
+        except Exception as e:
+            logger.error(f'Ошибка при обходе репозитория {owner}/{repo_name}: {e}')
+            errors.append(e)
+        finally:
+            emit(_STREAM_END)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
     try:
-        with py7zr.SevenZipFile(io.BytesIO(file_content), mode='r') as archive:
-            for name, bio in archive.readall().items():
-                try:
-                    file_data = FileData(
-                        owner, repo_name, name, bio.read().decode('utf-8')
-                    )
-                    results.append(file_data)
-                except UnicodeDecodeError:
-                    logger.warning(f'Ошибка при декодировании файла {name}')
-                except Exception as e:
-                    logger.error(f'Ошибка при обработке файла {name}: {e}')
-    except py7zr.exceptions.UnsupportedCompressionMethodError:
-        logger.error('Файл использует неподдерживаемый метод сжатия')
-    except Exception as e:
-        logger.error(f'Ошибка при обработке 7z-архива: {e}')
+        while True:
+            item = stream.get()
+            if item is _STREAM_END:
+                if errors:
+                    # Обход не завершён - репозиторий не должен считаться обработанным
+                    raise errors[0]
+                break
+            if isinstance(item, _BlobDone):
+                # Потребитель запросил следующий элемент - файл обработан целиком
+                state.mark_blob(owner, repo_name, item.path, item.sha)
+                continue
+            yield item
+    finally:
+        closed.set()
+
+
+def _extract_archive(
+    archive_type: str,
+    file_content,
+    owner,
+    repo_name,
+    name_filter=None,
+    nested=False,
+    limits=DEFAULT_LIMITS,
+    mode='r|*',
+):
+    """Отдаёт FileData для текстовых файлов архива (двоичные пропускаются)."""
+    if not nested:
+        limits = limits._replace(max_depth=1)
+    for member in iter_archive(
+        file_content,
+        archive_type=archive_type,
+        limits=limits,
+        name_filter=name_filter,
+        tar_mode=mode,
+    ):
+        metrics.count_files('extract', size=len(member.data))
+        if not member.is_text:
+            logger.debug(f'Файл {member.name} не текстовый, пропускаем')
+            continue
+        yield FileData(
+            owner,
+            repo_name,
+            member.name,
+            member.data.decode('utf-8', errors='replace'),
+            raw_content=member.data,
+        )
+
+
+def extract_zip(
+    file_content, owner, repo_name, name_filter=None, nested=False, limits=None
+):
+    """
+    Извлекает файлы из zip-архива, отдавая FileData по одному.
+
+    :param file_content: Содержимое архива (bytes) или seekable файловый объект.
+    :param name_filter: Функция, возвращающая новое имя файла или None, если файл
+        нужно пропустить.
+    :param nested: Распаковывать вложенные архивы.
+    :param limits: ArchiveLimits (по умолчанию archive_extraction.DEFAULT_LIMITS).
+    """
+    return _extract_archive(
+        'zip',
+        file_content,
+        owner,
+        repo_name,
+        name_filter,
+        nested,
+        limits or DEFAULT_LIMITS,
+    )
+
+
+def extract_tar(
+    file_content,
+    owner,
+    repo_name,
+    name_filter=None,
+    nested=False,
+    mode='r:gz',
+    limits=None,
+):
+    """
+    Извлекает файлы из tar-архива, отдавая FileData по одному.
+
+    :param file_content: Содержимое архива (bytes) или файловый объект; для
+        потокового чтения без перемотки передайте mode='r|gz'.
+    :param name_filter: Функция, возвращающая новое имя файла или None, если файл
+        нужно пропустить.
+    :param nested: Распаковывать вложенные архивы.
+    :param limits: ArchiveLimits (по умолчанию archive_extraction.DEFAULT_LIMITS).
+    """
+    return _extract_archive(
+        'tar',
+        file_content,
+        owner,
+        repo_name,
+        name_filter,
+        nested,
+        limits or DEFAULT_LIMITS,
+        mode,
+    )
+
+
+def extract_7z(file_content, owner, repo_name, nested=False, limits=None):
+    """
+    Извлекает файлы из 7z-архива, отдавая FileData по одному.
+
+    :param file_content: Содержимое архива (bytes) или seekable файловый объект.
+    :param nested: Распаковывать вложенные архивы.
+    :param limits: ArchiveLimits (по умолчанию archive_extraction.DEFAULT_LIMITS).
+    """
+    return _extract_archive(
+        '7z',
+        file_content,
+        owner,
+        repo_name,
+        nested=nested,
+        limits=limits or DEFAULT_LIMITS,
+    )
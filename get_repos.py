@@ -1,14 +1,11 @@
-import requests
 import json
-from source import TOKEN
+from github_client import get_scheduler
 from logging_config import logging
 
 logger = logging.getLogger(__name__)
 
 
 def get_repositories():
-    headers = {'Authorization': f'token {TOKEN}'}
-
     repositories = []
     url = 'https://api.github.com/search/repositories'
     page = 1
@@ -18,7 +15,7 @@ def get_repositories():
         params = {'q': 'language:python', 'per_page': 100, 'page': page}
 
         logger.info(f'Происходит запрос к GitHub API: {page}/{page_amount}')
-        response = requests.get(url, headers=headers, params=params)
+        response = get_scheduler().get(url, params=params)
 
         if response.status_code == 200:
             data = response.json()
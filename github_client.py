@@ -0,0 +1,334 @@
+"""
+Общий планировщик запросов к GitHub API.
+
+Учитывает лимиты X-RateLimit-* для каждого токена из пула и каждого ресурса
+API (core, search, ...: у них независимые лимиты), равномерно
+распределяет оставшийся бюджет запросов до момента сброса лимита и повторяет
+неудачные запросы (403/429 из-за лимитов, 5xx, сетевые ошибки) с
+экспоненциальной задержкой и случайным разбросом.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import source
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 120.0
+# Сколько запросов каждого токена держать в запасе (не больше десятой части
+# лимита ресурса: у search всего 30 запросов в минуту)
+RESERVE = 50
+DEFAULT_RESOURCE = 'core'
+# Ниже этого остатка запросы токена распределяются равномерно до сброса лимита
+PACING_THRESHOLD = 1000
+POOL_SIZE = 32
+REQUEST_TIMEOUT = 60
+
+# Ответ, тело которого уже прочитано (для aiohttp, где ответ закрывается)
+FetchResult = namedtuple('FetchResult', ['status', 'headers', 'body'])
+
+
+class RateLimitedError(Exception):
+    """Запрос не удался после всех повторов."""
+
+
+class _TokenBudget:
+    def __init__(self, token: str, resource: str = DEFAULT_RESOURCE):
+        self.token = token
+        self.resource = resource
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+        self.next_time = 0.0
+
+    def available(self, now: float) -> int | None:
+        if self.remaining is None or now >= self.reset_at:
+            return None  # бюджет неизвестен или уже сброшен
+        return self.remaining - self.reserve
+
+    @property
+    def reserve(self) -> int:
+        if self.limit is None:
+            return RESERVE
+        return min(RESERVE, self.limit // 10)
+
+
+def _resource(url: str) -> str:
+    """Ресурс лимита GitHub API, которому принадлежит запрос (X-RateLimit-Resource)."""
+    path = urlsplit(url).path
+    if path.startswith('/search/code'):
+        return 'code_search'
+    if path.startswith('/search/'):
+        return 'search'
+    if path.startswith('/graphql'):
+        return 'graphql'
+    return DEFAULT_RESOURCE
+
+
+def _load_tokens() -> list[str]:
+    tokens = getattr(source, 'TOKENS', None) or source.TOKEN
+    if isinstance(tokens, str):
+        tokens = [token.strip() for token in tokens.split(',')]
+    return [token for token in tokens if token]
+
+
+class RequestScheduler:
+    def __init__(self, tokens: list[str] | None = None):
+        self._tokens = tokens if tokens is not None else _load_tokens()
+        # (токен, ресурс) -> _TokenBudget; бюджеты ресурсов создаются по мере
+        # первых запросов к ним
+        self._budgets = {
+            (token, DEFAULT_RESOURCE): _TokenBudget(token) for token in self._tokens
+        }
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _budget(self, token: str, resource: str) -> _TokenBudget:
+        budget = self._budgets.get((token, resource))
+        if budget is None:
+            budget = self._budgets[token, resource] = _TokenBudget(token, resource)
+        return budget
+
+    def _reserve(self, resource: str = DEFAULT_RESOURCE):
+        """
+        Выбирает токен для следующего запроса.
+
+        :param resource: Ресурс лимита, к которому относится запрос (см. _resource).
+        :return: Бюджет токена (или None для запроса без токена) и время
+            ожидания в секундах до отправки запроса.
+        """
+        if not self._tokens:
+            return None, 0.0
+
+        with self._lock:
+            now = time.time()
+            budgets = [self._budget(token, resource) for token in self._tokens]
+
+            def ready_at(budget):
+                available = budget.available(now)
+                if available is not None and available <= 0:
+                    return max(budget.reset_at, budget.next_time)
+                return max(budget.next_time, now)
+
+            budget = min(budgets, key=ready_at)
+            start = ready_at(budget)
+
+            available = budget.available(now)
+            if available is not None and available <= 0:
+                # Лимит исчерпан: все ждут сброса окна, без сдвига на интервал
+                budget.next_time = budget.reset_at
+            elif available is not None and available < PACING_THRESHOLD:
+                budget.next_time = start + (budget.reset_at - now) / available
+            else:
+                budget.next_time = start
+            if available is not None and budget.remaining is not None:
+                budget.remaining -= 1
+            return budget, max(start - now, 0.0)
+
+    def _update(self, budget, status: int, headers):
+        if budget is None:
+            return
+        with self._lock:
+            resource = headers.get('X-RateLimit-Resource')
+            if resource and resource != budget.resource:
+                # Ответ учтён в лимите другого ресурса, чем предполагалось
+                budget = self._budget(budget.token, resource)
+            try:
+                if 'X-RateLimit-Remaining' in headers:
+                    budget.remaining = int(headers['X-RateLimit-Remaining'])
+                if 'X-RateLimit-Reset' in headers:
+                    reset_at = float(headers['X-RateLimit-Reset'])
+                    if reset_at > budget.reset_at:
+                        # Новое окно: темп, накопленный в старом, не действует
+                        budget.next_time = 0.0
+                    budget.reset_at = reset_at
+                if 'X-RateLimit-Limit' in headers:
+                    budget.limit = int(headers['X-RateLimit-Limit'])
+            except ValueError:
+                return
+            if status in (403, 429) and 'Retry-After' in headers:
+                try:
+                    retry_at = time.time() + float(headers['Retry-After'])
+                except ValueError:
+                    return
+                budget.next_time = max(budget.next_time, retry_at)
+
+    def _should_retry(self, status: int, headers) -> bool:
+        if status in RETRY_STATUSES:
+            return True
+        # 403 означает исчерпанный (или вторичный) лимит, а не отказ в доступе
+        return status == 403 and (
+            headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in headers
+        )
+
+    def _is_exhausted(self, status: int, headers) -> bool:
+        # Ожидание сброса исчерпанного лимита берёт на себя _reserve
+        return status == 403 and headers.get('X-RateLimit-Remaining') == '0'
+
+    def _retry_delay(self, attempt: int, headers=None) -> float:
+        if headers is not None and 'Retry-After' in headers:
+            try:
+                return float(headers['Retry-After'])
+            except ValueError:
+                pass
+        delay = min(MAX_DELAY, BASE_DELAY * 2**attempt)
+        return random.uniform(0, delay)
+
+    def rate_limit_status(self) -> list[dict]:
+        """Текущий остаток лимита по каждому токену и ресурсу."""
+        with self._lock:
+            return [
+                {
+                    'token': self._tokens.index(budget.token),
+                    'resource': budget.resource,
+                    'limit': budget.limit,
+                    'remaining': budget.remaining,
+                    'reset_at': budget.reset_at,
+                }
+                for budget in self._budgets.values()
+            ]
+
+    def request(
+        self, method: str, url: str, authorize: bool = True, headers=None, **kwargs
+    ) -> requests.Response:
+        """
+        Выполняет HTTP-запрос через общий пул соединений с учётом лимитов.
+
+        :param authorize: Добавлять токен и учитывать лимит API (для
+            raw.githubusercontent.com не нужно).
+        :return: Последний полученный ответ (в том числе с кодом ошибки, если
+            повторы не помогли).
+        :raises RateLimitedError: Если ни одна попытка не получила ответа.
+        """
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        last_error = None
+        for attempt in range(MAX_RETRIES + 1):
+            budget, wait = self._reserve(_resource(url)) if authorize else (None, 0.0)
+            if wait > 0:
+                logger.info(f'Ожидание лимита GitHub API: {wait:.1f} с')
+                time.sleep(wait)
+
+            request_headers = dict(headers or {})
+            if budget is not None:
+                request_headers['Authorization'] = f'Bearer {budget.token}'
+            try:
+                with metrics.timer('http'):
+                    response = self.session.request(
+                        method, url, headers=request_headers, **kwargs
+                    )
+            except requests.RequestException as e:
+                metrics.inc('nir_http_requests_total', status='error')
+                last_error = e
+                logger.warning(f'Ошибка запроса {url}: {e}, попытка {attempt + 1}')
+                time.sleep(self._retry_delay(attempt))
+                continue
+
+            metrics.inc('nir_http_requests_total', status=str(response.status_code))
+            self._update(budget, response.status_code, response.headers)
+            if attempt < MAX_RETRIES and self._should_retry(
+                response.status_code, response.headers
+            ):
+                logger.warning(
+                    f'Ответ {response.status_code} на {url}, попытка {attempt + 1}'
+                )
+                response.close()
+                if not self._is_exhausted(response.status_code, response.headers):
+                    time.sleep(self._retry_delay(attempt, response.headers))
+                continue
+            return response
+
+        raise RateLimitedError(f'Не удалось выполнить запрос {url}: {last_error}')
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    async def fetch_async(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        authorize: bool = True,
+        headers=None,
+    ) -> FetchResult:
+        """Асинхронный аналог request для GET через общую сессию aiohttp."""
+        last_error = None
+        for attempt in range(MAX_RETRIES + 1):
+            budget, wait = self._reserve(_resource(url)) if authorize else (None, 0.0)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            request_headers = dict(headers or {})
+            if budget is not None:
+                request_headers['Authorization'] = f'Bearer {budget.token}'
+            try:
+                with metrics.timer('http'):
+                    async with session.get(url, headers=request_headers) as response:
+                        result = FetchResult(
+                            response.status, response.headers, await response.read()
+                        )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc('nir_http_requests_total', status='error')
+                last_error = e
+                logger.warning(f'Ошибка запроса {url}: {e}, попытка {attempt + 1}')
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+
+            metrics.inc('nir_http_requests_total', status=str(result.status))
+            self._update(budget, result.status, result.headers)
+            if attempt < MAX_RETRIES and self._should_retry(
+                result.status, result.headers
+            ):
+                logger.warning(f'Ответ {result.status} на {url}, попытка {attempt + 1}')
+                if not self._is_exhausted(result.status, result.headers):
+                    await asyncio.sleep(self._retry_delay(attempt, result.headers))
+                continue
+            return result
+
+        raise RateLimitedError(f'Не удалось выполнить запрос {url}: {last_error}')
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """Возвращает общий для процесса планировщик запросов."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def _rate_limit_metrics():
+    if _scheduler is None:
+        return
+    now = time.time()
+    for status in _scheduler.rate_limit_status():
+        labels = {'token': str(status['token']), 'resource': status['resource']}
+        yield 'nir_github_rate_limit_remaining', status['remaining'], labels
+        if status['reset_at']:
+            yield (
+                'nir_github_rate_limit_reset_seconds',
+                max(status['reset_at'] - now, 0.0),
+                labels,
+            )
+
+
+metrics.register_collector(_rate_limit_metrics)
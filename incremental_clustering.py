@@ -0,0 +1,199 @@
+"""
+Потоковая кластеризация эмбеддингов эталонного кода.
+
+Эмбеддинги подаются батчами по мере вычисления. Первые sample_size векторов
+служат выборкой, на которой выбирается число кластеров (кандидаты обучаются
+параллельно) и инициализируются центры; дальше центры обновляются
+mini-batch k-means без повторного обучения. Состояние (центры и число
+точек в каждом кластере) сохраняется, поэтому новые эталонные репозитории
+можно добавлять к уже построенной кластеризации.
+"""
+
+import os
+
+import numpy as np
+
+import metrics
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_SIZE = 20_000
+DEFAULT_BATCH_SIZE = 4096
+K_CANDIDATES = tuple(range(2, 21))
+CLUSTERER_FILE = 'kmeans.npz'
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float64)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _fit_inertia(sample: np.ndarray, k: int, random_state: int) -> float:
+    from sklearn.cluster import KMeans
+
+    return (
+        KMeans(n_clusters=k, n_init=3, random_state=random_state).fit(sample).inertia_
+    )
+
+
+def _elbow(candidates: list[int], inertias: list[float]) -> int:
+    """Точка кривой SSE, наиболее удалённая вниз от хорды между её концами."""
+    ks = np.asarray(candidates, dtype=np.float64)
+    sse = np.asarray(inertias, dtype=np.float64)
+    x = (ks - ks[0]) / max(ks[-1] - ks[0], 1.0)
+    y = (sse - sse.min()) / max(sse.max() - sse.min(), 1e-12)
+    chord = y[0] + (y[-1] - y[0]) * x
+    return candidates[int(np.argmax(chord - y))]
+
+
+def choose_num_clusters(
+    sample: np.ndarray,
+    candidates=K_CANDIDATES,
+    n_jobs: int = -1,
+    random_state: int = 0,
+) -> tuple[int, dict[int, float]]:
+    """
+    Выбирает число кластеров методом локтя.
+
+    :param sample: Выборка эмбеддингов.
+    :param candidates: Проверяемые значения k.
+    :param n_jobs: Число параллельных процессов для обучения кандидатов (joblib).
+    :return: Выбранное k и SSE для каждого кандидата.
+    """
+    candidates = [k for k in candidates if k <= len(sample)]
+    if len(candidates) < 3:
+        return (candidates[-1] if candidates else 1), {}
+
+    from joblib import Parallel, delayed
+
+    inertias = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_inertia)(sample, k, random_state) for k in candidates
+    )
+    return _elbow(candidates, inertias), dict(zip(candidates, inertias))
+
+
+class StreamingKMeans:
+    """
+    Инкрементальная k-means по нормированным эмбеддингам.
+
+    После инициализации на выборке каждый батч относится к ближайшим центрам,
+    а центр сдвигается к среднему своих точек с шагом, обратным числу уже
+    учтённых точек (mini-batch k-means Скалли), так что центр остаётся
+    средним всех отнесённых к нему векторов.
+    """
+
+    def __init__(
+        self,
+        num_clusters: int | None = None,
+        sample_size: int = DEFAULT_SAMPLE_SIZE,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        candidates=K_CANDIDATES,
+        n_jobs: int = -1,
+        random_state: int = 0,
+    ):
+        """
+        :param num_clusters: Число кластеров; None - выбрать на выборке.
+        :param sample_size: Размер выборки для выбора k и инициализации.
+        :param batch_size: Сколько векторов накапливать перед обновлением центров.
+        """
+        self.num_clusters = num_clusters
+        self.sample_size = sample_size
+        self.batch_size = batch_size
+        self.candidates = candidates
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.centers = None
+        self.counts = None
+        self._buffer = []
+        self._buffered = 0
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.centers is not None
+
+    def partial_fit(self, embeddings: np.ndarray):
+        """Добавляет батч эмбеддингов."""
+        if embeddings.size == 0:
+            return
+        self._buffer.append(_normalize(embeddings))
+        self._buffered += len(embeddings)
+        threshold = self.batch_size if self.is_fitted else self.sample_size
+        if self._buffered >= threshold:
+            self.flush()
+
+    def flush(self):
+        """Обрабатывает накопленные векторы (в конце потока)."""
+        if not self._buffer:
+            return
+        data = np.vstack(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self.is_fitted:
+            with metrics.timer('clustering', step='update'):
+                self._update(data)
+        else:
+            with metrics.timer('clustering', step='init'):
+                self._initialize(data)
+
+    def _initialize(self, sample: np.ndarray):
+        from sklearn.cluster import KMeans
+
+        k = self.num_clusters
+        if k is None:
+            k, _ = choose_num_clusters(
+                sample, self.candidates, self.n_jobs, self.random_state
+            )
+        k = max(1, min(k, len(sample)))
+        logger.info(f'Инициализация {k} кластеров на выборке из {len(sample)} векторов')
+
+        kmeans = KMeans(n_clusters=k, n_init=3, random_state=self.random_state)
+        labels = kmeans.fit_predict(sample)
+        self.centers = kmeans.cluster_centers_.astype(np.float64)
+        self.counts = np.bincount(labels, minlength=k).astype(np.int64)
+
+    def _update(self, data: np.ndarray):
+        labels = self._assign(data)
+        batch_counts = np.bincount(labels, minlength=len(self.centers))
+        sums = np.zeros_like(self.centers)
+        np.add.at(sums, labels, data)
+
+        present = batch_counts > 0
+        old_counts = self.counts[present]
+        self.counts[present] += batch_counts[present]
+        self.centers[present] = (
+            self.centers[present] * old_counts[:, None] + sums[present]
+        ) / self.counts[present][:, None]
+
+    def _assign(self, data: np.ndarray) -> np.ndarray:
+        distances = (
+            -2.0 * data @ self.centers.T + np.sum(self.centers**2, axis=1)[None, :]
+        )
+        return np.argmin(distances, axis=1)
+
+    def predict(self, embeddings: np.ndarray) -> np.ndarray:
+        """Возвращает номер ближайшего кластера для каждого эмбеддинга."""
+        if not self.is_fitted:
+            raise ValueError('Кластеризация ещё не обучена')
+        if embeddings.size == 0:
+            return np.empty(0, dtype=np.int64)
+        return self._assign(_normalize(embeddings))
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.savez(
+            os.path.join(directory, CLUSTERER_FILE),
+            centers=self.centers,
+            counts=self.counts,
+        )
+
+    @classmethod
+    def load(cls, directory: str, **kwargs):
+        """Загружает обученную кластеризацию для дообучения на новых данных."""
+        clusterer = cls(**kwargs)
+        with np.load(os.path.join(directory, CLUSTERER_FILE)) as data:
+            clusterer.centers = data['centers']
+            clusterer.counts = data['counts']
+        clusterer.num_clusters = len(clusterer.centers)
+        return clusterer
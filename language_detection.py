@@ -1,25 +1,140 @@
+import ast
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
 from pygments.lexers import guess_lexer
 from pygments.util import ClassNotFound
+
+import metrics
 from logging_config import logging
 
 logger = logging.getLogger(__name__)
 
+PYTHON = 'Python'
+# Расширения, по которым язык определяется без чтения содержимого
+PYTHON_EXTENSIONS = {'.py', '.pyw', '.pyi'}
+EXTENSION_LANGUAGES = {
+    '.c': 'C',
+    '.h': 'C',
+    '.cpp': 'C++',
+    '.cc': 'C++',
+    '.hpp': 'C++',
+    '.cs': 'C#',
+    '.java': 'Java',
+    '.js': 'JavaScript',
+    '.ts': 'TypeScript',
+    '.go': 'Go',
+    '.rs': 'Rust',
+    '.rb': 'Ruby',
+    '.php': 'PHP',
+    '.pl': 'Perl',
+    '.sh': 'Bash',
+    '.bat': 'Batchfile',
+    '.ps1': 'PowerShell',
+    '.vbs': 'VBScript',
+    '.asm': 'Assembly',
+    '.html': 'HTML',
+    '.css': 'CSS',
+    '.json': 'JSON',
+    '.xml': 'XML',
+    '.yml': 'YAML',
+    '.yaml': 'YAML',
+    '.md': 'Markdown',
+    '.pyc': 'Binary',
+    '.exe': 'Binary',
+    '.dll': 'Binary',
+    '.so': 'Binary',
+    '.bin': 'Binary',
+}
+# guess_lexer анализирует только начало файла такой длины
+GUESS_PREFIX_SIZE = 8192
+LANGUAGE_CACHE_SIZE = 65536
+
+_SHEBANG_RE = re.compile(r'#![^\n]*\bpython')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
 
-def _detect_language(code: str):
+
+def _parses_as_python(code: str) -> bool:
+    # Код Python 2 ast не разбирает - его распознаёт guess_lexer ('Python 2.x')
     try:
-        lexer = guess_lexer(code)
-        return lexer.name
+        ast.parse(code)
+        return True
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return False
 
+
+def _guess_language(code: str) -> str | None:
+    try:
+        return guess_lexer(code[:GUESS_PREFIX_SIZE]).name
     except ClassNotFound:
         logger.error('Language could not be determined.')
     except Exception as e:
         logger.error(f'An error occurred: {e}')
+    return None
+
+
+def _detect_from_content(code: str, python_extension: bool) -> str | None:
+    if python_extension and _parses_as_python(code):
+        return PYTHON
+    if _SHEBANG_RE.match(code):
+        return PYTHON
+    language = _guess_language(code)
+    if language == 'Python 2.x':
+        return PYTHON
+    return language
+
+
+def detect_language(filename: str, code: str) -> str | None:
+    """
+    Определяет язык файла.
+
+    Сначала проверяется расширение, затем для файлов .py - разбор через
+    ast, затем shebang и, наконец, guess_lexer по началу файла.
+    Результаты для содержимого кешируются по его хешу.
+
+    :param filename: Имя файла.
+    :param code: Содержимое файла.
+    :return: Название языка или None, если язык определить не удалось.
+    """
+    if not code:
+        return None
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in EXTENSION_LANGUAGES:
+        return EXTENSION_LANGUAGES[extension]
+
+    python_extension = extension in PYTHON_EXTENSIONS
+    key = (
+        hashlib.blake2b(
+            code.encode('utf-8', errors='replace'), digest_size=16
+        ).digest(),
+        python_extension,
+    )
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            metrics.inc('nir_cache_requests_total', cache='language', result='hit')
+            return _cache[key]
+
+    metrics.inc('nir_cache_requests_total', cache='language', result='miss')
+    with metrics.timer('language_detection'):
+        language = _detect_from_content(code, python_extension)
+    with _cache_lock:
+        _cache[key] = language
+        if len(_cache) > LANGUAGE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return language
 
 
 def should_process_file(filename: str, code: str) -> bool:
-    """Check if file should be processed based on extension"""
-    detected_language = _detect_language(code)
-    if detected_language != 'Python':
+    """Check if file should be processed based on extension and contents"""
+    detected_language = detect_language(filename, code)
+    metrics.count_files('language_detection', language=detected_language or 'unknown')
+    if detected_language != PYTHON:
         logger.warning(f'Unsupported language: {detected_language} in {filename}')
         return False
     return True
@@ -1,18 +1,26 @@
 import json
 import os
+from itertools import batched
 
+import metrics
 from logging_config import logging
+from crawl_state import CrawlState
 from get_repos import get_repositories
-from get_directory_contents import get_directory_contents
-from search_hash import (
-    get_file_hash,
-    search_hash_in_dataset,
-    load_csv_to_dataframe,
+from get_directory_contents import (
+    FetchError,
+    get_directory_contents,
+    iter_directory_contents,
 )
-from cluster_analysis import analyze_code_clusters
+from github_client import RateLimitedError
+from result_store import ResultStore
+from search_hash import hash_files, load_hash_index
+from cluster_analysis import analyze_code
 
 logger = logging.getLogger(__name__)
 
+HASH_SCAN_STATE_FILE = 'hash_scan_state.sqlite3'
+HASH_BATCH_SIZE = 64
+
 
 def load_repos():
     if (
@@ -34,35 +42,99 @@ def load_repos():
     return repositories
 
 
+def scan_repository(
+    owner: str, repo_name: str, hash_index, state: CrawlState, result_store=None
+):
+    """
+    Проверяет хеши файлов репозитория по базе вредоносного ПО.
+
+    Результаты по каждому файлу сохраняются в state (CrawlState с deferred=True).
+
+    :param result_store: ResultStore: копии уже проверенных файлов берут
+        результат из него, а места всех копий запоминаются для отчёта.
+    """
+    logger.info(f'Обработка репозитория {owner}/{repo_name}...\n')
+    files = iter_directory_contents(owner, repo_name, state=state)
+    for batch in batched(files, HASH_BATCH_SIZE):
+        # Хеши считаются по исходным байтам файлов, за один проход на файл
+        hashes = hash_files(
+            [
+                file_data.raw_content
+                if file_data.raw_content is not None
+                else file_data.file_content
+                for file_data in batch
+            ]
+        )
+        results = [None] * len(batch)
+        if result_store is not None:
+            for i, (file_data, file_hashes) in enumerate(zip(batch, hashes)):
+                result_store.add_location(file_hashes.sha256, file_data)
+                results[i] = result_store.get(file_hashes.sha256)
+        unknown = [i for i, result in enumerate(results) if result is None]
+
+        found_hashes = {i: [] for i in unknown}
+        for hash_type in 'sha256', 'md5', 'sha1':
+            found_rows = hash_index.find_rows(
+                [getattr(hashes[i], hash_type) for i in unknown], hash_type
+            )
+            for i, rows in zip(unknown, found_rows):
+                file_name = batch[i].file_name
+                if len(rows):
+                    found_hashes[i].append(hash_type)
+                    logger.info(
+                        f'Найдено совпадение хеша {hash_type} '
+                        f'для файла {file_name} в репозитории {repo_name}'
+                    )
+                else:
+                    logger.warning(
+                        f'Хеш {hash_type} для файла {file_name} не найден в базе данных'
+                    )
+        for i, found in found_hashes.items():
+            results[i] = {'sha256': hashes[i].sha256, 'found': found}
+            if result_store is not None:
+                result_store.put(hashes[i].sha256, results[i])
+
+        for file_data, result in zip(batch, results):
+            state.save_result(file_data, {'file_name': file_data.file_name, **result})
+        state.commit()
+
+
 def analyze_with_dataset():
     repositories = load_repos()
 
-    malware_dataset = load_csv_to_dataframe('full.csv')
+    hash_index = load_hash_index('full.csv')
 
-    if malware_dataset is None:
+    if hash_index is None:
         logging.error(
             'Не удалось открыть базу данных вирусов, завершение работы программы'
         )
         return
 
+    # Повторный запуск анализирует только изменившиеся файлы, а прерванный
+    # запуск продолжается с первого необработанного репозитория
+    state = CrawlState(HASH_SCAN_STATE_FILE, deferred=True)
+    run_id = state.start_run(resume=True)
+    result_store = ResultStore(analysis='hash')
+
     for repo in repositories:
-        logger.info(f'Обработка репозитория {repo["owner"]}/{repo["name"]}...\n')
-        file_data_list = get_directory_contents(repo['owner'], repo['name'])
-        for file_data in file_data_list:
-            for hash_type in 'sha256', 'md5', 'sha1':
-                file_hash = get_file_hash(file_data.file_content, hash_type)
-                search_result = search_hash_in_dataset(
-                    malware_dataset, file_hash, hash_type + '_hash'
-                )
-                if search_result is not None and not search_result.empty:
-                    logger.info(
-                        f'Найдено совпадение хеша {hash_type} '
-                        f'для файла {file_data.file_name} в репозитории {repo["name"]}'
-                    )
-                else:
-                    logger.warning(
-                        f'Хеш {hash_type} для файла {file_data.file_name} не найден в базе данных'
-                    )
+        if state.is_repo_done(run_id, repo['owner'], repo['name']):
+            logger.info(f'Репозиторий {repo["owner"]}/{repo["name"]} уже обработан')
+            continue
+        try:
+            scan_repository(
+                repo['owner'], repo['name'], hash_index, state, result_store
+            )
+        except (FetchError, RateLimitedError) as e:
+            # Репозиторий не отмечается обработанным: продолжение запуска
+            # обойдёт его снова
+            logger.error(
+                f'Репозиторий {repo["owner"]}/{repo["name"]} не обработан: {e}'
+            )
+            continue
+        state.mark_repo_done(run_id, repo['owner'], repo['name'])
+        state.commit()
+
+    state.finish_run(run_id)
 
 
 def main():
@@ -83,7 +155,7 @@ def main():
         logger.info(
             f'Analyzing file: {file_data.file_name} from {file_data.owner}/{file_data.repo_name}'
         )
-        df = analyze_code_clusters(file_data.file_content, visualize=False)
+        df = analyze_code(file_data.file_content, visualize=False)
         df.to_csv(
             f'{save_dir}/{file_data.repo_name}_{file_data.file_name.replace("/", "_")}.csv',
             index=False,
@@ -91,4 +163,5 @@ def main():
 
 
 if __name__ == '__main__':
+    metrics.configure_from_env()
     main()
@@ -0,0 +1,335 @@
+"""
+Метрики этапов сканирования.
+
+Счётчики, гистограммы и показатели (gauge) хранятся в памяти процесса и
+экспортируются в текстовом формате Prometheus (HTTP-эндпоинт /metrics) и/или
+периодическими снимками в файл JSON Lines. Показатели, которые дешевле
+прочитать в момент экспорта (RSS, остаток лимита GitHub, кэш эмбеддингов),
+отдают зарегистрированные коллекторы.
+
+Настройка через переменные окружения (см. configure_from_env):
+    NIR_METRICS_PORT - порт эндпоинта Prometheus;
+    NIR_METRICS_FILE - файл для снимков в формате JSON Lines;
+    NIR_METRICS_INTERVAL - период записи снимков в секундах (по умолчанию 30);
+    NIR_PROFILE - каталог для профилей cProfile горячих циклов (см. profiled).
+"""
+
+import atexit
+import bisect
+import cProfile
+import http.server
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from logging_config import logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм длительности в секундах
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+TOKEN_BUCKETS = (512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+DEFAULT_EXPORT_INTERVAL = 30.0
+
+HELP = {
+    'nir_stage_seconds': 'Длительность операций этапов сканирования',
+    'nir_files_total': 'Число файлов, прошедших этап',
+    'nir_bytes_total': 'Объём данных, прошедших этап',
+    'nir_batch_chunks': 'Число чанков в батче модели',
+    'nir_batch_tokens': 'Число токенов в батче модели с учётом padding',
+    'nir_cache_requests_total': 'Обращения к кэшам по результату (hit/miss)',
+    'nir_http_requests_total': 'HTTP-запросы к GitHub по коду ответа',
+    'nir_hash_queries_total': 'Хеши, проверенные по базе',
+    'nir_github_rate_limit_remaining': 'Остаток лимита запросов токена GitHub',
+    'nir_github_rate_limit_reset_seconds': 'Время до сброса лимита токена GitHub',
+    'nir_process_resident_bytes': 'Резидентная память процесса',
+    'nir_service_queue_sequences': 'Последовательности в очереди сервиса эмбеддингов',
+    'nir_service_rejected_total': 'Запросы, отклонённые из-за переполненной очереди',
+}
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}  # ключ -> [границы, счётчики корзин, число, сумма]
+_collectors = []
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1.0, **labels):
+    """Увеличивает счётчик."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = float(value)
+
+
+def observe(name: str, value: float, buckets=TIME_BUCKETS, **labels):
+    """Добавляет наблюдение в гистограмму (границы задаются первым вызовом)."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [buckets, [0] * len(buckets), 0, 0.0]
+        position = bisect.bisect_left(histogram[0], value)
+        if position < len(histogram[1]):
+            histogram[1][position] += 1
+        histogram[2] += 1
+        histogram[3] += value
+
+
+@contextmanager
+def timer(stage: str, **labels):
+    """Замеряет длительность блока как наблюдение nir_stage_seconds{stage}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('nir_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+
+def count_files(stage: str, files: int = 1, size: int = 0, **labels):
+    """Учитывает файлы (и их объём), прошедшие этап."""
+    inc('nir_files_total', files, stage=stage, **labels)
+    if size:
+        inc('nir_bytes_total', size, stage=stage, **labels)
+
+
+def register_collector(callback):
+    """
+    Регистрирует функцию, вызываемую при каждом экспорте.
+
+    :param callback: Функция без аргументов, возвращающая итерируемое из
+        (имя, значение, словарь меток) - значения показателей на момент вызова.
+    """
+    with _lock:
+        _collectors.append(callback)
+
+
+def _resident_bytes():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    # Без psutil - пиковое значение (ru_maxrss в Linux в килобайтах)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _process_metrics():
+    yield 'nir_process_resident_bytes', _resident_bytes(), {}
+
+
+register_collector(_process_metrics)
+
+
+def _collect():
+    with _lock:
+        collectors = list(_collectors)
+    for callback in collectors:
+        try:
+            for name, value, labels in callback():
+                if value is not None:
+                    set_gauge(name, value, **labels)
+        except Exception as e:
+            logger.warning(f'Ошибка коллектора метрик: {e}')
+
+
+def snapshot() -> dict:
+    """
+    Текущие значения всех метрик.
+
+    :return: Словарь с отметкой времени и списками counters, gauges и
+        histograms; у каждой записи есть name, labels и значения.
+    """
+    _collect()
+    with _lock:
+        return {
+            'timestamp': time.time(),
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(_counters.items())
+            ],
+            'gauges': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(_gauges.items())
+            ],
+            'histograms': [
+                {
+                    'name': name,
+                    'labels': dict(labels),
+                    'buckets': dict(zip(map(str, buckets), bucket_counts)),
+                    'count': total,
+                    'sum': value_sum,
+                }
+                for (name, labels), (
+                    buckets,
+                    bucket_counts,
+                    total,
+                    value_sum,
+                ) in sorted(_histograms.items())
+            ],
+        }
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return (
+        '{'
+        + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+        + '}'
+    )
+
+
+def render_prometheus() -> str:
+    """Текущие метрики в текстовом формате Prometheus."""
+    data = snapshot()
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name in described:
+            return
+        described.add(name)
+        if name in HELP:
+            lines.append(f'# HELP {name} {HELP[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    for kind, entries in (('counter', data['counters']), ('gauge', data['gauges'])):
+        for entry in entries:
+            describe(entry['name'], kind)
+            lines.append(
+                f'{entry["name"]}{_format_labels(entry["labels"])} {entry["value"]}'
+            )
+    for entry in data['histograms']:
+        name, labels = entry['name'], entry['labels']
+        describe(name, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in entry['buckets'].items():
+            cumulative += bucket_count
+            lines.append(
+                f'{name}_bucket{_format_labels(labels, le=bound)} {cumulative}'
+            )
+        lines.append(
+            f'{name}_bucket{_format_labels(labels, le="+Inf")} {entry["count"]}'
+        )
+        lines.append(f'{name}_sum{_format_labels(labels)} {entry["sum"]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {entry["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port: int, address: str = '127.0.0.1'):
+    """Запускает эндпоинт /metrics в фоновом потоке."""
+    server = http.server.ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Метрики доступны на http://{address}:{server.server_port}/metrics')
+    return server
+
+
+class JsonlExporter:
+    """Фоновый поток, дописывающий снимок метрик в файл JSON Lines."""
+
+    def __init__(self, path: str, interval: float = DEFAULT_EXPORT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def write(self):
+        line = json.dumps({'pid': os.getpid(), **snapshot()}, ensure_ascii=False)
+        with open(self.path, 'a') as file:
+            file.write(line + '\n')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread.start()
+        # Последний снимок - с итоговыми значениями
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        if not self._stop.is_set():
+            self._stop.set()
+            self.write()
+
+
+def configure_from_env(http: bool = True):
+    """
+    Включает экспорт метрик согласно переменным окружения NIR_METRICS_*.
+
+    :param http: Запускать эндпоинт Prometheus (процессы-воркеры пула пишут
+        только снимки JSON Lines - порт занят родительским процессом).
+    """
+    port = os.environ.get('NIR_METRICS_PORT')
+    if port and http:
+        start_http_server(int(port))
+    path = os.environ.get('NIR_METRICS_FILE')
+    if path:
+        interval = float(
+            os.environ.get('NIR_METRICS_INTERVAL', DEFAULT_EXPORT_INTERVAL)
+        )
+        JsonlExporter(path, interval).start()
+
+
+@contextmanager
+def profiled(name: str):
+    """
+    Профилирует горячий цикл через cProfile, если задан NIR_PROFILE.
+
+    Профиль сохраняется в NIR_PROFILE/{name}-{pid}.prof (смотреть через
+    python -m pstats или snakeviz). Без NIR_PROFILE ничего не делает; для
+    py-spy профилирование включать не нужно - горячие циклы вынесены в
+    именованные функции и видны в его выводе.
+    """
+    directory = os.environ.get('NIR_PROFILE')
+    if not directory:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        path = os.path.join(directory, f'{name}-{os.getpid()}.prof')
+        profile.dump_stats(path)
+        logger.info(f'Профиль {name} сохранён в {path}')
@@ -0,0 +1,229 @@
+"""
+Промежуточный уровень анализа: поиск почти-дубликатов эталонного кода.
+
+Для файла считается MinHash-сигнатура по шинглам нормализованных токенов
+(комментарии и пробелы отбрасываются, строки и числа заменяются метками), а
+LSH-индекс (banding) по сигнатурам эталонных файлов находит кандидатов за
+несколько обращений к словарю. Это на порядки дешевле эмбеддингов, поэтому до
+модели доходят только файлы, похожие на эталонные, или файлы, для которых
+оценка ненадёжна.
+"""
+
+import json
+import os
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 128
+# 32 полосы по 4 строки: файлы со сходством по Жаккару 0.5 становятся
+# кандидатами с вероятностью ~0.87, со сходством 0.2 - ~0.05
+NUM_BANDS = 32
+SHINGLE_SIZE = 5
+# При меньшем числе шинглов оценка сходства ненадёжна
+MIN_SHINGLES = 10
+NEAR_MATCH_THRESHOLD = 0.5
+SEED = 1
+# Токенизатор сигнатур: сохраняется в индексе, сигнатуры другого токенизатора
+# несравнимы
+TOKENIZER = 'regex-v2'
+# Шинглы обрабатываются блоками, чтобы не держать матрицу NUM_PERM x N целиком
+SHINGLE_BLOCK_SIZE = 8192
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_SHINGLE_BASE = np.uint64(1_000_003)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+_TOKEN_RE = re.compile(
+    r'(?P<comment>#[^\n]*)'
+    r'|(?P<string>[rRbBuUfF]{0,2}(?:"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\''
+    r'|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'))'
+    r'|(?P<number>\d[\w.]*)'
+    r'|(?P<name>\w+)'
+    # Составные операторы - один токен, как у tokenize
+    r'|(?P<op>\*\*=?|//=?|<<=?|>>=?|->|:=|\.\.\.|[-+*/%&|^@<>=!]=|\S)'
+)
+
+
+def tokenize_code(code: str) -> list[str]:
+    """
+    Разбивает код на нормализованные токены.
+
+    Токенизатор детерминирован и не зависит от окружения: сигнатуры при
+    построении индекса и при проверке должны считаться одинаково (см. TOKENIZER).
+
+    :return: Токены без комментариев, строковые и числовые литералы заменены
+        на STR и NUM.
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(code):
+        kind = match.lastgroup
+        if kind == 'comment':
+            continue
+        if kind == 'string':
+            tokens.append('STR')
+        elif kind == 'number':
+            tokens.append('NUM')
+        else:
+            tokens.append(match.group())
+    return tokens
+
+
+def _shingle_hashes(tokens: list[str]) -> np.ndarray:
+    """Возвращает уникальные 32-битные хеши шинглов из SHINGLE_SIZE токенов."""
+    ids = np.fromiter(
+        (zlib.crc32(token.encode('utf-8')) for token in tokens),
+        dtype=np.uint64,
+        count=len(tokens),
+    )
+    count = len(ids) - SHINGLE_SIZE + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    # Полиномиальный хеш окна; переполнение uint64 допустимо
+    hashes = np.zeros(count, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        hashes = hashes * _SHINGLE_BASE + ids[offset : offset + count]
+    return np.unique((hashes * _MIX) >> np.uint64(32))
+
+
+def _permutations(num_perm: int, seed: int = SEED) -> tuple[np.ndarray, np.ndarray]:
+    generator = np.random.default_rng(seed)
+    a = generator.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+    b = generator.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+    return a.reshape(-1, 1), b.reshape(-1, 1)
+
+
+_PERMUTATIONS = _permutations(NUM_PERM)
+
+
+def minhash_signature(code: str) -> np.ndarray | None:
+    """
+    Считает MinHash-сигнатуру кода.
+
+    :return: Массив uint32 длины NUM_PERM или None, если шинглов меньше
+        MIN_SHINGLES и оценка сходства была бы ненадёжной.
+    """
+    shingles = _shingle_hashes(tokenize_code(code))
+    if len(shingles) < MIN_SHINGLES:
+        return None
+
+    a, b = _PERMUTATIONS
+    signature = np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint64)
+    for start in range(0, len(shingles), SHINGLE_BLOCK_SIZE):
+        block = shingles[start : start + SHINGLE_BLOCK_SIZE]
+        # a, b < 2^31 и хеши < 2^32, поэтому a * h + b не переполняет uint64
+        values = ((a * block + b) % _MERSENNE_PRIME) & np.uint64(0xFFFFFFFF)
+        signature = np.minimum(signature, values.min(axis=1))
+    return signature.astype(np.uint32)
+
+
+class MinHashLSHIndex:
+    """
+    LSH-индекс MinHash-сигнатур эталонных файлов.
+
+    Сигнатура делится на NUM_BANDS полос; файлы, у которых совпала хотя бы
+    одна полоса, считаются кандидатами, а их сходство по Жаккару оценивается
+    долей совпавших значений сигнатуры.
+    """
+
+    def __init__(self, num_bands: int = NUM_BANDS):
+        if NUM_PERM % num_bands:
+            raise ValueError('NUM_PERM должно делиться на число полос')
+        self.num_bands = num_bands
+        self.rows = NUM_PERM // num_bands
+        self.sources = []
+        self._signatures = []
+        self._buckets = [defaultdict(list) for _ in range(num_bands)]
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def _bands(self, signature: np.ndarray):
+        for band in range(self.num_bands):
+            yield band, signature[band * self.rows : (band + 1) * self.rows].tobytes()
+
+    def add(self, source: str, signature: np.ndarray):
+        position = len(self.sources)
+        self.sources.append(source)
+        self._signatures.append(signature)
+        for band, key in self._bands(signature):
+            self._buckets[band][key].append(position)
+
+    def query(self, signature: np.ndarray) -> list[tuple[str, float]]:
+        """
+        Ищет эталонные файлы, похожие на файл с данной сигнатурой.
+
+        :return: Пары (эталонный файл, оценка сходства по Жаккару) по убыванию
+            сходства.
+        """
+        candidates = set()
+        for band, key in self._bands(signature):
+            candidates.update(self._buckets[band].get(key, ()))
+        matches = [
+            (
+                self.sources[position],
+                float(np.mean(self._signatures[position] == signature)),
+            )
+            for position in candidates
+        ]
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        signatures = (
+            np.vstack(self._signatures)
+            if self._signatures
+            else np.empty((0, NUM_PERM), dtype=np.uint32)
+        )
+        np.save(os.path.join(directory, 'minhash.npy'), signatures)
+        with open(os.path.join(directory, 'minhash.json'), 'w') as file:
+            json.dump(
+                {
+                    'num_perm': NUM_PERM,
+                    'num_bands': self.num_bands,
+                    'shingle_size': SHINGLE_SIZE,
+                    'seed': SEED,
+                    'tokenizer': TOKENIZER,
+                    'sources': self.sources,
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, directory: str):
+        """
+        Загружает индекс из каталога.
+
+        :return: Индекс или None, если его нет или он построен с другими
+            параметрами MinHash или другим токенизатором.
+        """
+        meta_path = os.path.join(directory, 'minhash.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if (meta['num_perm'], meta['shingle_size'], meta['seed']) != (
+            NUM_PERM,
+            SHINGLE_SIZE,
+            SEED,
+        ):
+            logger.warning('LSH-индекс построен с другими параметрами MinHash')
+            return None
+        if meta.get('tokenizer') != TOKENIZER:
+            logger.warning(
+                f'LSH-индекс построен токенизатором {meta.get("tokenizer")}, '
+                f'а не {TOKENIZER}: перестройте индекс (collect_reference_clusters.py)'
+            )
+            return None
+
+        index = cls(meta['num_bands'])
+        signatures = np.load(os.path.join(directory, 'minhash.npy'))
+        for source, signature in zip(meta['sources'], signatures):
+            index.add(source, signature)
+        return index
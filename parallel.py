@@ -0,0 +1,192 @@
+"""
+Параллельный анализ файлов в пуле процессов.
+
+Каждый процесс-воркер один раз загружает модель и эталонный индекс и
+ограничивает число потоков модели, чтобы воркеры не конкурировали за ядра.
+Кэш эмбеддингов у воркеров общий (запись в него синхронизируется между
+процессами). Файлы передаются воркерам батчами из
+ограниченной очереди, поэтому загрузка не убегает далеко вперёд анализа.
+"""
+
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import metrics
+from cluster_analysis import preprocess_code
+from embedding_backends import TransformerBackend, get_backend
+from logging_config import logging
+from pipeline import FILES_PER_BATCH, _batched, embed_files, score_files
+from reference_index import REFERENCE_INDEX_DIR, ReferenceIndex
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# Сколько батчей на воркер может находиться в очереди
+TASKS_PER_WORKER = 2
+PROGRESS_INTERVAL = 10.0
+
+# Состояние процесса-воркера, заполняется в _init_worker
+_worker = {}
+
+
+def _init_worker(threads: int, reference_dir: str, top_k: int, threshold):
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    # Для ONNX-бэкенда (сессия создаётся в этом процессе)
+    os.environ['NIR_ONNX_THREADS'] = str(threads)
+    backend = get_backend()
+    if isinstance(backend, TransformerBackend):
+        import torch
+
+        torch.set_num_threads(threads)
+
+    # Пробный прогон загружает токенизатор и модель до первой задачи
+    backend.forward(backend.tokenize(['pass'], backend.max_length))
+
+    _worker['reference_index'] = ReferenceIndex.load(reference_dir)
+    _worker['top_k'] = top_k
+    _worker['threshold'] = threshold
+    metrics.configure_from_env(http=False)
+
+
+def _analyze_batch(batch) -> tuple[list[tuple[int, dict]], list[int]]:
+    """
+    Анализирует батч в воркере.
+
+    :return: Пары (номер файла в батче, результат) и номера файлов, эмбеддинги
+        которых посчитаны не полностью (см. embed_files).
+    """
+    positions = {id(file_data): i for i, file_data in enumerate(batch)}
+    failed = []
+    results = [
+        (positions[id(file_data)], result)
+        for file_data, result in score_files(
+            embed_files(
+                batch,
+                files_per_batch=len(batch),
+                preprocess=preprocess_code,
+                on_failed=lambda file_data: failed.append(positions[id(file_data)]),
+            ),
+            _worker['reference_index'],
+            top_k=_worker['top_k'],
+            threshold=_worker['threshold'],
+        )
+    ]
+    return results, failed
+
+
+def analyze_parallel(
+    files,
+    workers: int = DEFAULT_WORKERS,
+    threads_per_worker: int | None = None,
+    files_per_task: int = FILES_PER_BATCH,
+    ordered: bool = False,
+    reference_dir: str = REFERENCE_INDEX_DIR,
+    top_k: int = 5,
+    threshold: float = 0.9,
+    checkpoint=None,
+    on_task_done=None,
+    on_failed=None,
+    progress_interval: float = PROGRESS_INTERVAL,
+):
+    """
+    Считает эмбеддинги и сравнивает файлы с эталонным индексом в пуле процессов.
+
+    :param files: Поток FileData.
+    :param workers: Число процессов-воркеров.
+    :param threads_per_worker: Число потоков модели в воркере (по умолчанию
+        ядра делятся поровну между воркерами).
+    :param files_per_task: Число файлов в одной задаче воркера.
+    :param ordered: Отдавать результаты в порядке поступления файлов, иначе -
+        по мере готовности.
+    :param checkpoint: Вызывается после отправки каждой задачи; возвращённое
+        значение передаётся в on_task_done (например, CrawlState.checkpoint).
+    :param on_task_done: Вызывается, когда потребитель обработал результаты
+        задачи и всех более ранних (например, CrawlState.commit).
+    :param on_failed: Вызывается с FileData, эмбеддинги которого посчитаны не
+        полностью (например, CrawlState.skip_blob), до on_task_done его задачи.
+    :param progress_interval: Период вывода прогресса в секундах.
+    :return: Генератор пар (FileData, результат) как у score_files.
+    """
+    threads = threads_per_worker or max(1, DEFAULT_WORKERS // workers)
+    context = multiprocessing.get_context('spawn')
+
+    batches = _batched(files, files_per_task)
+    pending = {}  # future -> номер задачи
+    submitted = deque()  # порядок отправки (для ordered)
+    tasks = {}  # номер задачи -> (батч, значение checkpoint)
+    completed_tasks = set()
+    task_count = 0
+    next_confirmed = 0
+    files_done = 0
+    started = last_report = time.monotonic()
+
+    logger.info(f'Запуск {workers} воркеров по {threads} потоков')
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(threads, reference_dir, top_k, threshold),
+    ) as executor:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < workers * TASKS_PER_WORKER:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                # Исходные байты воркеру не нужны - не пересылаем их
+                future = executor.submit(
+                    _analyze_batch,
+                    [file_data._replace(raw_content=None) for file_data in batch],
+                )
+                pending[future] = task_count
+                if ordered:
+                    submitted.append(future)
+                tasks[task_count] = (
+                    batch,
+                    checkpoint() if checkpoint is not None else None,
+                )
+                task_count += 1
+            if not pending:
+                break
+
+            if ordered:
+                done = [submitted.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                number = pending.pop(future)
+                batch, _ = tasks[number]
+                results, failed = future.result()
+                if on_failed is not None:
+                    for position in failed:
+                        on_failed(batch[position])
+                for position, result in results:
+                    yield batch[position], result
+                files_done += len(batch)
+                completed_tasks.add(number)
+
+            # Подтверждаем только непрерывный префикс завершённых задач
+            token = None
+            confirmed = False
+            while next_confirmed in completed_tasks:
+                completed_tasks.remove(next_confirmed)
+                _, token = tasks.pop(next_confirmed)
+                next_confirmed += 1
+                confirmed = True
+            if confirmed and on_task_done is not None:
+                on_task_done(token)
+
+            now = time.monotonic()
+            if now - last_report >= progress_interval:
+                last_report = now
+                logger.info(
+                    f'Обработано файлов: {files_done}, '
+                    f'{files_done / (now - started):.1f} файл/с'
+                )
+
+    logger.info(f'Параллельный анализ завершён: {files_done} файлов')
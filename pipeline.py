@@ -0,0 +1,200 @@
+"""
+Потоковый конвейер анализа: загрузка -> распаковка -> фильтрация ->
+отбор почти-дубликатов (MinHash/LSH) -> эмбеддинги -> оценка сходства.
+
+Каждая стадия - генератор, поэтому в памяти одновременно находится только
+текущий батч файлов, а эмбеддинги считаются, пока загрузка ещё идёт.
+"""
+
+from itertools import islice
+
+import numpy as np
+
+import metrics
+from cluster_analysis import embed_code_batch, split_embeddings_by_source
+from get_directory_contents import iter_directory_contents
+from language_detection import should_process_file
+from logging_config import logging
+from minhash_lsh import NEAR_MATCH_THRESHOLD, minhash_signature
+
+logger = logging.getLogger(__name__)
+
+FILES_PER_BATCH = 16
+
+
+def fetch_files(
+    repositories: list[tuple[str, str, str]], mode=None, state=None, run_id=None
+):
+    """
+    Отдаёт FileData всех репозиториев (owner, repo_name, path) по очереди.
+
+    :param state: CrawlState для инкрементального обхода (см. get_directory_contents).
+    :param run_id: Идентификатор запуска в state: репозитории, уже полностью
+        обработанные в этом запуске, пропускаются. Отметка о репозитории
+        ставится в очередь отложенных отметок state (deferred=True) после его
+        последнего файла и записывается, когда потребитель подтвердит этот
+        файл (commit из on_batch_done/on_task_done).
+    """
+    for owner, repo_name, path in repositories:
+        if run_id is not None and state.is_repo_done(run_id, owner, repo_name):
+            logger.info(f'Repository {owner}/{repo_name} already processed, skipping')
+            continue
+        logger.info(f'Processing repository: {owner}/{repo_name}')
+        try:
+            yield from iter_directory_contents(owner, repo_name, path, mode, state)
+        except Exception as e:
+            logger.error(f'Error processing {owner}/{repo_name}: {str(e)}')
+            continue
+        if run_id is not None:
+            state.mark_repo_done(run_id, owner, repo_name)
+
+
+def filter_files(files):
+    """Пропускает только файлы, которые нужно анализировать."""
+    for file_data in files:
+        if should_process_file(file_data.file_name, file_data.file_content):
+            yield file_data
+
+
+def index_signatures(files, lsh_index):
+    """Добавляет MinHash-сигнатуры проходящих файлов в LSH-индекс."""
+    for file_data in files:
+        signature = minhash_signature(file_data.file_content)
+        if signature is not None:
+            lsh_index.add(
+                f'{file_data.owner}/{file_data.repo_name}/{file_data.file_name}',
+                signature,
+            )
+        yield file_data
+
+
+def prefilter_files(
+    files, lsh_index, threshold: float = NEAR_MATCH_THRESHOLD, on_skip=None
+):
+    """
+    Пропускает к модели только файлы, похожие на эталонные по LSH.
+
+    Файлы, для которых сигнатура ненадёжна (слишком короткие), пропускаются
+    к модели без проверки.
+
+    :param lsh_index: MinHashLSHIndex эталонных файлов.
+    :param threshold: Минимальная оценка сходства по Жаккару с эталонным файлом.
+    :param on_skip: Вызывается как on_skip(file_data, сходство) для отсеянных
+        файлов.
+    """
+    passed = skipped = 0
+    for file_data in files:
+        with metrics.timer('minhash'):
+            signature = minhash_signature(file_data.file_content)
+        if signature is not None:
+            matches = lsh_index.query(signature)
+            similarity = matches[0][1] if matches else 0.0
+            if similarity < threshold:
+                skipped += 1
+                metrics.count_files('prefilter', outcome='skipped')
+                if on_skip is not None:
+                    on_skip(file_data, similarity)
+                continue
+        passed += 1
+        metrics.count_files('prefilter', outcome='passed')
+        yield file_data
+    logger.info(f'LSH: передано модели {passed} файлов, отсеяно {skipped}')
+
+
+def _batched(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def embed_files(
+    files,
+    files_per_batch: int = FILES_PER_BATCH,
+    preprocess=None,
+    on_batch_done=None,
+    on_failed=None,
+):
+    """
+    Считает эмбеддинги чанков для потока файлов.
+
+    Чанки нескольких файлов упаковываются в общие батчи модели.
+
+    :param preprocess: Необязательная функция предобработки кода.
+    :param on_batch_done: Вызывается, когда потребитель обработал все результаты
+        батча (например, CrawlState.commit).
+    :param on_failed: Вызывается с FileData, эмбеддинги которого посчитаны не
+        полностью из-за ошибки модели (например, CrawlState.skip_blob: такой
+        файл не должен считаться обработанным). Вызов происходит до отдачи
+        результатов батча.
+    :return: Генератор пар (FileData, эмбеддинги чанков файла); файлы без
+        эмбеддингов пропускаются.
+    """
+    for batch in _batched(files, files_per_batch):
+        codes = [file_data.file_content for file_data in batch]
+        if preprocess is not None:
+            codes = [preprocess(code) for code in codes]
+
+        failed = []
+        embeddings, refs = embed_code_batch(codes, on_failed=failed.extend)
+        if on_failed is not None:
+            for i in failed:
+                on_failed(batch[i])
+        metrics.count_files(
+            'embed', len(batch), sum(len(file_data.file_content) for file_data in batch)
+        )
+        if embeddings.size != 0:
+            per_file = split_embeddings_by_source(embeddings, refs, len(batch))
+            for file_data, file_embeddings in zip(batch, per_file):
+                if file_embeddings.size != 0:
+                    yield file_data, file_embeddings
+        if on_batch_done is not None:
+            on_batch_done()
+
+
+def score_files(embedded, reference_index, top_k: int = 5, threshold: float = 0.9):
+    """
+    Сравнивает файлы с эталонным индексом.
+
+    :return: Генератор пар (FileData, словарь с результатом анализа файла).
+    """
+    for file_data, embeddings in embedded:
+        with metrics.timer('reference_search'):
+            similarity_score, matches = reference_index.match_files(embeddings, top_k)
+        yield (
+            file_data,
+            {
+                'owner': file_data.owner,
+                'repo_name': file_data.repo_name,
+                'file_name': file_data.file_name,
+                'similarity_score': similarity_score,
+                'matches': matches,
+                'is_malicious': similarity_score > threshold,
+            },
+        )
+
+
+def fit_clusters(embedded, clusterer):
+    """Дообучает потоковую кластеризацию на эмбеддингах проходящих файлов."""
+    for file_data, embeddings in embedded:
+        clusterer.partial_fit(embeddings)
+        yield file_data, embeddings
+
+
+def collect_embeddings(embedded) -> tuple[np.ndarray, list[int], list[str]]:
+    """
+    Собирает эмбеддинги из потока в одну матрицу.
+
+    :return: Матрица эмбеддингов, номер источника для каждой её строки и список
+        источников (owner/repo/file).
+    """
+    blocks = []
+    chunk_sources = []
+    sources = []
+    for file_data, embeddings in embedded:
+        chunk_sources.extend([len(sources)] * len(embeddings))
+        sources.append(f'{file_data.owner}/{file_data.repo_name}/{file_data.file_name}')
+        blocks.append(embeddings)
+
+    if not blocks:
+        return np.array([]), [], []
+    return np.vstack(blocks), chunk_sources, sources
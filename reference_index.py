@@ -0,0 +1,358 @@
+"""
+Эталонный индекс: эмбеддинги чанков эталонного кода и поиск ближайших соседей.
+
+Формат каталога индекса (версия FORMAT_VERSION):
+    meta.json - версия формата, модель, параметры предобработки, размеры и
+        каталог текущей версии индекса (data-{номер});
+    data-{номер}/embeddings.npy - нормированные эмбеддинги чанков (float16 или
+        float32);
+    data-{номер}/chunk_sources.npy - номер исходного файла для каждого чанка;
+    data-{номер}/labels.npy - номер кластера для каждого чанка (необязательно);
+    data-{номер}/centroids.npy - центроиды кластеров (необязательно);
+    data-{номер}/sources.json - имена исходных файлов (owner/repo/path).
+
+Массивы открываются через mmap без копирования, поэтому индекс любого размера
+открывается сразу, а процессы-воркеры делят одни и те же страницы в кэше ОС.
+Каждое сохранение пишет файлы в новый каталог data-{номер}, а на него
+переключает атомарная замена meta.json, поэтому читатель никогда не видит
+файлы разных версий вместе. Предыдущая версия удаляется только следующим
+сохранением: читатель, успевший прочитать прежний meta.json, её ещё откроет.
+"""
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from logging_config import logging
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_INDEX_DIR = 'reference_index'
+# Начиная с этого числа чанков используется HNSW (если установлен hnswlib)
+HNSW_MIN_SIZE = 50_000
+SEARCH_BLOCK_SIZE = 65_536
+FORMAT_VERSION = 3
+META_FILE = 'meta.json'
+DATA_PREFIX = 'data-'
+# Файлы индекса версий 1 и 2, которые хранились прямо в каталоге
+LEGACY_FILES = (
+    'embeddings.npy',
+    'chunk_sources.npy',
+    'labels.npy',
+    'centroids.npy',
+    'sources.json',
+    'hnsw.bin',
+)
+EMBEDDING_DTYPES = ('float16', 'float32')
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _save_atomic(path: str, write):
+    temporary = f'{path}.tmp-{os.getpid()}'
+    with open(temporary, 'wb') as file:
+        write(file)
+    os.replace(temporary, path)
+
+
+def _read_meta(directory: str) -> dict | None:
+    meta_path = os.path.join(directory, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        meta = json.load(file)
+    # До версии 3 файлы индекса лежали прямо в каталоге
+    meta.setdefault('generation', 0)
+    meta.setdefault('data', '.')
+    return meta
+
+
+def _remove_stale_versions(directory: str, meta: dict, previous: str | None):
+    """Удаляет версии индекса, кроме текущей и предыдущей."""
+    keep = {meta['data'], previous}
+    for name in os.listdir(directory):
+        if name.startswith(DATA_PREFIX) and name not in keep:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    if '.' not in keep:
+        for name in LEGACY_FILES:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _load_array(directory: str, name: str, mmap: bool = True):
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+
+def _merge_top_k(scores, indices, k):
+    """Оставляет k лучших (по убыванию score) столбцов в каждой строке."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        indices = np.take_along_axis(indices, part, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return (
+        np.take_along_axis(scores, order, axis=1),
+        np.take_along_axis(indices, order, axis=1),
+    )
+
+
+class ReferenceIndex:
+    """
+    Индекс эмбеддингов эталонных чанков для поиска ближайших соседей.
+
+    Сходство считается как косинусная близость. Для больших наборов
+    используется HNSW (hnswlib), иначе - точный поиск блоками через NumPy.
+    """
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        chunk_sources: np.ndarray,
+        sources: list[str],
+        centroids: np.ndarray | None = None,
+        method: str = 'auto',
+        labels: np.ndarray | None = None,
+        model: str | None = None,
+        preprocessing: dict | None = None,
+        normalized: bool = False,
+    ):
+        """
+        :param embeddings: Матрица эмбеддингов эталонных чанков (n, dim).
+        :param chunk_sources: Номер исходного файла для каждого чанка (n,).
+        :param sources: Имена исходных файлов (owner/repo/path).
+        :param centroids: Центроиды кластеров эталонного набора.
+        :param method: 'auto', 'exact' или 'hnsw'.
+        :param labels: Номер кластера для каждого чанка (n,).
+        :param model: Идентификатор модели, которой посчитаны эмбеддинги.
+        :param preprocessing: Параметры предобработки и разбиения кода на чанки.
+        :param normalized: Эмбеддинги уже нормированы - используются как есть
+            (без копирования, например массив из mmap).
+        """
+        self.embeddings = embeddings if normalized else _normalize(embeddings)
+        self.chunk_sources = (
+            chunk_sources if normalized else np.asarray(chunk_sources, dtype=np.int64)
+        )
+        self.sources = list(sources)
+        self.centroids = centroids
+        self.labels = labels
+        self.model = model
+        self.preprocessing = preprocessing or {}
+        self._hnsw = None
+
+        if method == 'hnsw' and hnswlib is None:
+            logger.warning('hnswlib не установлен, используется точный поиск')
+            method = 'exact'
+        if method == 'auto':
+            use_hnsw = hnswlib is not None and len(self.embeddings) >= HNSW_MIN_SIZE
+            method = 'hnsw' if use_hnsw else 'exact'
+        self.method = method
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    @property
+    def dim(self) -> int:
+        return self.embeddings.shape[1]
+
+    def _blocks(self):
+        # float16 из mmap переводится в float32 поблочно, а не целиком
+        for start in range(0, len(self), SEARCH_BLOCK_SIZE):
+            block = self.embeddings[start : start + SEARCH_BLOCK_SIZE]
+            yield start, block.astype(np.float32, copy=False)
+
+    def _build_hnsw(self):
+        index = hnswlib.Index(space='ip', dim=self.dim)
+        index.init_index(max_elements=len(self), ef_construction=200, M=16)
+        for start, block in self._blocks():
+            index.add_items(block, np.arange(start, start + len(block)))
+        return index
+
+    def _search_exact(self, queries: np.ndarray, k: int):
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_indices = np.full((len(queries), 0), -1, dtype=np.int64)
+        for start, block in self._blocks():
+            scores = queries @ block.T
+            indices = np.broadcast_to(
+                np.arange(start, start + len(block)), scores.shape
+            )
+            best_scores, best_indices = _merge_top_k(
+                np.concatenate([best_scores, scores], axis=1),
+                np.concatenate([best_indices, indices], axis=1),
+                k,
+            )
+        return best_scores, best_indices
+
+    def search(self, queries: np.ndarray, k: int = 5) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ищет k ближайших эталонных чанков для каждого запроса.
+
+        :return: Матрицы косинусной близости и номеров чанков формы (m, k).
+        """
+        queries = _normalize(queries)
+        k = min(k, len(self))
+        if k == 0:
+            empty = np.empty((len(queries), 0))
+            return empty, empty.astype(np.int64)
+
+        if self.method == 'hnsw':
+            if self._hnsw is None:
+                self._hnsw = self._build_hnsw()
+            self._hnsw.set_ef(max(2 * k, 64))
+            labels, distances = self._hnsw.knn_query(queries, k=k)
+            return 1.0 - distances, labels.astype(np.int64)
+        return self._search_exact(queries, k)
+
+    def match_files(
+        self, embeddings: np.ndarray, k: int = 5
+    ) -> tuple[float, list[tuple[str, float]]]:
+        """
+        Сравнивает чанки нового файла с эталонными.
+
+        :param embeddings: Эмбеддинги чанков нового файла.
+        :param k: Число ближайших соседей на чанк и число возвращаемых файлов.
+        :return: Оценка сходства (средняя близость чанков к ближайшему эталонному
+            чанку, от 0 до 1) и k наиболее похожих эталонных файлов с оценками.
+        """
+        if embeddings.size == 0 or len(self) == 0:
+            return 0.0, []
+
+        scores, indices = self.search(embeddings, k)
+        similarity_score = float(np.clip(scores[:, 0], 0.0, 1.0).mean())
+
+        best_per_file = {}
+        for score, index in zip(scores.ravel(), indices.ravel()):
+            if index < 0:
+                continue
+            source = int(self.chunk_sources[index])
+            best_per_file[source] = max(best_per_file.get(source, -1.0), float(score))
+
+        matches = sorted(best_per_file.items(), key=lambda item: item[1], reverse=True)
+        return similarity_score, [
+            (self.sources[source], score) for source, score in matches[:k]
+        ]
+
+    def save(self, directory: str = REFERENCE_INDEX_DIR, dtype: str = 'float32'):
+        """
+        Сохраняет индекс в каталог.
+
+        :param dtype: Тип хранения эмбеддингов: float32 или float16 (вдвое
+            меньше места, точность косинусной близости ~1e-3).
+        """
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f'Неподдерживаемый тип эмбеддингов: {dtype}')
+        os.makedirs(directory, exist_ok=True)
+        previous = _read_meta(directory)
+        generation = previous['generation'] + 1 if previous is not None else 1
+        data = f'{DATA_PREFIX}{generation}'
+        # Каталог новой версии не виден читателям, пока на него не указывает
+        # meta.json; остатки прерванного сохранения с тем же номером удаляются
+        data_path = os.path.join(directory, data)
+        shutil.rmtree(data_path, ignore_errors=True)
+        os.makedirs(data_path)
+
+        def save_array(name, array):
+            with open(os.path.join(data_path, name), 'wb') as file:
+                np.save(file, array)
+
+        save_array('embeddings.npy', np.asarray(self.embeddings).astype(dtype))
+        save_array('chunk_sources.npy', np.asarray(self.chunk_sources, np.int64))
+        for name, array in (
+            ('labels.npy', self.labels),
+            ('centroids.npy', self.centroids),
+        ):
+            if array is not None:
+                save_array(name, np.asarray(array))
+        with open(os.path.join(data_path, 'sources.json'), 'w') as file:
+            json.dump(self.sources, file)
+        if self.method == 'hnsw':
+            if self._hnsw is None:
+                self._hnsw = self._build_hnsw()
+            self._hnsw.save_index(os.path.join(data_path, 'hnsw.bin'))
+
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'generation': generation,
+            'data': data,
+            'model': self.model,
+            'preprocessing': self.preprocessing,
+            'dtype': dtype,
+            'dim': self.dim,
+            'num_chunks': len(self),
+            'num_sources': len(self.sources),
+            'num_clusters': None if self.centroids is None else len(self.centroids),
+        }
+        # Переключение на новую версию - единственная атомарная замена meta.json
+        _save_atomic(
+            os.path.join(directory, META_FILE),
+            lambda file: file.write(json.dumps(meta, indent=2).encode('utf-8')),
+        )
+        _remove_stale_versions(
+            directory, meta, previous['data'] if previous is not None else None
+        )
+
+    @classmethod
+    def load(
+        cls, directory: str = REFERENCE_INDEX_DIR, method: str = 'auto', mmap=True
+    ):
+        """
+        Открывает индекс из каталога.
+
+        Эмбеддинги, номера источников и метки кластеров отображаются в память
+        только для чтения и не копируются.
+
+        :param mmap: False - прочитать массивы в память целиком.
+        """
+        meta = _read_meta(directory)
+        if meta is not None:
+            if meta['format_version'] > FORMAT_VERSION:
+                raise ValueError(
+                    f'Эталонный индекс в {directory} имеет версию формата '
+                    f'{meta["format_version"]}, поддерживается до {FORMAT_VERSION}'
+                )
+            data_path = os.path.join(directory, meta['data'])
+        else:
+            # Индекс первой версии: эмбеддинги могут быть не нормированы
+            logger.warning(f'Эталонный индекс в {directory} без {META_FILE}')
+            meta = {}
+            data_path = directory
+
+        embeddings = _load_array(data_path, 'embeddings.npy', mmap)
+        chunk_sources = _load_array(data_path, 'chunk_sources.npy', mmap)
+        with open(os.path.join(data_path, 'sources.json')) as file:
+            sources = json.load(file)
+
+        index = cls(
+            embeddings,
+            chunk_sources,
+            sources,
+            _load_array(data_path, 'centroids.npy', mmap=False),
+            method=method,
+            labels=_load_array(data_path, 'labels.npy', mmap),
+            model=meta.get('model'),
+            preprocessing=meta.get('preprocessing'),
+            normalized=bool(meta),
+        )
+        hnsw_path = os.path.join(data_path, 'hnsw.bin')
+        if index.method == 'hnsw' and os.path.exists(hnsw_path):
+            index._hnsw = hnswlib.Index(space='ip', dim=index.dim)
+            index._hnsw.load_index(hnsw_path, max_elements=len(index))
+        return index
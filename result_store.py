@@ -0,0 +1,267 @@
+"""
+Дедупликация файлов по хешу содержимого.
+
+Популярные файлы (вендоренные библиотеки, шаблоны setup.py, одинаковые
+дропперы) встречаются во многих репозиториях. Результат анализа сохраняется
+по SHA-256 содержимого, и копии файла получают его из хранилища без повторного
+анализа; для каждого содержимого запоминаются все места, где оно встретилось.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+RESULT_STORE_FILE = 'result_store.sqlite3'
+# Поля результата, описывающие место файла, а не его содержимое
+LOCATION_FIELDS = ('owner', 'repo_name', 'file_name')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    content_hash TEXT NOT NULL,
+    analysis TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (content_hash, analysis)
+);
+CREATE TABLE IF NOT EXISTS locations (
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (owner, repo, path, file_name)
+);
+CREATE INDEX IF NOT EXISTS locations_by_hash ON locations (content_hash);
+"""
+
+
+def content_hash(file_data) -> str:
+    """SHA-256 исходных байтов файла (или текста, если байты не сохранены)."""
+    data = file_data.raw_content
+    if data is None:
+        data = file_data.file_content.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _location(file_data) -> tuple[str, str, str, str]:
+    # Для файлов из архива path - путь архива, file_name - путь внутри него
+    return (
+        file_data.owner,
+        file_data.repo_name,
+        file_data.path or '',
+        file_data.file_name,
+    )
+
+
+def _format_location(owner: str, repo: str, path: str, file_name: str) -> str:
+    if not path:
+        return f'{owner}/{repo}/{file_name}'
+    if os.path.basename(path) == file_name:
+        return f'{owner}/{repo}/{path}'
+    return f'{owner}/{repo}/{path}:{file_name}'
+
+
+def _location_result(result: dict, file_data) -> dict:
+    return {
+        **result,
+        'owner': file_data.owner,
+        'repo_name': file_data.repo_name,
+        'file_name': file_data.file_name,
+    }
+
+
+class ResultStore:
+    """
+    Результаты анализа по хешу содержимого и места, где встретились файлы.
+
+    :param analysis: Вид анализа; результаты разных видов (или одного вида с
+        разными параметрами) хранятся независимо.
+    """
+
+    def __init__(self, path: str = RESULT_STORE_FILE, analysis: str = 'default'):
+        self.path = path
+        self.analysis = analysis
+        # Хранилище может быть общим для нескольких воркеров сканирования
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            columns = [
+                row[1]
+                for row in self._connection.execute('PRAGMA table_info(locations)')
+            ]
+            if columns and 'path' not in columns:
+                # Места без пути: одноимённые файлы из разных каталогов
+                # затирали друг друга, такой отчёт строится заново
+                self._connection.execute('DROP TABLE locations')
+            self._connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, query: str, params=()):
+        with self._lock, self._connection:
+            return self._connection.execute(query, params).fetchall()
+
+    def get(self, key: str) -> dict | None:
+        rows = self._execute(
+            'SELECT result FROM verdicts WHERE content_hash=? AND analysis=?',
+            (key, self.analysis),
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def put(self, key: str, result: dict):
+        """Сохраняет результат для содержимого (без полей места файла)."""
+        result = {
+            name: value for name, value in result.items() if name not in LOCATION_FIELDS
+        }
+        self._execute(
+            'INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)',
+            (key, self.analysis, json.dumps(result), time.time()),
+        )
+
+    def add_location(self, key: str, file_data):
+        self._execute(
+            'INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?)',
+            (*_location(file_data), key),
+        )
+
+    def locations(self, key: str) -> list[tuple[str, str, str, str]]:
+        """
+        Места (owner, repo, path, file_name), где встретилось содержимое; path
+        пуст, если путь файла неизвестен.
+        """
+        return self._execute(
+            'SELECT owner, repo, path, file_name FROM locations WHERE content_hash=? '
+            'ORDER BY owner, repo, path, file_name',
+            (key,),
+        )
+
+    def duplicates(self) -> list[dict]:
+        """
+        Содержимое, встретившееся более чем в одном месте.
+
+        :return: Словари с хешем, результатом анализа (если он есть) и списком
+            мест, по убыванию числа копий.
+        """
+        rows = self._execute(
+            'SELECT locations.content_hash, COUNT(*) AS copies, verdicts.result '
+            'FROM locations LEFT JOIN verdicts '
+            'ON verdicts.content_hash = locations.content_hash AND analysis = ? '
+            'GROUP BY locations.content_hash HAVING copies > 1 '
+            'ORDER BY copies DESC, locations.content_hash',
+            (self.analysis,),
+        )
+        return [
+            {
+                'content_hash': key,
+                'copies': copies,
+                'result': json.loads(result) if result is not None else None,
+                'locations': [
+                    _format_location(*location) for location in self.locations(key)
+                ],
+            }
+            for key, copies, result in rows
+        ]
+
+
+class Deduplicator:
+    """
+    Пара этапов конвейера анализа: filter пропускает к анализу только первую
+    копию каждого содержимого, resolve после её анализа сохраняет результат и
+    отдаёт его для копий.
+
+    Копии, результат для которых уже есть в хранилище, передаются в
+    on_duplicate сразу; копии содержимого, которое ещё анализируется,
+    выдаются resolve сразу после оригинала. Если оригинал не получил
+    результата, его копии передаются в on_failed.
+    """
+
+    def __init__(self, store: ResultStore, on_duplicate=None, on_failed=None):
+        """
+        :param on_duplicate: Вызывается как on_duplicate(FileData, результат)
+            для копий с уже известным результатом.
+        :param on_failed: Вызывается с FileData файлов, анализ которых не
+            удался (см. fail), и их копий (например, CrawlState.skip_blob).
+        """
+        self.store = store
+        self.on_duplicate = on_duplicate
+        self.on_failed = on_failed
+        self.skipped = 0
+        self._keys = {}  # место файла -> хеш для файлов, ушедших на анализ
+        self._waiting = {}  # хеш -> копии, ждущие результата оригинала
+
+    def filter(self, files):
+        """Отдаёт файлы, содержимое которых нужно проанализировать."""
+        for file_data in files:
+            key = content_hash(file_data)
+            self.store.add_location(key, file_data)
+            if key in self._waiting:
+                self._waiting[key].append(file_data)
+                self.skipped += 1
+                metrics.count_files('dedup', outcome='duplicate')
+                continue
+            result = self.store.get(key)
+            if result is not None:
+                self.skipped += 1
+                metrics.count_files('dedup', outcome='duplicate')
+                if self.on_duplicate is not None:
+                    self.on_duplicate(file_data, _location_result(result, file_data))
+                continue
+            self._waiting[key] = []
+            self._keys[_location(file_data)] = key
+            metrics.count_files('dedup', outcome='unique')
+            yield file_data
+
+    def fail(self, file_data):
+        """
+        Отмечает, что анализ файла не удался (например, on_failed конвейера):
+        файл и ждущие его результата копии передаются в on_failed, а
+        следующая копия содержимого снова уйдёт на анализ.
+        """
+        key = self._keys.pop(_location(file_data), None)
+        copies = self._waiting.pop(key, []) if key is not None else []
+        if self.on_failed is not None:
+            for failed in (file_data, *copies):
+                self.on_failed(failed)
+
+    def resolve(self, results):
+        """
+        Сохраняет результаты анализа в хранилище.
+
+        :param results: Поток пар (FileData, результат) после анализа.
+        :return: Тот же поток, дополненный парами для копий, ждавших результата.
+        """
+        for file_data, result in results:
+            key = self._keys.pop(_location(file_data), None)
+            yield file_data, result
+            if key is None:
+                continue
+            self.store.put(key, result)
+            for duplicate in self._waiting.pop(key, ()):
+                yield duplicate, _location_result(result, duplicate)
+        # Оригиналы без результата (например, без эмбеддингов): их копии тоже
+        # не проанализированы
+        if self.on_failed is not None:
+            for copies in self._waiting.values():
+                for duplicate in copies:
+                    self.on_failed(duplicate)
+        self._waiting.clear()
+        self._keys.clear()
+
+
+if __name__ == '__main__':
+    # python result_store.py [analysis] - отчёт о дубликатах в формате JSON
+    store = ResultStore(analysis=sys.argv[1] if len(sys.argv) > 1 else 'default')
+    json.dump(store.duplicates(), sys.stdout, ensure_ascii=False, indent=2)
+    print()
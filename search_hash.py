@@ -1,29 +1,131 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 import hashlib
+
+import metrics
 from logging_config import logging
 
+try:
+    import tlsh
+except ImportError:
+    tlsh = None
+
+try:
+    import ssdeep
+except ImportError:
+    ssdeep = None
+
 logger = logging.getLogger(__name__)
 
+# Тип хеша -> столбец базы MalwareBazaar и размер дайджеста в байтах
+HASH_COLUMNS = {'sha256': 'sha256_hash', 'md5': 'md5_hash', 'sha1': 'sha1_hash'}
+DIGEST_SIZES = {'sha256': 32, 'md5': 16, 'sha1': 20}
+
+HASH_DB_DIR = 'hash_db'
+HASH_DB_VERSION = 1
+CSV_CHUNK_SIZE = 200_000
+# Ограничение SQLite на число параметров запроса
+SQLITE_MAX_PARAMS = 900
+
+# Размер блока, которым данные передаются всем хешерам за один проход
+HASH_CHUNK_SIZE = 1024 * 1024
+# С этого числа файлов хеши считаются в пуле потоков (hashlib отпускает GIL)
+PARALLEL_HASH_MIN_FILES = 8
+
+# Нечёткие хеши равны None, если не запрошены или библиотека не установлена
+FileHashes = namedtuple(
+    'FileHashes', ['sha256', 'md5', 'sha1', 'tlsh', 'ssdeep'], defaults=(None, None)
+)
+
 
 def get_file_hash(file_content, hash_type='sha256'):
     """
     Генерирует хеш для содержимого файла.
 
-    :param file_content: Содержимое файла.
+    :param file_content: Содержимое файла (bytes или str, который кодируется
+        в UTF-8).
     :param hash_type: Тип хеша ('sha256', 'md5', 'sha1').
     :return: Строка с хешем файла.
     """
-    if hash_type == 'sha256':
-        hasher = hashlib.sha256()
-    elif hash_type == 'md5':
-        hasher = hashlib.md5()
-    elif hash_type == 'sha1':
-        hasher = hashlib.sha1()
-    else:
+    if hash_type not in HASH_COLUMNS:
         raise ValueError('Неизвестный тип хеша')
+    return getattr(get_file_hashes(file_content), hash_type)
+
+
+def _iter_chunks(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        view = memoryview(data)
+        for start in range(0, len(view), HASH_CHUNK_SIZE):
+            yield view[start : start + HASH_CHUNK_SIZE]
+        return
+    while chunk := data.read(HASH_CHUNK_SIZE):
+        yield chunk
+
+
+def get_file_hashes(data, fuzzy: bool = False) -> FileHashes:
+    """
+    Считает sha256, md5 и sha1 (и, по запросу, TLSH и ssdeep) за один проход.
+
+    :param data: Исходные байты файла, str (кодируется в UTF-8) или бинарный
+        файловый объект, который читается блоками.
+    :param fuzzy: Считать нечёткие хеши TLSH и ssdeep (если библиотеки
+        установлены).
+    :return: FileHashes с hex-строками хешей.
+    """
+    hashers = [hashlib.sha256(), hashlib.md5(), hashlib.sha1()]
+    tlsh_hasher = tlsh.Tlsh() if fuzzy and tlsh is not None else None
+    ssdeep_hasher = ssdeep.Hash() if fuzzy and ssdeep is not None else None
+
+    for chunk in _iter_chunks(data):
+        for hasher in hashers:
+            hasher.update(chunk)
+        if tlsh_hasher is not None:
+            tlsh_hasher.update(bytes(chunk))
+        if ssdeep_hasher is not None:
+            ssdeep_hasher.update(bytes(chunk))
+
+    tlsh_digest = None
+    if tlsh_hasher is not None:
+        try:
+            tlsh_hasher.final()
+            tlsh_digest = tlsh_hasher.hexdigest()
+        except ValueError:
+            pass  # TLSH не определён для слишком коротких или однородных данных
+    return FileHashes(
+        *(hasher.hexdigest() for hasher in hashers),
+        tlsh=tlsh_digest,
+        ssdeep=ssdeep_hasher.digest() if ssdeep_hasher is not None else None,
+    )
+
+
+def hash_files(contents, fuzzy: bool = False, workers: int | None = None):
+    """
+    Считает хеши для списка файлов, для больших списков - в пуле потоков.
 
-    hasher.update(file_content.encode('utf-8'))
-    return hasher.hexdigest()
+    :param contents: Список содержимого файлов (см. get_file_hashes).
+    :param workers: Число потоков (по умолчанию выбирает ThreadPoolExecutor).
+    :return: Список FileHashes в том же порядке.
+    """
+    metrics.count_files(
+        'hash', len(contents), sum(len(data) for data in contents if data is not None)
+    )
+    with metrics.timer('hash'):
+        if len(contents) < PARALLEL_HASH_MIN_FILES or workers == 1:
+            return [get_file_hashes(data, fuzzy) for data in contents]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(
+                executor.map(lambda data: get_file_hashes(data, fuzzy), contents)
+            )
 
 
 def load_csv_to_dataframe(file_path):
@@ -57,3 +159,376 @@ def search_hash_in_dataset(df, hash_value, hash_type='sha256_hash'):
     else:
         logger.warning('DataFrame пустой или не содержит указанного столбца хеша.')
         return None
+
+
+def _to_digests(hash_values, size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Переводит hex-строки хешей в массив двоичных дайджестов фиксированной длины.
+
+    Пробелы, кавычки и регистр игнорируются (в выгрузке MalwareBazaar значения
+    могут содержать пробел после разделителя).
+
+    :return: Массив дайджестов dtype S{size} и маска корректных значений.
+    """
+    digests = np.zeros(len(hash_values), dtype=f'S{size}')
+    valid = np.zeros(len(hash_values), dtype=bool)
+    for i, value in enumerate(hash_values):
+        if not isinstance(value, str):
+            continue
+        try:
+            digest = bytes.fromhex(value.strip().strip('"'))
+        except ValueError:
+            continue
+        if len(digest) == size:
+            digests[i] = digest
+            valid[i] = True
+    return digests, valid
+
+
+class HashIndex:
+    """
+    Индекс хешей базы вредоносного ПО.
+
+    Для каждого типа хеша хранится отсортированный массив двоичных дайджестов
+    и номера соответствующих строк DataFrame, поэтому поиск выполняется
+    бинарным поиском (searchsorted), а не полным просмотром столбца.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._digests = {}
+        self._rows = {}
+        for hash_type, column in HASH_COLUMNS.items():
+            if column not in df.columns:
+                logger.warning(f'В базе нет столбца {column}')
+                continue
+            digests, valid = _to_digests(df[column].tolist(), DIGEST_SIZES[hash_type])
+            rows = np.flatnonzero(valid)
+            order = np.argsort(digests[rows], kind='stable')
+            self._digests[hash_type] = digests[rows][order]
+            self._rows[hash_type] = rows[order]
+        logger.info(f'Построен индекс хешей для {len(df)} записей')
+
+    def _get_rows(self, rows: np.ndarray) -> pd.DataFrame:
+        return self.df.iloc[rows]
+
+    def find_rows(self, hash_values, hash_type: str = 'sha256') -> list[np.ndarray]:
+        """
+        Пакетный поиск хешей одного типа.
+
+        :param hash_values: Список hex-строк хешей.
+        :param hash_type: Тип хеша ('sha256', 'md5', 'sha1').
+        :return: Для каждого хеша - массив номеров строк DataFrame, где он найден.
+        """
+        if hash_type not in DIGEST_SIZES:
+            raise ValueError('Неизвестный тип хеша')
+        empty = np.empty(0, dtype=np.int64)
+        hash_values = list(hash_values)
+        metrics.inc('nir_hash_queries_total', len(hash_values), hash_type=hash_type)
+        if hash_type not in self._digests:
+            return [empty for _ in hash_values]
+
+        queries, valid = _to_digests(hash_values, DIGEST_SIZES[hash_type])
+        digests = self._digests[hash_type]
+        with metrics.timer('hash_lookup', hash_type=hash_type):
+            left = np.searchsorted(digests, queries, side='left')
+            right = np.searchsorted(digests, queries, side='right')
+        rows = self._rows[hash_type]
+        return [
+            rows[start:end] if is_valid else empty
+            for start, end, is_valid in zip(left, right, valid)
+        ]
+
+    def search_many(
+        self, hash_values, hash_type: str = 'sha256'
+    ) -> dict[str, pd.DataFrame]:
+        """
+        Пакетный поиск хешей одного типа.
+
+        :return: Словарь {хеш: найденные строки DataFrame} только для найденных хешей.
+        """
+        return {
+            hash_value: self._get_rows(rows)
+            for hash_value, rows in zip(
+                hash_values, self.find_rows(hash_values, hash_type)
+            )
+            if len(rows)
+        }
+
+    def search(self, hash_value: str, hash_type: str = 'sha256') -> pd.DataFrame:
+        """
+        Ищет один хеш.
+
+        :return: Строки DataFrame, где найден хеш (возможно, пустые).
+        """
+        (rows,) = self.find_rows([hash_value], hash_type)
+        return self._get_rows(rows)
+
+
+def _clean_column(name: str) -> str:
+    # Заголовок выгрузки MalwareBazaar закомментирован: # "first_seen_utc", ...
+    return name.strip().lstrip('#').strip().strip('"')
+
+
+def _read_dataset_chunks(csv_path: str):
+    reader = pd.read_csv(
+        csv_path,
+        quotechar='"',
+        skipinitialspace=True,
+        on_bad_lines='warn',
+        dtype=str,
+        chunksize=CSV_CHUNK_SIZE,
+    )
+    for chunk in reader:
+        chunk.columns = [_clean_column(column) for column in chunk.columns]
+        # Строки-комментарии (например, итоговое число записей в конце файла)
+        comments = chunk.iloc[:, 0].fillna('').str.startswith('#')
+        yield chunk[~comments]
+
+
+def _load_meta(directory: str) -> dict | None:
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        meta = json.load(file)
+    # Базы, построенные до появления сборок, хранят всё прямо в каталоге
+    meta.setdefault('generation', 0)
+    meta.setdefault('arrays', '.')
+    meta.setdefault('metadata', 'metadata.sqlite3')
+    return meta
+
+
+def _remove_stale_builds(directory: str, meta: dict):
+    """Удаляет файлы сборок, на которые больше не ссылается meta.json."""
+    legacy = {f'{hash_type}.npy' for hash_type in HASH_COLUMNS} | {
+        f'{hash_type}_rows.npy' for hash_type in HASH_COLUMNS
+    }
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith('arrays-') and name != meta['arrays']:
+            shutil.rmtree(path, ignore_errors=True)
+        elif name.startswith('metadata') and not name.startswith(meta['metadata']):
+            os.remove(path)
+        elif name in legacy and meta['arrays'] != '.':
+            os.remove(path)
+
+
+def build_hash_database(
+    csv_path: str, directory: str = HASH_DB_DIR, append: bool = True
+) -> int:
+    """
+    Конвертирует CSV-выгрузку базы вредоносного ПО в двоичную базу хешей.
+
+    Для каждого типа хеша сохраняются отсортированный массив дайджестов
+    фиксированной длины ({тип}.npy) и номера записей ({тип}_rows.npy); остальные
+    столбцы записей хранятся в SQLite-базе metadata-*.sqlite3. При append=True
+    новые записи дописываются в существующую базу, уже известные sha256
+    пропускаются.
+
+    Каждая конвертация пишет массивы в новый каталог arrays-{номер сборки}, а
+    meta.json указывает на текущую сборку и заменяется последним, поэтому
+    прерванная конвертация оставляет прежнюю базу целой.
+
+    :param csv_path: Путь к CSV файлу (full.csv или более свежая выгрузка).
+    :param directory: Каталог базы.
+    :param append: Дописать в существующую базу, иначе построить заново.
+    :return: Число добавленных записей.
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta = _load_meta(directory)
+    generation = meta['generation'] + 1 if meta is not None else 1
+    arrays = f'arrays-{generation}'
+    if append and meta is not None:
+        if meta['version'] != HASH_DB_VERSION:
+            raise ValueError(f'Неподдерживаемая версия базы хешей: {meta["version"]}')
+        count = meta['count']
+        # Новые записи дописываются в ту же SQLite-базу: текущая сборка
+        # ссылается только на записи с row_id < count
+        metadata = meta['metadata']
+        old_digests = {
+            hash_type: np.load(
+                os.path.join(directory, meta['arrays'], f'{hash_type}.npy')
+            )
+            for hash_type in HASH_COLUMNS
+        }
+        old_rows = {
+            hash_type: np.load(
+                os.path.join(directory, meta['arrays'], f'{hash_type}_rows.npy')
+            )
+            for hash_type in HASH_COLUMNS
+        }
+    else:
+        count = 0
+        metadata = f'metadata-{generation}.sqlite3'
+        old_digests = {
+            hash_type: np.empty(0, dtype=f'S{size}')
+            for hash_type, size in DIGEST_SIZES.items()
+        }
+        old_rows = {
+            hash_type: np.empty(0, dtype=np.int64) for hash_type in HASH_COLUMNS
+        }
+        # Остатки прерванной сборки с тем же номером
+        for suffix in ('', '-journal'):
+            if os.path.exists(os.path.join(directory, metadata + suffix)):
+                os.remove(os.path.join(directory, metadata + suffix))
+
+    connection = sqlite3.connect(os.path.join(directory, metadata))
+    with connection:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS samples '
+            '(row_id INTEGER PRIMARY KEY, data TEXT NOT NULL)'
+        )
+        # Записи, оставшиеся от прерванной конвертации
+        connection.execute('DELETE FROM samples WHERE row_id >= ?', (count,))
+
+    logger.info(f'Конвертирую {csv_path} в базу хешей {directory}...')
+    new_digests = {hash_type: [] for hash_type in HASH_COLUMNS}
+    new_rows = {hash_type: [] for hash_type in HASH_COLUMNS}
+    seen_sha256 = set()
+    added = 0
+    for chunk in _read_dataset_chunks(csv_path):
+        digests = {}
+        for hash_type, column in HASH_COLUMNS.items():
+            values = chunk[column].tolist() if column in chunk.columns else []
+            if len(values) != len(chunk):
+                values = [None] * len(chunk)
+            digests[hash_type] = _to_digests(values, DIGEST_SIZES[hash_type])
+
+        # Пропускаем записи, чей sha256 уже есть в базе или встречался выше
+        sha256, sha256_valid = digests['sha256']
+        known = old_digests['sha256']
+        is_new = ~sha256_valid
+        if len(known):
+            positions = np.searchsorted(known, sha256).clip(max=len(known) - 1)
+            is_new |= known[positions] != sha256
+        else:
+            is_new[:] = True
+        for i in np.flatnonzero(is_new & sha256_valid):
+            if sha256[i] in seen_sha256:
+                is_new[i] = False
+            else:
+                seen_sha256.add(sha256[i])
+
+        keep = np.flatnonzero(is_new)
+        row_ids = np.arange(count + added, count + added + len(keep))
+        records = chunk.iloc[keep].to_dict(orient='records')
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO samples VALUES (?, ?)',
+                (
+                    (int(row_id), json.dumps(record))
+                    for row_id, record in zip(row_ids, records)
+                ),
+            )
+        for hash_type, (values, valid) in digests.items():
+            valid = valid[keep]
+            new_digests[hash_type].append(values[keep][valid])
+            new_rows[hash_type].append(row_ids[valid])
+        added += len(keep)
+
+    connection.close()
+
+    # Массивы новой сборки пишутся в отдельный каталог; текущая сборка при
+    # этом не меняется и остаётся рабочей, если конвертация прервётся
+    arrays_path = os.path.join(directory, arrays)
+    shutil.rmtree(arrays_path, ignore_errors=True)
+    os.makedirs(arrays_path)
+    for hash_type in HASH_COLUMNS:
+        digests = np.concatenate([old_digests[hash_type], *new_digests[hash_type]])
+        rows = np.concatenate([old_rows[hash_type], *new_rows[hash_type]])
+        order = np.argsort(digests, kind='stable')
+        np.save(os.path.join(arrays_path, f'{hash_type}.npy'), digests[order])
+        np.save(
+            os.path.join(arrays_path, f'{hash_type}_rows.npy'),
+            rows[order].astype(np.int64),
+        )
+
+    # Переключение на новую сборку - единственная атомарная замена meta.json
+    meta = {
+        'version': HASH_DB_VERSION,
+        'count': count + added,
+        'generation': generation,
+        'arrays': arrays,
+        'metadata': metadata,
+    }
+    meta_path = os.path.join(directory, 'meta.json')
+    with open(meta_path + '.tmp', 'w') as file:
+        json.dump(meta, file)
+    os.replace(meta_path + '.tmp', meta_path)
+    _remove_stale_builds(directory, meta)
+    logger.info(f'Добавлено записей: {added}, всего в базе: {count + added}')
+    return added
+
+
+class HashDatabase(HashIndex):
+    """
+    Двоичная база хешей, построенная build_hash_database.
+
+    Массивы дайджестов отображаются в память (mmap), поэтому база открывается
+    быстро и не загружается в память целиком.
+    """
+
+    def __init__(self, directory: str = HASH_DB_DIR):
+        self.directory = directory
+        meta = _load_meta(directory)
+        if meta is None:
+            raise FileNotFoundError(f'База хешей {directory} не найдена')
+        if meta['version'] != HASH_DB_VERSION:
+            raise ValueError(f'Неподдерживаемая версия базы хешей: {meta["version"]}')
+        self.count = meta['count']
+        self._digests = {}
+        self._rows = {}
+        arrays = os.path.join(directory, meta['arrays'])
+        for hash_type in HASH_COLUMNS:
+            self._digests[hash_type] = np.load(
+                os.path.join(arrays, f'{hash_type}.npy'), mmap_mode='r'
+            )
+            self._rows[hash_type] = np.load(
+                os.path.join(arrays, f'{hash_type}_rows.npy'), mmap_mode='r'
+            )
+        self._connection = sqlite3.connect(
+            os.path.join(directory, meta['metadata']), check_same_thread=False
+        )
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _get_rows(self, rows: np.ndarray) -> pd.DataFrame:
+        row_ids = [int(row) for row in rows]
+        records = {}
+        for start in range(0, len(row_ids), SQLITE_MAX_PARAMS):
+            batch = row_ids[start : start + SQLITE_MAX_PARAMS]
+            placeholders = ', '.join('?' * len(batch))
+            records.update(
+                self._connection.execute(
+                    f'SELECT row_id, data FROM samples WHERE row_id IN ({placeholders})',
+                    batch,
+                ).fetchall()
+            )
+        return pd.DataFrame(
+            [json.loads(records[row_id]) for row_id in row_ids], index=row_ids
+        )
+
+
+def load_hash_index(csv_path: str = 'full.csv', directory: str = HASH_DB_DIR):
+    """
+    Открывает двоичную базу хешей, при первом запуске конвертируя в неё CSV.
+
+    :return: HashDatabase или None, если базу не удалось открыть.
+    """
+    try:
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            build_hash_database(csv_path, directory, append=False)
+        database = HashDatabase(directory)
+        logger.info(f'Открыта база хешей: {len(database)} записей')
+        return database
+    except Exception as e:
+        logger.error(f'Ошибка при загрузке базы хешей {directory}: {e}')
+        return None
+
+
+if __name__ == '__main__':
+    # Дописывает в базу хешей переданные выгрузки: python search_hash.py full.csv
+    for path in sys.argv[1:] or ['full.csv']:
+        build_hash_database(path)
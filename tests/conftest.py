@@ -0,0 +1,18 @@
+"""
+Общая настройка тестов.
+
+Токены GitHub (source.py) тестам не нужны: если модуля нет, подкладывается
+заглушка. Это файл, а не запись в sys.modules, чтобы его видели и процессы,
+запущенные через spawn.
+"""
+
+import importlib.machinery
+import os
+import sys
+import tempfile
+
+if importlib.machinery.PathFinder.find_spec('source', sys.path) is None:
+    _directory = tempfile.mkdtemp(prefix='nir-tests-')
+    with open(os.path.join(_directory, 'source.py'), 'w') as file:
+        file.write("TOKEN = ''\n")
+    sys.path.insert(0, _directory)
@@ -0,0 +1,136 @@
+"""
+Локальный HTTP-сервер с подмножеством GitHub API для тестов без сети и
+токенов: листинги каталогов (contents), загрузка файлов и архивы
+репозиториев (tarball, zipball).
+"""
+
+import hashlib
+import http.server
+import io
+import json
+import re
+import tarfile
+import threading
+import zipfile
+
+
+class GitHubServer:
+    """
+    Репозитории владельца owner в виде {имя: {путь: содержимое}}.
+
+    :param errors: Код ответа для отдельных запросов: {(репозиторий, каталог): код}
+        для листингов и {(репозиторий, 'tarball' или 'zipball'): код} для архивов.
+    """
+
+    def __init__(
+        self,
+        owner: str,
+        repositories: dict[str, dict[str, bytes]],
+        errors: dict | None = None,
+    ):
+        self.owner = owner
+        self.repositories = repositories
+        self.errors = errors or {}
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), self._handler()
+        )
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def listing(self, repo: str, directory: str) -> list[dict] | None:
+        entries = {}
+        prefix = f'{directory}/' if directory else ''
+        for path in self.repositories.get(repo, {}):
+            if path.startswith(prefix):
+                name, _, rest = path[len(prefix) :].partition('/')
+                entries[name] = 'dir' if rest else 'file'
+        if not entries:
+            return None
+        items = []
+        for name, kind in sorted(entries.items()):
+            path = prefix + name
+            content = self.repositories[repo].get(path, b'')
+            items.append(
+                {
+                    'name': name,
+                    'path': path,
+                    'type': kind,
+                    'sha': hashlib.sha1(content + path.encode()).hexdigest(),
+                    'download_url': f'{self.url}/raw/{repo}/{path}'
+                    if kind == 'file'
+                    else None,
+                }
+            )
+        return items
+
+    def archive(self, repo: str, archive_format: str) -> bytes | None:
+        """Архив репозитория с корневым каталогом {owner}-{repo}-{sha}/, как у GitHub."""
+        if repo not in self.repositories:
+            return None
+        root = f'{self.owner}-{repo}-0123abc'
+        buffer = io.BytesIO()
+        if archive_format == 'tarball':
+            with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+                for path, content in sorted(self.repositories[repo].items()):
+                    info = tarfile.TarInfo(f'{root}/{path}')
+                    info.size = len(content)
+                    archive.addfile(info, io.BytesIO(content))
+        else:
+            with zipfile.ZipFile(buffer, 'w') as archive:
+                for path, content in sorted(self.repositories[repo].items()):
+                    archive.writestr(f'{root}/{path}', content)
+        return buffer.getvalue()
+
+    def _handler(self):
+        server = self
+        contents = re.compile(
+            rf'^/repos/{re.escape(self.owner)}/([^/]+)/contents/?(.*)$'
+        )
+        archives = re.compile(
+            rf'^/repos/{re.escape(self.owner)}/([^/]+)/(tarball|zipball)$'
+        )
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, body = 404, b''
+                match = contents.match(self.path)
+                archive = archives.match(self.path)
+                if archive:
+                    if archive.groups() in server.errors:
+                        status = server.errors[archive.groups()]
+                    else:
+                        body = server.archive(*archive.groups())
+                        status, body = (404, b'') if body is None else (200, body)
+                elif match:
+                    repo = match.group(1)
+                    directory = re.sub('/+', '/', match.group(2)).strip('/')
+                    if (repo, directory) in server.errors:
+                        status = server.errors[repo, directory]
+                    else:
+                        items = server.listing(repo, directory)
+                        if items is not None:
+                            status, body = 200, json.dumps(items).encode()
+                elif self.path.startswith('/raw/'):
+                    repo, _, path = self.path[5:].partition('/')
+                    if path in server.repositories.get(repo, {}):
+                        status, body = 200, server.repositories[repo][path]
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,172 @@
+"""
+Потоковая распаковка архивов: вложенные архивы и ограничения, защищающие от
+архивных бомб (глубина, размер файла, общий объём, число файлов, коэффициент
+сжатия).
+"""
+
+import io
+import tarfile
+import zipfile
+
+import py7zr
+import pytest
+
+from archive_extraction import (
+    DEFAULT_LIMITS,
+    RATIO_MIN_SIZE,
+    ArchiveLimitError,
+    ArchiveLimits,
+    iter_archive,
+)
+
+# Сжимается примерно в тысячу раз
+BOMB_SIZE = 8 * RATIO_MIN_SIZE
+
+
+def _zip(files: dict[str, bytes]) -> bytes:
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return output.getvalue()
+
+
+def _tar(files: dict[str, bytes], compression: str = '') -> bytes:
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode=f'w:{compression}') as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return output.getvalue()
+
+
+def _7z(files: dict[str, bytes]) -> bytes:
+    output = io.BytesIO()
+    with py7zr.SevenZipFile(output, 'w') as archive:
+        for name, data in files.items():
+            archive.writestr(data, name)
+    return output.getvalue()
+
+
+class _Stream(io.RawIOBase):
+    """Поток без перемотки, как ответ HTTP."""
+
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self._data.readinto(buffer)
+
+
+def _names(members) -> list[str]:
+    return [member.name for member in members]
+
+
+@pytest.fixture
+def nested() -> bytes:
+    deep = _zip({'c.txt': b'level three\n'})
+    inner = _tar({'b.txt': b'level two\n', 'deep.zip': deep})
+    return _zip({'a.txt': b'level one\n', 'inner.tar': inner})
+
+
+@pytest.mark.parametrize(
+    'max_depth, expected',
+    [
+        (1, ['a.txt']),
+        (2, ['a.txt', 'inner.tar/b.txt']),
+        (3, ['a.txt', 'inner.tar/b.txt', 'inner.tar/deep.zip/c.txt']),
+    ],
+)
+def test_nested_archives_up_to_depth(nested, max_depth, expected):
+    limits = DEFAULT_LIMITS._replace(max_depth=max_depth)
+    members = list(iter_archive(nested, 'outer.zip', limits=limits))
+
+    assert _names(members) == expected
+    assert all(member.is_text for member in members)
+    assert members[-1].data.startswith(b'level')
+
+
+def test_nested_7z_archive():
+    inner = _7z({'src/main.py': b'print(1)\n', 'blob.bin': b'\x00\x01' * 100})
+    members = list(iter_archive(_zip({'bundle.7z': inner}), 'outer.zip'))
+
+    assert sorted(_names(members)) == ['bundle.7z/blob.bin', 'bundle.7z/src/main.py']
+    assert {member.name: member.is_text for member in members} == {
+        'bundle.7z/src/main.py': True,
+        'bundle.7z/blob.bin': False,
+    }
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_compression_ratio_stops_tar_bomb(stream):
+    archive = _tar(
+        {'readme.txt': b'hello\n', 'zeros.bin': bytes(BOMB_SIZE)}, compression='gz'
+    )
+    assert len(archive) * DEFAULT_LIMITS.max_ratio < BOMB_SIZE
+
+    source = _Stream(archive) if stream else archive
+    members = iter_archive(source, 'bomb.tar.gz', archive_type='tar')
+    # Файлы до превышения ограничения уже отданы и корректны
+    assert next(members).data == b'hello\n'
+    with pytest.raises(ArchiveLimitError):
+        next(members)
+
+
+def test_zip_bomb_member_is_skipped():
+    archive = _zip({'zeros.bin': bytes(BOMB_SIZE), 'main.py': b'x = 1\n'})
+
+    assert _names(iter_archive(archive, 'bomb.zip')) == ['main.py']
+
+
+def test_nested_zip_bomb_is_skipped():
+    # Каждый уровень в отдельности сжат умеренно
+    inner = _zip({f'zeros{i}.bin': bytes(BOMB_SIZE) for i in range(4)})
+    archive = _zip({'layer.zip': inner, 'main.py': b'x = 1\n'})
+
+    assert _names(iter_archive(archive, 'bomb.zip')) == ['main.py']
+
+
+@pytest.mark.parametrize('make', [_zip, _tar, _7z])
+def test_member_size_limit_skips_file(make):
+    archive = make({'big.txt': b'a' * 2000, 'small.txt': b'b' * 10})
+    limits = DEFAULT_LIMITS._replace(max_member_size=1000)
+
+    members = list(iter_archive(archive, 'archive', limits=limits))
+
+    assert _names(members) == ['small.txt']
+
+
+def test_total_size_limit():
+    files = {f'file{i}.txt': b'x' * 1000 for i in range(5)}
+    limits = ArchiveLimits(max_total_size=2500, max_ratio=None)
+
+    members = iter_archive(_zip(files), 'archive.zip', limits=limits)
+    assert _names([next(members), next(members)]) == ['file0.txt', 'file1.txt']
+    with pytest.raises(ArchiveLimitError):
+        next(members)
+
+    # 7z проверяет объём по заголовкам до распаковки
+    with pytest.raises(ArchiveLimitError):
+        list(iter_archive(_7z(files), 'archive.7z', limits=limits))
+
+
+def test_total_size_counts_nested_archives():
+    inner = _zip({f'file{i}.txt': b'x' * 1000 for i in range(3)})
+    archive = _tar({'one.zip': inner, 'two.zip': inner})
+    limits = ArchiveLimits(max_total_size=6000, max_ratio=None)
+
+    with pytest.raises(ArchiveLimitError):
+        list(iter_archive(archive, 'archive.tar', limits=limits))
+
+
+def test_member_count_limit():
+    files = {f'file{i}.txt': b'x' for i in range(10)}
+    limits = DEFAULT_LIMITS._replace(max_members=5)
+
+    with pytest.raises(ArchiveLimitError):
+        list(iter_archive(_tar(files), 'archive.tar', limits=limits))
+    assert len(list(iter_archive(_tar(files), 'archive.tar'))) == 10
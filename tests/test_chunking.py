@@ -0,0 +1,112 @@
+"""
+Нарезка кода на окна токенов: границы окон, перекрытие и разбиение по узлам
+AST верхнего уровня.
+"""
+
+import itertools
+
+import pytest
+
+from benchmarks import TinyTokenizer
+from chunking import _window_bounds, chunk_code
+
+MAX_TOKENS = 32
+SPECIAL_TOKENS = 2
+BUDGET = MAX_TOKENS - SPECIAL_TOKENS
+
+
+@pytest.fixture
+def tokenizer():
+    return TinyTokenizer(4096)
+
+
+def _code(lines: int) -> str:
+    return ''.join(f'value{i} = compute(item{i}, {i})\n' for i in range(lines))
+
+
+def _ids(tokenizer, text: str) -> list[int]:
+    return tokenizer(text, add_special_tokens=False)['input_ids']
+
+
+@pytest.mark.parametrize('overlap', [0, 8, BUDGET - 1])
+def test_windows_cover_tokens_with_overlap(overlap):
+    bounds = _window_bounds(100, BUDGET, overlap, None)
+
+    assert bounds[0][0] == 0
+    assert bounds[-1][1] == 100
+    for start, end in bounds:
+        assert 0 < end - start <= BUDGET
+    for (_, previous_end), (start, end) in itertools.pairwise(bounds):
+        assert previous_end - start == overlap
+        assert end > previous_end
+
+
+def test_chunks_fill_budget_and_overlap(tokenizer):
+    code = _code(20)
+    ids = _ids(tokenizer, code)
+    overlap = 8
+
+    chunks = chunk_code(code, tokenizer, MAX_TOKENS, overlap=overlap)
+
+    assert len(chunks) > 2
+    assert chunks[0].text.startswith('value0 =')
+    assert code.endswith(chunks[-1].text)
+    for chunk in chunks:
+        assert len(chunk.input_ids) <= MAX_TOKENS
+        assert chunk.input_ids[0] == 1 and chunk.input_ids[-1] == 2
+        # Текст чанка - ровно те токены, что попали в окно
+        assert _ids(tokenizer, chunk.text) == chunk.input_ids[1:-1]
+    # Все окна, кроме последнего, заполняют бюджет
+    assert all(len(chunk.input_ids) == MAX_TOKENS for chunk in chunks[:-1])
+    windows = [chunk.input_ids[1:-1] for chunk in chunks]
+    for previous, current in itertools.pairwise(windows[:-1]):
+        assert previous[-overlap:] == current[:overlap]
+    # Токены всех окон без перекрытий складываются в токены кода
+    joined = windows[0] + [
+        token for window in windows[1:-1] for token in window[overlap:]
+    ]
+    assert ids[: len(joined)] == joined
+    assert ids[-len(windows[-1]) :] == windows[-1]
+
+
+def test_short_code_is_one_chunk(tokenizer):
+    code = 'x = 1\n'
+    chunks = chunk_code(code, tokenizer, MAX_TOKENS)
+
+    assert [chunk.text for chunk in chunks] == [code]
+    assert chunk_code('', tokenizer, MAX_TOKENS) == []
+
+
+def test_overlap_is_limited_by_budget(tokenizer):
+    chunks = chunk_code(_code(10), tokenizer, MAX_TOKENS, overlap=10 * MAX_TOKENS)
+
+    # Окна всё равно сдвигаются хотя бы на один токен
+    assert 1 < len(chunks) <= len(_ids(tokenizer, _code(10)))
+
+
+def test_split_on_top_level_definitions(tokenizer):
+    functions = [f'def f{i}(a, b):\n    return a + b * {i}\n\n\n' for i in range(6)]
+    long_function = 'def long(a):\n' + ''.join(f'    a = a + {i}\n' for i in range(40))
+    code = ''.join(functions) + long_function
+
+    chunks = chunk_code(code, tokenizer, MAX_TOKENS, overlap=4, split_on_ast=True)
+
+    texts = [chunk.text for chunk in chunks]
+    # Короткие функции не режутся посередине
+    for function in functions:
+        assert any(function in text for text in texts)
+    # Окна до длинной функции начинаются с определения функции
+    for text in texts:
+        if 'a = a +' not in text:
+            assert text.startswith('def f')
+    # Функция длиннее бюджета режется окнами
+    assert sum('a = a +' in text for text in texts) > 1
+    assert all(len(chunk.input_ids) <= MAX_TOKENS for chunk in chunks)
+
+
+def test_invalid_python_falls_back_to_windows(tokenizer):
+    code = _code(10) + 'def broken(:\n'
+
+    assert chunk_code(code, tokenizer, MAX_TOKENS, split_on_ast=True) == chunk_code(
+        code, tokenizer, MAX_TOKENS
+    )
@@ -0,0 +1,276 @@
+"""
+Отметки об обработанных файлах в CrawlState: файл, эмбеддинги которого не
+удалось посчитать, не должен считаться обработанным.
+"""
+
+import multiprocessing
+import types
+
+import numpy as np
+import pytest
+
+import embedding_cache
+import parallel
+import pipeline
+from benchmarks import TinyBackend
+from crawl_state import CrawlState
+from embedding_backends import register_backend
+from get_directory_contents import FileData
+from parallel import analyze_parallel
+from pipeline import embed_files, fetch_files
+from reference_index import ReferenceIndex
+
+OWNER, REPO = 'owner', 'repo'
+# Батч модели, в который попал чанк с этим словом, падает
+POISON = 'poison'
+
+
+class _FailingBackend(TinyBackend):
+    def __init__(self):
+        super().__init__()
+        self._poison = self.tokenizer.encode(POISON)[0][0]
+
+    @property
+    def name(self) -> str:
+        return 'test-failing'
+
+    def forward(self, input_ids: list[list[int]]) -> np.ndarray:
+        if any(self._poison in ids for ids in input_ids):
+            raise RuntimeError('batch failed')
+        return super().forward(input_ids)
+
+
+@pytest.fixture
+def failing_backend(monkeypatch):
+    register_backend('test-failing', lambda model_path, precision: _FailingBackend())
+    monkeypatch.setenv('NIR_EMBEDDING_BACKEND', 'test-failing')
+    monkeypatch.setattr(embedding_cache, 'CACHE_ENABLED', False)
+
+
+def _file(index: int, word: str = 'value', repo: str = REPO) -> FileData:
+    path = f'src/module{index}.py'
+    return FileData(
+        OWNER, repo, f'module{index}.py', f'{word} = {index}\n', path, f'sha{index}'
+    )
+
+
+def _mark(state: CrawlState, file_data: FileData):
+    state.mark_blob(file_data.owner, file_data.repo_name, file_data.path, file_data.sha)
+
+
+def _is_done(state: CrawlState, file_data: FileData) -> bool:
+    return state.is_unchanged(
+        file_data.owner, file_data.repo_name, file_data.path, file_data.sha
+    )
+
+
+def _crawl(state: CrawlState, files: list[FileData]):
+    # Как и обход, отмечает файл, когда потребитель запросил следующий
+    previous = None
+    for file_data in files:
+        if previous is not None:
+            _mark(state, previous)
+        yield file_data
+        previous = file_data
+    if previous is not None:
+        _mark(state, previous)
+
+
+def test_failed_batch_is_not_marked_done(tmp_path, failing_backend):
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    # Чанки одной длины: два батча модели по 8, падает один из них
+    files = [_file(i) for i in range(15)] + [_file(15, POISON)]
+
+    failed = []
+
+    def on_failed(file_data):
+        failed.append(file_data)
+        state.skip_blob(file_data)
+
+    embedded = [
+        file_data
+        for file_data, _ in embed_files(
+            _crawl(state, files), files_per_batch=len(files), on_failed=on_failed
+        )
+    ]
+    state.commit()
+
+    assert files[-1] in failed
+    assert 0 < len(failed) < len(files)
+    assert set(embedded) | set(failed) == set(files)
+    assert not set(embedded) & set(failed)
+    for file_data in files:
+        assert _is_done(state, file_data) == (file_data not in failed)
+
+
+def test_skip_before_mark_and_checkpoints(tmp_path):
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    first, second, third = _file(0), _file(1), _file(2)
+
+    _mark(state, first)
+    _mark(state, second)
+    position = state.checkpoint()
+    # Отметка о третьем файле поступит после отказа от него
+    state.skip_blob(third)
+    _mark(state, third)
+    state.skip_blob(first)
+    assert state.checkpoint() == position
+
+    state.commit(position)
+    assert not _is_done(state, first)
+    assert _is_done(state, second)
+    state.commit()
+    assert not _is_done(state, third)
+
+    # Отказ действует только на одну отметку
+    _mark(state, third)
+    state.commit()
+    assert _is_done(state, third)
+
+
+def test_skip_without_deferred_mode(tmp_path):
+    state = CrawlState(str(tmp_path / 'state.sqlite3'))
+    first, second = _file(0), _file(1)
+
+    _mark(state, first)
+    state.skip_blob(first)
+    state.skip_blob(second)
+    _mark(state, second)
+
+    assert not _is_done(state, first)
+    assert not _is_done(state, second)
+
+
+@pytest.fixture
+def repositories(monkeypatch):
+    """
+    Два репозитория меньше батча анализа (4 файла): первый целиком попадает в
+    удачный батч, батч с концом второго падает.
+    """
+    contents = {
+        'healthy': [_file(i, repo='healthy') for i in range(3)],
+        'broken': [_file(3, repo='broken')]
+        + [_file(4, repo='broken'), _file(5, POISON, repo='broken')],
+    }
+
+    def iter_directory_contents(owner, repo_name, path, mode, state):
+        return _crawl(state, contents[repo_name])
+
+    monkeypatch.setattr(pipeline, 'iter_directory_contents', iter_directory_contents)
+    return contents
+
+
+def _check_repositories(state: CrawlState, run_id: int, contents, failed):
+    healthy, broken = contents['healthy'], contents['broken']
+    assert set(failed) == set(broken[1:])
+    for file_data in healthy + broken:
+        assert _is_done(state, file_data) == (file_data not in failed)
+    assert state.is_repo_done(run_id, OWNER, 'healthy')
+    assert not state.is_repo_done(run_id, OWNER, 'broken')
+
+
+def _skip(state: CrawlState, failed: list):
+    def on_failed(file_data):
+        failed.append(file_data)
+        state.skip_blob(file_data)
+
+    return on_failed
+
+
+def test_small_repository_is_done_after_its_batch(
+    tmp_path, failing_backend, repositories
+):
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    run_id = state.start_run()
+    failed = []
+    files = fetch_files(
+        [(OWNER, 'healthy', ''), (OWNER, 'broken', '')], state=state, run_id=run_id
+    )
+
+    for file_data, _ in embed_files(
+        files,
+        files_per_batch=4,
+        on_batch_done=state.commit,
+        on_failed=_skip(state, failed),
+    ):
+        # Пока потребитель не подтвердил батч, ничего не записано
+        assert not _is_done(state, file_data)
+    state.finish_run(run_id)
+
+    _check_repositories(state, run_id, repositories, failed)
+
+
+@pytest.mark.filterwarnings('ignore:This process .* is multi-threaded')
+def test_small_repository_is_done_after_its_task(
+    tmp_path, monkeypatch, failing_backend, repositories
+):
+    # Воркеры наследуют зарегистрированный в тесте бэкенд
+    monkeypatch.setattr(
+        parallel,
+        'multiprocessing',
+        types.SimpleNamespace(
+            get_context=lambda method: multiprocessing.get_context('fork')
+        ),
+    )
+    reference_dir = str(tmp_path / 'reference_index')
+    ReferenceIndex(
+        np.random.default_rng(0).normal(size=(4, 64)),
+        np.arange(4),
+        [f'reference/file{i}.py' for i in range(4)],
+    ).save(reference_dir)
+
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    run_id = state.start_run()
+    failed = []
+    files = fetch_files(
+        [(OWNER, 'healthy', ''), (OWNER, 'broken', '')], state=state, run_id=run_id
+    )
+
+    for file_data, _ in analyze_parallel(
+        files,
+        workers=2,
+        threads_per_worker=1,
+        files_per_task=4,
+        reference_dir=reference_dir,
+        checkpoint=state.checkpoint,
+        on_task_done=state.commit,
+        on_failed=_skip(state, failed),
+    ):
+        assert not _is_done(state, file_data)
+    state.finish_run(run_id)
+
+    _check_repositories(state, run_id, repositories, failed)
+
+
+def test_repository_mark_is_deferred(tmp_path):
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    run_id = state.start_run()
+    files = [_file(0), _file(1)]
+    for file_data in files:
+        _mark(state, file_data)
+    state.mark_repo_done(run_id, OWNER, REPO)
+    assert not state.is_repo_done(run_id, OWNER, REPO)
+
+    # Отказ от файла после отметки о репозитории, но до commit
+    state.skip_blob(files[1])
+    state.commit()
+    assert _is_done(state, files[0])
+    assert not _is_done(state, files[1])
+    assert not state.is_repo_done(run_id, OWNER, REPO)
+
+
+def test_skip_after_commit(tmp_path):
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    run_id = state.start_run()
+    first, second = _file(0), _file(1)
+    _mark(state, first)
+    _mark(state, second)
+    state.mark_repo_done(run_id, OWNER, REPO)
+    state.commit()
+    assert state.is_repo_done(run_id, OWNER, REPO)
+
+    # Например, копия файла, анализ оригинала которого не удался позже
+    state.skip_blob(second)
+    assert _is_done(state, first)
+    assert not _is_done(state, second)
+    assert not state.is_repo_done(run_id, OWNER, REPO)
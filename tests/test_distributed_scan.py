@@ -0,0 +1,132 @@
+"""
+Распределённое сканирование: несколько процессов с общими файлами очереди,
+состояния обхода и хранилища результатов или воркеры, обращающиеся к
+координатору по HTTP.
+
+Репозитории отдаёт локальный HTTP-сервер с подмножеством GitHub API, поэтому
+тест не требует сети и токенов.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import pytest
+from github_server import GitHubServer
+
+from work_queue import WorkQueue
+
+OWNER = 'test-owner'
+REPOSITORIES = 6
+FILES_PER_REPOSITORY = 20
+WORKERS = 3
+# Файл из базы вредоносного ПО, лежит в каждом втором репозитории
+MALWARE = b'import os\nos.system("rm -rf --no-preserve-root /")\n'
+
+
+def _repository_files(index: int) -> dict[str, bytes]:
+    files = {
+        f'pkg{i % 3}/module{i}.py': f'VALUE = {index * 1000 + i}\n'.encode()
+        for i in range(FILES_PER_REPOSITORY)
+    }
+    if index % 2 == 0:
+        files['payload.py'] = MALWARE
+    return files
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    """
+    Рабочий каталог со списком репозиториев и выгрузкой хешей; переменные
+    окружения наследуют процессы-воркеры.
+    """
+    repositories = {f'repo{i}': _repository_files(i) for i in range(REPOSITORIES)}
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'repositories.json').write_text(
+        json.dumps([{'owner': OWNER, 'name': name} for name in repositories])
+    )
+    (tmp_path / 'full.csv').write_text(
+        '# "first_seen_utc", "sha256_hash", "md5_hash", "sha1_hash", '
+        '"file_name", "signature"\n'
+        f'"2024-01-01 00:00:00", "{hashlib.sha256(MALWARE).hexdigest()}", '
+        f'"{hashlib.md5(MALWARE).hexdigest()}", "{hashlib.sha1(MALWARE).hexdigest()}", '
+        '"payload.py", "Test"\n'
+    )
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1,localhost')
+
+    with GitHubServer(OWNER, repositories) as server:
+        monkeypatch.setenv('GITHUB_API_URL', server.url)
+        yield repositories
+
+
+def test_workers_share_queue_and_state(environment, tmp_path):
+    import distributed_scan
+    import get_directory_contents
+
+    # Модуль мог быть импортирован раньше с другим адресом API
+    get_directory_contents.GITHUB_API_URL = os.environ['GITHUB_API_URL']
+    report = distributed_scan.run_local(
+        WORKERS, queue_path=str(tmp_path / 'queue.sqlite3')
+    )
+
+    assert report['failed'] == []
+    assert report['summary']['tasks'] == {'done': REPOSITORIES}
+    assert set(report['repositories']) == {f'{OWNER}/{name}' for name in environment}
+    for name, files in environment.items():
+        results = report['repositories'][f'{OWNER}/{name}']
+        assert len(results) == len(files)
+        found = {result['file_name'] for result in results if result['found']}
+        assert found == ({'payload.py'} if 'payload.py' in files else set())
+
+    connection = sqlite3.connect(tmp_path / 'hash_scan_state.sqlite3')
+    try:
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    finally:
+        connection.close()
+
+
+def test_workers_reach_coordinator_over_http(environment, tmp_path, monkeypatch):
+    import distributed_scan
+    import get_directory_contents
+    from work_queue import make_server
+
+    get_directory_contents.GITHUB_API_URL = os.environ['GITHUB_API_URL']
+    monkeypatch.setattr(distributed_scan, 'POLL_INTERVAL', 0.1)
+    queue_path = str(tmp_path / 'queue.sqlite3')
+    distributed_scan.run_coordinator(queue_path, restart=True)
+
+    server = make_server(WorkQueue(queue_path), 'http://127.0.0.1:0')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        # Воркеры разных машин: у каждого свои файлы состояния и результатов
+        workers = [
+            threading.Thread(
+                target=distributed_scan.run_worker,
+                kwargs={
+                    'queue_path': address,
+                    'worker_id': f'host-{i}',
+                    'state_path': str(tmp_path / f'state-{i}.sqlite3'),
+                    'result_store_path': str(tmp_path / f'results-{i}.sqlite3'),
+                },
+            )
+            for i in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report = distributed_scan.merge_report(queue_path, output=None)
+    assert report['failed'] == []
+    assert report['summary']['tasks'] == {'done': REPOSITORIES}
+    for name, files in environment.items():
+        results = report['repositories'][f'{OWNER}/{name}']
+        assert len(results) == len(files)
+        found = {result['file_name'] for result in results if result['found']}
+        assert found == ({'payload.py'} if 'payload.py' in files else set())
@@ -0,0 +1,57 @@
+"""
+Дисковый кэш эмбеддингов: у каждой модели свой каталог и своя размерность.
+"""
+
+import numpy as np
+import pytest
+
+import embedding_cache
+from embedding_cache import EmbeddingCache, get_default_cache, make_key
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(embedding_cache, 'CACHE_ENABLED', True)
+    monkeypatch.setattr(embedding_cache, '_default_caches', {})
+    return tmp_path / 'cache'
+
+
+def _vector(dim: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+
+
+def test_models_with_different_dimensions(cache_dir):
+    models = {'Salesforce/codegen-2B-mono:fp32': 256, 'microsoft/unixcoder:fp32': 96}
+    for seed, (model, dim) in enumerate(models.items()):
+        cache = get_default_cache(model)
+        cache.put(make_key(model, 512, 1, 'x = 1'), _vector(dim, seed))
+        cache.flush()
+
+    # Каталоги переживают перезапуск процесса
+    embedding_cache._default_caches.clear()
+    for seed, (model, dim) in enumerate(models.items()):
+        cache = get_default_cache(model)
+        assert cache.directory.startswith(str(cache_dir))
+        vector = cache.get(make_key(model, 512, 1, 'x = 1'))
+        np.testing.assert_array_equal(vector, _vector(dim, seed))
+    assert len({get_default_cache(model).directory for model in models}) == 2
+
+
+def test_eviction_keeps_recent_entries(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_entries=4)
+    keys = [make_key('model', 512, 1, f'x = {i}') for i in range(6)]
+    for i, key in enumerate(keys[:4]):
+        cache.put(key, _vector(8, i))
+    cache.flush()
+    # Первая запись использована недавно и не вытесняется
+    assert cache.get(keys[0]) is not None
+    for i, key in enumerate(keys[4:], start=4):
+        cache.put(key, _vector(8, i))
+    cache.flush()
+
+    reopened = EmbeddingCache(str(tmp_path), max_entries=4)
+    assert reopened.get(keys[1]) is None
+    assert reopened.get(keys[2]) is None
+    for i in (0, 3, 4, 5):
+        np.testing.assert_array_equal(reopened.get(keys[i]), _vector(8, i))
@@ -0,0 +1,125 @@
+"""
+Обход репозитория через локальный сервер с подмножеством GitHub API: ошибки
+листингов и загрузки архива не должны приводить к тихой потере части
+репозитория.
+"""
+
+import io
+import zipfile
+
+import pytest
+from github_server import GitHubServer
+
+import get_directory_contents
+import github_client
+import pipeline
+from crawl_state import CrawlState
+from get_directory_contents import (
+    FetchError,
+    iter_directory_contents,
+    iter_repository_archive,
+)
+
+OWNER = 'test-owner'
+FILES = {
+    'main.py': b'print("main")\n',
+    'pkg/module.py': b'VALUE = 1\n',
+    'pkg/nested/deep.py': b'VALUE = 2\n',
+}
+MODES = ['serial', 'async']
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1,localhost')
+    # Повторы без задержек
+    monkeypatch.setattr(github_client, 'BASE_DELAY', 0.0)
+    with GitHubServer(OWNER, {'repo': dict(FILES)}) as server:
+        monkeypatch.setattr(get_directory_contents, 'GITHUB_API_URL', server.url)
+        yield server
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_walks_all_directories(server, mode):
+    files = iter_directory_contents(OWNER, 'repo', mode=mode)
+    assert sorted(file_data.path for file_data in files) == sorted(FILES)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('status', [403, 503])
+def test_failed_listing_raises(server, mode, status):
+    server.errors['repo', 'pkg/nested'] = status
+    with pytest.raises(FetchError):
+        list(iter_directory_contents(OWNER, 'repo', mode=mode))
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_missing_directory_is_empty(server, mode):
+    assert list(iter_directory_contents(OWNER, 'repo', 'absent', mode=mode)) == []
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_failed_listing_leaves_repository_undone(server, tmp_path, mode):
+    server.errors['repo', 'pkg'] = 503
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    run_id = state.start_run()
+
+    files = list(pipeline.fetch_files([(OWNER, 'repo', '')], mode, state, run_id))
+    state.finish_run(run_id)
+    assert not state.is_repo_done(run_id, OWNER, 'repo')
+
+    # Следующий запуск загружает репозиторий целиком
+    del server.errors['repo', 'pkg']
+    run_id = state.start_run(resume=False)
+    files += pipeline.fetch_files([(OWNER, 'repo', '')], mode, state, run_id)
+    state.finish_run(run_id)
+    assert state.is_repo_done(run_id, OWNER, 'repo')
+    assert sorted({file_data.path for file_data in files}) == sorted(FILES)
+
+
+def _zip(members: dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('archive_format', ['tarball', 'zipball'])
+def test_archive_mode(server, archive_format):
+    server.repositories['repo']['vendor/lib.zip'] = _zip({'inner/x.py': b'X = 1\n'})
+    files = {
+        file_data.file_name: file_data.file_content
+        for file_data in iter_repository_archive(
+            OWNER, 'repo', archive_format=archive_format
+        )
+    }
+    assert files == {
+        **{path: content.decode() for path, content in FILES.items()},
+        'vendor/lib.zip/inner/x.py': 'X = 1\n',
+    }
+
+    files = iter_repository_archive(OWNER, 'repo', 'pkg', archive_format)
+    assert sorted(file_data.file_name for file_data in files) == [
+        'pkg/module.py',
+        'pkg/nested/deep.py',
+    ]
+
+
+@pytest.mark.parametrize('status', [403, 503])
+def test_failed_archive_raises(server, tmp_path, status):
+    server.errors['repo', 'tarball'] = status
+    with pytest.raises(FetchError):
+        list(iter_directory_contents(OWNER, 'repo', mode='archive'))
+
+    # Репозиторий не отмечается обработанным, а не обрабатывается как пустой
+    state = CrawlState(str(tmp_path / 'state.sqlite3'), deferred=True)
+    run_id = state.start_run()
+    files = pipeline.fetch_files([(OWNER, 'repo', '')], 'archive', state, run_id)
+    assert list(files) == []
+    state.finish_run(run_id)
+    assert not state.is_repo_done(run_id, OWNER, 'repo')
+
+
+def test_missing_repository_archive_is_empty(server):
+    assert list(iter_directory_contents(OWNER, 'absent', mode='archive')) == []
@@ -0,0 +1,63 @@
+"""
+Учёт лимитов GitHub API в RequestScheduler: у каждого токена отдельные
+бюджеты для ресурсов core и search.
+"""
+
+import time
+
+from github_client import RequestScheduler
+
+
+def _headers(resource: str, limit: int, remaining: int, reset_in: float) -> dict:
+    return {
+        'X-RateLimit-Resource': resource,
+        'X-RateLimit-Limit': str(limit),
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(time.time() + reset_in),
+    }
+
+
+def test_search_does_not_consume_core_budget():
+    scheduler = RequestScheduler(['token'])
+    budget, wait = scheduler._reserve('core')
+    scheduler._update(budget, 200, _headers('core', 5000, 4990, 3600))
+
+    budget, wait = scheduler._reserve('search')
+    assert wait == 0.0
+    scheduler._update(budget, 200, _headers('search', 30, 29, 60))
+
+    # Бюджет search почти полон: запас не больше десятой части лимита
+    budget, wait = scheduler._reserve('search')
+    assert budget.resource == 'search'
+    assert wait < 60 / 20
+    # Бюджет core не затронут запросами к search
+    budget, wait = scheduler._reserve('core')
+    assert budget.resource == 'core'
+    assert budget.remaining == 4990 - 1
+    assert wait == 0.0
+
+
+def test_response_counts_against_reported_resource():
+    scheduler = RequestScheduler(['token'])
+    budget, _ = scheduler._reserve('core')
+    # Сервер учёл запрос в лимите search
+    scheduler._update(budget, 200, _headers('search', 30, 0, 60))
+
+    _, wait = scheduler._reserve('core')
+    assert wait == 0.0
+    _, wait = scheduler._reserve('search')
+    assert 55 < wait <= 60
+
+
+def test_exhausted_token_is_skipped():
+    scheduler = RequestScheduler(['first', 'second'])
+    for token, remaining in (('first', 0), ('second', 4000)):
+        scheduler._update(
+            scheduler._budget(token, 'core'),
+            200,
+            _headers('core', 5000, remaining, 3600),
+        )
+
+    budget, wait = scheduler._reserve('core')
+    assert budget.token == 'second'
+    assert wait == 0.0
@@ -0,0 +1,74 @@
+"""
+Потоковая кластеризация: на хорошо разделимых данных mini-batch k-means
+находит те же кластеры, что и разметка, а центры остаются средними точек.
+"""
+
+import numpy as np
+
+from incremental_clustering import StreamingKMeans
+
+DIM = 16
+CLUSTERS = 4
+
+
+def _blobs(count: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    # Кластеры вокруг попарно ортогональных направлений с небольшим шумом
+    generator = np.random.default_rng(seed)
+    labels = generator.integers(0, CLUSTERS, size=count)
+    directions = np.eye(DIM)[:CLUSTERS] * 3.0
+    return directions[labels] + generator.normal(scale=0.1, size=(count, DIM)), labels
+
+
+def _stream(clusterer: StreamingKMeans, data: np.ndarray, batch: int = 37):
+    for start in range(0, len(data), batch):
+        clusterer.partial_fit(data[start : start + batch])
+    clusterer.flush()
+
+
+def _assert_same_partition(predicted: np.ndarray, labels: np.ndarray):
+    # Каждому истинному кластеру соответствует ровно один найденный
+    pairs = set(zip(labels.tolist(), predicted.tolist()))
+    assert len(pairs) == CLUSTERS
+    assert len({found for _, found in pairs}) == CLUSTERS
+
+
+def test_streaming_kmeans_separates_clusters():
+    data, labels = _blobs(2000, 0)
+    clusterer = StreamingKMeans(
+        sample_size=200, batch_size=100, candidates=range(2, 9), n_jobs=1
+    )
+
+    _stream(clusterer, data)
+
+    assert len(clusterer.centers) == CLUSTERS
+    assert clusterer.counts.sum() == len(data)
+    predicted = clusterer.predict(data)
+    _assert_same_partition(predicted, labels)
+    # Центр - среднее всех нормированных векторов кластера
+    normalized = data / np.linalg.norm(data, axis=1, keepdims=True)
+    for cluster in range(CLUSTERS):
+        members = normalized[predicted == cluster]
+        np.testing.assert_allclose(
+            clusterer.centers[cluster], members.mean(axis=0), atol=1e-9
+        )
+        assert clusterer.counts[cluster] == len(members)
+
+
+def test_saved_clustering_continues_on_new_data(tmp_path):
+    first, first_labels = _blobs(600, 1)
+    clusterer = StreamingKMeans(num_clusters=CLUSTERS, sample_size=200, batch_size=50)
+    _stream(clusterer, first)
+    clusterer.save(str(tmp_path))
+
+    restored = StreamingKMeans.load(str(tmp_path), batch_size=50)
+    second, second_labels = _blobs(400, 2)
+    _stream(restored, second)
+
+    assert restored.num_clusters == CLUSTERS
+    assert restored.counts.sum() == len(first) + len(second)
+    _assert_same_partition(
+        restored.predict(np.vstack([first, second])),
+        np.concatenate([first_labels, second_labels]),
+    )
+    # Дообучение не переставляет кластеры
+    np.testing.assert_array_equal(restored.predict(first), clusterer.predict(first))
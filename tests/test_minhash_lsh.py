@@ -0,0 +1,89 @@
+"""
+MinHash-сигнатуры и LSH-индекс почти-дубликатов.
+"""
+
+import io
+import json
+import os
+import tokenize
+
+from minhash_lsh import MinHashLSHIndex, minhash_signature, tokenize_code
+
+SAMPLE = '''
+import os  # комментарий
+
+
+def run(path: str, retries=3) -> bool:
+    """Документация."""
+    total = 0
+    for i in range(retries):
+        total += i ** 2 // 3
+        if total >= 10 and path != 'x':
+            value := total
+    data = {**kwargs}
+    return os.path.exists(path) or total << 2 == 0x1F
+'''
+TOKEN_KINDS = {tokenize.STRING: 'STR', tokenize.NUMBER: 'NUM'}
+SKIPPED = {
+    tokenize.COMMENT,
+    tokenize.NL,
+    tokenize.NEWLINE,
+    tokenize.INDENT,
+    tokenize.DEDENT,
+    tokenize.ENDMARKER,
+}
+
+
+def _reference_tokens(code: str) -> list[str]:
+    return [
+        TOKEN_KINDS.get(token.type, token.string)
+        for token in tokenize.generate_tokens(io.StringIO(code).readline)
+        if token.type not in SKIPPED
+    ]
+
+
+def test_tokens_match_python_tokenizer():
+    assert tokenize_code(SAMPLE) == _reference_tokens(SAMPLE)
+
+
+OTHER = """
+class Stack:
+    def __init__(self):
+        self.items = []
+
+    def push(self, item):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.pop() if self.items else None
+"""
+
+
+def test_near_duplicate_is_found(tmp_path):
+    index = MinHashLSHIndex()
+    index.add('reference/sample.py', minhash_signature(SAMPLE))
+    index.add('reference/other.py', minhash_signature(OTHER))
+    index.save(str(tmp_path))
+
+    loaded = MinHashLSHIndex.load(str(tmp_path))
+    # Другие комментарии, строки и числа не меняют токены
+    copy = SAMPLE.replace("'x'", "'y'").replace('# комментарий', '# другой')
+    copy += '\n\nprint(run("a"))\n'
+    matches = loaded.query(minhash_signature(copy))
+    assert matches[0][0] == 'reference/sample.py'
+    assert matches[0][1] >= 0.8
+    assert 'reference/other.py' not in dict(matches)
+
+
+def test_index_with_other_tokenizer_is_refused(tmp_path):
+    index = MinHashLSHIndex()
+    index.add('reference/sample.py', minhash_signature(SAMPLE))
+    index.save(str(tmp_path))
+
+    meta_path = os.path.join(tmp_path, 'minhash.json')
+    with open(meta_path) as file:
+        meta = json.load(file)
+    meta['tokenizer'] = 'code_tokenize'
+    with open(meta_path, 'w') as file:
+        json.dump(meta, file)
+    assert MinHashLSHIndex.load(str(tmp_path)) is None
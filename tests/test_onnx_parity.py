@@ -0,0 +1,74 @@
+"""
+Совпадение эмбеддингов ONNX-бэкенда с исходной моделью PyTorch.
+
+Вместо настоящей модели экспортируется крошечный BERT со случайными весами,
+собранный в tmp_path, поэтому тест не требует сети. Без torch, transformers
+или onnxruntime (pip install .[onnx]) тест пропускается.
+"""
+
+import os
+import re
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from embedding_backends import (
+    PARITY_SAMPLES,
+    PARITY_TOLERANCE,
+    OnnxBackend,
+    TransformerBackend,
+    check_parity,
+)
+
+MAX_LENGTH = 64
+
+
+@pytest.fixture(scope='module')
+def tiny_model(tmp_path_factory):
+    """Каталог с BERT-подобной моделью и токенизатором в формате from_pretrained."""
+    directory = tmp_path_factory.mktemp('tiny-bert')
+    words = sorted(
+        {token for text in PARITY_SAMPLES for token in re.findall(r'\w+|[^\w\s]', text)}
+    )
+    vocab_file = directory / 'vocab.txt'
+    vocab_file.write_text(
+        '\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', *words]) + '\n'
+    )
+    tokenizer = transformers.BertTokenizerFast(str(vocab_file), do_lower_case=False)
+    tokenizer.save_pretrained(directory)
+
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=128,
+        max_position_embeddings=MAX_LENGTH,
+    )
+    transformers.BertModel(config).eval().save_pretrained(directory)
+    return str(directory)
+
+
+@pytest.mark.parametrize('precision', ['fp32', 'int8'])
+def test_onnx_matches_eager(tiny_model, tmp_path, precision):
+    reference = TransformerBackend(tiny_model, MAX_LENGTH)
+    candidate = OnnxBackend(
+        tiny_model, MAX_LENGTH, precision, export_dir=str(tmp_path / 'onnx')
+    )
+
+    assert check_parity(reference, candidate) <= PARITY_TOLERANCE[precision]
+
+
+def test_export_is_reused(tiny_model, tmp_path):
+    export_dir = str(tmp_path / 'onnx')
+    model_file = OnnxBackend(tiny_model, MAX_LENGTH, export_dir=export_dir).model_file
+    modified = os.stat(model_file).st_mtime_ns
+
+    again = OnnxBackend(tiny_model, MAX_LENGTH, export_dir=export_dir).model_file
+    assert again == model_file
+    assert os.stat(model_file).st_mtime_ns == modified
@@ -0,0 +1,156 @@
+"""
+Эталонный индекс: сохранение версий и поиск ближайших соседей.
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+import reference_index
+from reference_index import META_FILE, ReferenceIndex
+
+DIM = 16
+
+
+def _index(count: int, seed: int) -> ReferenceIndex:
+    generator = np.random.default_rng(seed)
+    return ReferenceIndex(
+        generator.normal(size=(count, DIM)),
+        np.arange(count) // 2,
+        [f'reference/file{i}.py' for i in range((count + 1) // 2)],
+        model='test-model',
+    )
+
+
+def _read_meta(directory) -> dict:
+    with open(os.path.join(directory, META_FILE)) as file:
+        return json.load(file)
+
+
+def test_save_switches_versions_through_meta(tmp_path):
+    first, second = _index(6, 0), _index(10, 1)
+    first.save(str(tmp_path))
+    old_meta = _read_meta(tmp_path)
+    second.save(str(tmp_path))
+    meta = _read_meta(tmp_path)
+
+    assert meta['data'] != old_meta['data']
+    loaded = ReferenceIndex.load(str(tmp_path))
+    assert len(loaded) == 10
+    assert loaded.sources == second.sources
+    np.testing.assert_allclose(loaded.embeddings, second.embeddings, rtol=1e-6)
+
+    # Читатель, прочитавший прежний meta.json, открывает прежнюю версию целиком
+    old_data = tmp_path / old_meta['data']
+    assert len(np.load(old_data / 'embeddings.npy')) == 6
+    assert len(json.loads((old_data / 'sources.json').read_text())) == 3
+
+    # Версии старше предыдущей удаляются
+    _index(4, 2).save(str(tmp_path))
+    assert not old_data.exists()
+    assert (tmp_path / meta['data']).exists()
+
+
+def test_interrupted_save_keeps_current_version(tmp_path, monkeypatch):
+    _index(6, 0).save(str(tmp_path))
+
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+
+    # Сохранение прерывается после записи массивов новой версии
+    monkeypatch.setattr(json, 'dump', fail)
+    with pytest.raises(OSError):
+        _index(10, 1).save(str(tmp_path))
+    monkeypatch.undo()
+
+    loaded = ReferenceIndex.load(str(tmp_path))
+    assert len(loaded) == 6
+    assert len(loaded.sources) == 3
+
+
+def test_loads_and_migrates_flat_layout(tmp_path):
+    # Версия 2: файлы прямо в каталоге
+    index = _index(6, 0)
+    np.save(tmp_path / 'embeddings.npy', index.embeddings)
+    np.save(tmp_path / 'chunk_sources.npy', index.chunk_sources)
+    (tmp_path / 'sources.json').write_text(json.dumps(index.sources))
+    (tmp_path / META_FILE).write_text(
+        json.dumps({'format_version': 2, 'model': 'test-model', 'preprocessing': {}})
+    )
+
+    loaded = ReferenceIndex.load(str(tmp_path))
+    assert len(loaded) == 6
+    loaded.save(str(tmp_path))
+    assert len(ReferenceIndex.load(str(tmp_path))) == 6
+    # Прежние файлы нужны читателям до следующего сохранения
+    assert (tmp_path / 'embeddings.npy').exists()
+    _index(4, 1).save(str(tmp_path))
+    assert not (tmp_path / 'embeddings.npy').exists()
+
+
+def _brute_force(index: ReferenceIndex, queries: np.ndarray, k: int):
+    references = index.embeddings.astype(np.float64)
+    references /= np.linalg.norm(references, axis=1, keepdims=True)
+    scores = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ references.T
+    indices = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(scores, indices, axis=1), indices
+
+
+@pytest.mark.parametrize('block_size', [7, 64, 65_536])
+def test_exact_search_matches_brute_force(monkeypatch, block_size):
+    # Маленькие блоки проверяют слияние лучших результатов разных блоков
+    monkeypatch.setattr(reference_index, 'SEARCH_BLOCK_SIZE', block_size)
+    index = _index(200, 0)
+    queries = np.random.default_rng(1).normal(size=(12, DIM))
+
+    scores, indices = index.search(queries, k=5)
+    expected_scores, expected_indices = _brute_force(index, queries, 5)
+
+    assert index.method == 'exact'
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, atol=1e-6)
+
+
+def test_search_of_saved_float16_index(tmp_path):
+    _index(100, 0).save(str(tmp_path), dtype='float16')
+    loaded = ReferenceIndex.load(str(tmp_path))
+    queries = np.random.default_rng(1).normal(size=(8, DIM))
+
+    scores, indices = loaded.search(queries, k=3)
+    expected_scores, _ = _brute_force(loaded, queries, 3)
+
+    assert loaded.embeddings.dtype == np.float16
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-3)
+    # Найденные чанки действительно так близки к запросам
+    all_scores, all_indices = _brute_force(loaded, queries, len(loaded))
+    for row, found in enumerate(indices):
+        by_index = dict(zip(all_indices[row], all_scores[row]))
+        np.testing.assert_allclose([by_index[i] for i in found], scores[row], atol=1e-3)
+
+
+def test_search_with_k_above_size():
+    index = _index(3, 0)
+    scores, indices = index.search(np.ones((2, DIM)), k=10)
+
+    assert scores.shape == indices.shape == (2, 3)
+    assert sorted(indices[0]) == [0, 1, 2]
+
+
+def test_match_files_keeps_best_chunk_per_file():
+    index = _index(10, 0)
+    # Запросы совпадают с чанками 2 и 3 (оба из файла 1) и чанком 8 (файл 4)
+    embeddings = np.asarray(index.embeddings)[[2, 3, 8]]
+
+    score, matches = index.match_files(embeddings, k=3)
+
+    assert score == pytest.approx(1.0)
+    names = [name for name, _ in matches]
+    assert names[:2] in (
+        ['reference/file1.py', 'reference/file4.py'],
+        ['reference/file4.py', 'reference/file1.py'],
+    )
+    assert len(names) == len(set(names))
+    assert matches[0][1] == pytest.approx(1.0)
+    assert index.match_files(np.empty((0, DIM))) == (0.0, [])
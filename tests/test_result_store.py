@@ -0,0 +1,122 @@
+"""
+Дедупликация анализа по хешу содержимого.
+"""
+
+import sqlite3
+
+from get_directory_contents import FileData
+from result_store import Deduplicator, ResultStore, content_hash
+
+
+def _file(repo: str, path: str, content: str, file_name: str | None = None):
+    return FileData(
+        'owner',
+        repo,
+        file_name or path.rsplit('/', 1)[-1],
+        content,
+        path,
+        f'sha-{path}',
+    )
+
+
+def _analyze(files, failed=()):
+    """Результат для каждого файла, кроме failed (их анализ не удался)."""
+    for file_data in files:
+        if file_data not in failed:
+            yield file_data, {'file_name': file_data.file_name, 'score': 1.0}
+
+
+def test_locations_are_keyed_by_path(tmp_path):
+    store = ResultStore(str(tmp_path / 'store.sqlite3'))
+    files = [
+        _file('repo', 'a/__init__.py', 'x = 1'),
+        _file('repo', 'b/__init__.py', 'x = 1'),
+        _file('repo', 'dist/bundle.zip', 'x = 1', file_name='pkg/__init__.py'),
+    ]
+    for file_data in files:
+        store.add_location(content_hash(file_data), file_data)
+
+    [duplicate] = store.duplicates()
+    assert duplicate['copies'] == 3
+    assert duplicate['locations'] == [
+        'owner/repo/a/__init__.py',
+        'owner/repo/b/__init__.py',
+        'owner/repo/dist/bundle.zip:pkg/__init__.py',
+    ]
+
+
+def test_old_locations_table_is_rebuilt(tmp_path):
+    path = str(tmp_path / 'store.sqlite3')
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE locations (owner TEXT NOT NULL, repo TEXT NOT NULL, '
+        'file_name TEXT NOT NULL, content_hash TEXT NOT NULL, '
+        'PRIMARY KEY (owner, repo, file_name))'
+    )
+    connection.commit()
+    connection.close()
+
+    store = ResultStore(path)
+    file_data = _file('repo', 'a/main.py', 'x = 1')
+    store.add_location(content_hash(file_data), file_data)
+    assert store.locations(content_hash(file_data)) == [
+        ('owner', 'repo', 'a/main.py', 'main.py')
+    ]
+
+
+def test_copies_of_failed_file_are_reported(tmp_path):
+    failed = []
+    deduplicator = Deduplicator(
+        ResultStore(str(tmp_path / 'store.sqlite3')), on_failed=failed.append
+    )
+    original = _file('first', 'main.py', 'x = 1')
+    copy = _file('second', 'main.py', 'x = 1')
+    other = _file('first', 'other.py', 'y = 2')
+
+    analyzed = list(deduplicator.filter([original, copy, other]))
+    assert analyzed == [original, other]
+    # Конвейер сообщает об ошибке анализа оригинала
+    deduplicator.fail(original)
+    results = list(deduplicator.resolve(_analyze(analyzed, failed=[original])))
+
+    assert failed == [original, copy]
+    assert [file_data for file_data, _ in results] == [other]
+    # Следующая копия снова уходит на анализ
+    late_copy = _file('third', 'main.py', 'x = 1')
+    assert list(deduplicator.filter([late_copy])) == [late_copy]
+
+
+def test_copies_of_file_without_result_are_reported(tmp_path):
+    failed = []
+    deduplicator = Deduplicator(
+        ResultStore(str(tmp_path / 'store.sqlite3')), on_failed=failed.append
+    )
+    original = _file('first', 'empty.py', '')
+    copy = _file('second', 'empty.py', '')
+
+    analyzed = list(deduplicator.filter([original, copy]))
+    # Анализ не дал результата, но и не сообщил об ошибке
+    assert list(deduplicator.resolve(_analyze(analyzed, failed=analyzed))) == []
+    assert failed == [copy]
+
+
+def test_copies_get_original_result(tmp_path):
+    store = ResultStore(str(tmp_path / 'store.sqlite3'))
+    duplicates = []
+    deduplicator = Deduplicator(
+        store, on_duplicate=lambda file_data, result: duplicates.append(file_data)
+    )
+    original = _file('first', 'main.py', 'x = 1')
+    copy = _file('second', 'lib/main.py', 'x = 1')
+
+    analyzed = list(deduplicator.filter([original, copy]))
+    results = dict(deduplicator.resolve(_analyze(analyzed)))
+    assert results[copy]['score'] == 1.0
+    assert results[copy]['repo_name'] == 'second'
+
+    # Результат сохранён: копия в следующем запуске не анализируется
+    again = Deduplicator(
+        store, on_duplicate=lambda file_data, result: duplicates.append(file_data)
+    )
+    assert list(again.filter([_file('third', 'main.py', 'x = 1')])) == []
+    assert len(duplicates) == 1
@@ -0,0 +1,213 @@
+"""
+Поиск хешей базы вредоносного ПО: индекс по DataFrame, двоичная база и
+подсчёт хешей файлов.
+"""
+
+import hashlib
+import io
+import json
+
+import pandas as pd
+import pytest
+
+from search_hash import (
+    HASH_CHUNK_SIZE,
+    HASH_COLUMNS,
+    PARALLEL_HASH_MIN_FILES,
+    HashDatabase,
+    HashIndex,
+    build_hash_database,
+    get_file_hash,
+    get_file_hashes,
+    hash_files,
+    load_hash_index,
+    search_hash_in_dataset,
+)
+
+
+def _sample(index: int) -> bytes:
+    return f'sample {index}\n'.encode()
+
+
+def _record(index: int) -> dict:
+    data = _sample(index)
+    return {
+        'first_seen_utc': f'2024-01-{index % 28 + 1:02d} 00:00:00',
+        'sha256_hash': hashlib.sha256(data).hexdigest(),
+        'md5_hash': hashlib.md5(data).hexdigest(),
+        'sha1_hash': hashlib.sha1(data).hexdigest(),
+        'file_name': f'sample{index}.py',
+        'signature': 'Test',
+    }
+
+
+@pytest.fixture
+def dataset() -> pd.DataFrame:
+    records = [_record(i) for i in range(50)]
+    # Одна выборка встречается в базе дважды
+    records.append({**_record(7), 'file_name': 'again.py'})
+    # Значения с пробелом и в верхнем регистре, как в выгрузке, и мусор
+    records[3]['sha256_hash'] = ' ' + records[3]['sha256_hash'].upper()
+    records[4]['md5_hash'] = 'not a hash'
+    return pd.DataFrame(records)
+
+
+def test_index_matches_full_scan(dataset):
+    index = HashIndex(dataset)
+    normalized = dataset.apply(lambda column: column.str.strip().str.lower())
+    queries = {
+        hash_type: [_record(i)[column] for i in range(60)]
+        for hash_type, column in HASH_COLUMNS.items()
+    }
+
+    for hash_type, column in HASH_COLUMNS.items():
+        found = index.search_many(queries[hash_type], hash_type)
+        for value in queries[hash_type]:
+            # Полный просмотр столбца с теми же правилами сравнения значений
+            expected = search_hash_in_dataset(normalized, value, column)
+            if value not in found:
+                assert expected.empty
+                continue
+            assert sorted(found[value].index) == sorted(expected.index)
+            assert found[value].equals(index.search(value, hash_type))
+
+
+def test_index_normalizes_values(dataset):
+    index = HashIndex(dataset)
+
+    # Пробел и регистр в базе не мешают поиску
+    rows = index.search(_record(3)['sha256_hash'])
+    assert list(rows['file_name']) == ['sample3.py']
+    # Запрос в верхнем регистре находит ту же запись
+    assert len(index.search(_record(5)['sha1_hash'].upper(), 'sha1')) == 1
+    assert sorted(index.search(_record(7)['md5_hash'], 'md5')['file_name']) == [
+        'again.py',
+        'sample7.py',
+    ]
+    # Некорректное значение в базе и в запросе просто не находится
+    assert index.search(_record(4)['md5_hash'], 'md5').empty
+    assert all(len(rows) == 0 for rows in index.find_rows(['zz', None, 'abc']))
+
+
+def test_index_without_column(dataset):
+    index = HashIndex(dataset.drop(columns=['sha1_hash']))
+
+    assert index.search(_record(1)['sha1_hash'], 'sha1').empty
+    assert len(index.search(_record(1)['sha256_hash'])) == 1
+    with pytest.raises(ValueError):
+        index.search(_record(1)['sha256_hash'], 'crc32')
+
+
+def _write_csv(path, indices):
+    # Формат выгрузки MalwareBazaar: закомментированный заголовок и пробелы
+    # после разделителей
+    lines = ['# "' + '", "'.join(_record(0)) + '"']
+    for i in indices:
+        lines.append('"' + '", "'.join(_record(i).values()) + '"')
+    lines.append(f'# Number of entries: {len(lines) - 1}')
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def _file_names(database, hash_type: str, indices) -> list[list[str]]:
+    column = HASH_COLUMNS[hash_type]
+    names = []
+    for i in indices:
+        rows = database.search(_record(i)[column], hash_type)
+        names.append([] if rows.empty else sorted(rows['file_name']))
+    return names
+
+
+def test_database_lookups(tmp_path):
+    csv_path = _write_csv(tmp_path / 'full.csv', [*range(40), 5])
+    directory = str(tmp_path / 'hash_db')
+
+    assert build_hash_database(csv_path, directory, append=False) == 40
+    database = HashDatabase(directory)
+
+    assert len(database) == 40
+    for hash_type in HASH_COLUMNS:
+        assert _file_names(database, hash_type, range(45)) == [
+            [f'sample{i}.py'] if i < 40 else [] for i in range(45)
+        ]
+    found = database.search_many([_record(i)['sha256_hash'] for i in (1, 2, 99)])
+    assert len(found) == 2
+    assert found[_record(2)['sha256_hash']]['signature'].tolist() == ['Test']
+
+
+def test_database_append(tmp_path):
+    directory = str(tmp_path / 'hash_db')
+    build_hash_database(_write_csv(tmp_path / 'first.csv', range(20)), directory)
+    old_meta = json.loads((tmp_path / 'hash_db' / 'meta.json').read_text())
+    old_database = HashDatabase(directory)
+
+    # Вторая выгрузка частично повторяет первую
+    added = build_hash_database(
+        _write_csv(tmp_path / 'second.csv', range(10, 30)), directory
+    )
+    database = HashDatabase(directory)
+
+    assert added == 10
+    assert len(database) == 30
+    assert _file_names(database, 'md5', range(31)) == [
+        [f'sample{i}.py'] if i < 30 else [] for i in range(31)
+    ]
+    # Открытая ранее сборка по-прежнему видит свои записи
+    assert len(old_database) == 20
+    assert _file_names(old_database, 'sha1', (0, 19, 25)) == [
+        ['sample0.py'],
+        ['sample19.py'],
+        [],
+    ]
+    meta = json.loads((tmp_path / 'hash_db' / 'meta.json').read_text())
+    assert meta['arrays'] != old_meta['arrays']
+    assert not (tmp_path / 'hash_db' / old_meta['arrays']).exists()
+
+
+def test_load_hash_index_builds_once(tmp_path):
+    csv_path = _write_csv(tmp_path / 'full.csv', range(5))
+    directory = str(tmp_path / 'hash_db')
+
+    assert len(load_hash_index(csv_path, directory)) == 5
+    # Повторный запуск открывает готовую базу, не читая CSV
+    (tmp_path / 'full.csv').unlink()
+    assert len(load_hash_index(csv_path, directory)) == 5
+    assert load_hash_index(csv_path, str(tmp_path / 'missing')) is None
+
+
+@pytest.mark.parametrize(
+    'data',
+    [
+        b'',
+        b'print("hello")\n',
+        # Несколько блоков чтения и неполный последний блок
+        bytes(range(256)) * (3 * HASH_CHUNK_SIZE // 256 + 7),
+    ],
+)
+def test_single_pass_digests(data):
+    expected = (
+        hashlib.sha256(data).hexdigest(),
+        hashlib.md5(data).hexdigest(),
+        hashlib.sha1(data).hexdigest(),
+    )
+
+    for source in (data, bytearray(data), memoryview(data), io.BytesIO(data)):
+        hashes = get_file_hashes(source)
+        assert (hashes.sha256, hashes.md5, hashes.sha1) == expected
+    assert get_file_hash(data, 'md5') == expected[1]
+
+
+def test_text_is_hashed_as_utf8():
+    text = 'комментарий = "значение"\n'
+    assert get_file_hashes(text) == get_file_hashes(text.encode('utf-8'))
+
+
+def test_hash_files_in_parallel():
+    contents = [_sample(i) * (i + 1) for i in range(PARALLEL_HASH_MIN_FILES * 2)]
+
+    hashes = hash_files(contents, workers=4)
+
+    assert [item.sha256 for item in hashes] == [
+        hashlib.sha256(data).hexdigest() for data in contents
+    ]
+    assert hashes == hash_files(contents, workers=1)
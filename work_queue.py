@@ -0,0 +1,421 @@
+import http.client
+import http.server
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+from logging_config import logging
+
+logger = logging.getLogger(__name__)
+
+WORK_QUEUE_FILE = 'work_queue.sqlite3'
+# Задача, чья аренда не продлевалась столько секунд, отдаётся другому воркеру
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+# Координатор, к которому воркеры других машин подключаются по HTTP
+DEFAULT_ADDRESS = 'http://0.0.0.0:8765'
+REQUEST_TIMEOUT = 60
+# Повторы запроса к недоступному координатору (например, при его перезапуске)
+REQUEST_RETRIES = 5
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (owner, repo)
+);
+CREATE TABLE IF NOT EXISTS task_results (
+    task_id INTEGER PRIMARY KEY,
+    worker TEXT NOT NULL,
+    finished_at REAL NOT NULL,
+    result TEXT NOT NULL
+);
+"""
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class WorkQueue:
+    """
+    Очередь задач (по одному репозиторию на задачу) в SQLite с арендой.
+
+    Воркер берёт задачу в аренду на lease_seconds и периодически продлевает
+    её. Если воркер умер, аренда истекает и задача достаётся другому воркеру;
+    после MAX_ATTEMPTS неудачных попыток задача считается проваленной.
+    Файл очереди может использоваться несколькими процессами одной машины
+    одновременно (не на сетевой файловой системе - см. distributed_scan);
+    воркеры других машин обращаются к очереди через координатор (serve и
+    RemoteWorkQueue).
+    """
+
+    def __init__(
+        self, path: str = WORK_QUEUE_FILE, lease_seconds: float = LEASE_SECONDS
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _transaction(self, callback):
+        # BEGIN IMMEDIATE сразу берёт блокировку на запись, поэтому два
+        # процесса не могут арендовать одну задачу
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = callback(self._connection)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+            return result
+
+    def enqueue(
+        self, repositories: list[tuple[str, str]], restart: bool = False
+    ) -> int:
+        """
+        Добавляет репозитории в очередь (уже добавленные пропускаются).
+
+        :param repositories: Пары (owner, repo).
+        :param restart: Очистить очередь и результаты предыдущего сканирования.
+        :return: Число добавленных задач.
+        """
+
+        def enqueue(connection):
+            if restart:
+                connection.execute('DELETE FROM tasks')
+                connection.execute('DELETE FROM task_results')
+            before = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO tasks (owner, repo) VALUES (?, ?)', repositories
+            )
+            return connection.total_changes - before
+
+        return self._transaction(enqueue)
+
+    def lease(self, worker: str):
+        """
+        Арендует следующую свободную задачу.
+
+        :return: (task_id, owner, repo) или None, если свободных задач нет.
+        """
+
+        def lease(connection):
+            now = time.time()
+            while True:
+                row = connection.execute(
+                    'SELECT task_id, owner, repo, attempts FROM tasks '
+                    "WHERE status = 'pending' "
+                    "OR (status = 'leased' AND lease_expires < ?) "
+                    'ORDER BY task_id LIMIT 1',
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+                task_id, owner, repo, attempts = row
+                if attempts >= MAX_ATTEMPTS:
+                    # Воркер умер на последней попытке
+                    connection.execute(
+                        "UPDATE tasks SET status = 'failed', "
+                        "error = COALESCE(error, 'аренда истекла') WHERE task_id = ?",
+                        (task_id,),
+                    )
+                    continue
+                connection.execute(
+                    "UPDATE tasks SET status = 'leased', worker = ?, "
+                    'lease_expires = ?, attempts = attempts + 1 WHERE task_id = ?',
+                    (worker, now + self.lease_seconds, task_id),
+                )
+                return task_id, owner, repo
+
+        return self._transaction(lease)
+
+    def heartbeat(self, task_id: int, worker: str) -> bool:
+        """
+        Продлевает аренду задачи.
+
+        :return: False, если аренда уже истекла и задачу забрал другой воркер.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                'UPDATE tasks SET lease_expires = ? '
+                "WHERE task_id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, task_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, task_id: int, worker: str, result) -> bool:
+        """
+        Сохраняет результат задачи.
+
+        :return: False, если задача уже принадлежит другому воркеру (результат
+            отброшен).
+        """
+
+        def complete(connection):
+            cursor = connection.execute(
+                "UPDATE tasks SET status = 'done', lease_expires = NULL, error = NULL "
+                "WHERE task_id = ? AND worker = ? AND status = 'leased'",
+                (task_id, worker),
+            )
+            if cursor.rowcount != 1:
+                return False
+            connection.execute(
+                'INSERT OR REPLACE INTO task_results VALUES (?, ?, ?, ?)',
+                (task_id, worker, time.time(), json.dumps(result)),
+            )
+            return True
+
+        return self._transaction(complete)
+
+    def fail(self, task_id: int, worker: str, error: str):
+        """Возвращает задачу в очередь или, если попытки исчерпаны, проваливает её."""
+        with self._lock:
+            self._connection.execute(
+                'UPDATE tasks SET error = ?, lease_expires = NULL, '
+                "status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE task_id = ? AND worker = ? AND status = 'leased'",
+                (error, MAX_ATTEMPTS, task_id, worker),
+            )
+
+    def counts(self) -> dict[str, int]:
+        """Число задач в каждом статусе."""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT status, COUNT(*) FROM tasks GROUP BY status'
+            ).fetchall()
+        return dict(rows)
+
+    def is_finished(self) -> bool:
+        counts = self.counts()
+        return not counts.get('pending') and not counts.get('leased')
+
+    def results(self) -> list[tuple[str, str, object]]:
+        """Результаты выполненных задач: (owner, repo, результат)."""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT owner, repo, result FROM tasks '
+                'JOIN task_results USING (task_id) ORDER BY task_id'
+            ).fetchall()
+        return [(owner, repo, json.loads(result)) for owner, repo, result in rows]
+
+    def failures(self) -> list[tuple[str, str, str]]:
+        """Проваленные задачи: (owner, repo, последняя ошибка)."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT owner, repo, error FROM tasks WHERE status = 'failed' "
+                'ORDER BY task_id'
+            ).fetchall()
+
+
+class CoordinatorError(Exception):
+    """Координатор недоступен или отклонил запрос."""
+
+
+def _make_handler(queue: WorkQueue):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/info':
+                self._reply(
+                    200,
+                    {'lease_seconds': queue.lease_seconds, 'counts': queue.counts()},
+                )
+            else:
+                self._reply(404, {'error': self.path})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                request = json.loads(body)
+                worker = request['worker']
+                if self.path == '/lease':
+                    reply = {'task': queue.lease(worker)}
+                elif self.path == '/heartbeat':
+                    reply = {'ok': queue.heartbeat(request['task_id'], worker)}
+                elif self.path == '/complete':
+                    reply = {
+                        'ok': queue.complete(
+                            request['task_id'], worker, request['result']
+                        )
+                    }
+                elif self.path == '/fail':
+                    queue.fail(request['task_id'], worker, request['error'])
+                    reply = {'ok': True}
+                else:
+                    self._reply(404, {'error': self.path})
+                    return
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+            self._reply(200, reply)
+
+    return Handler
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def make_server(queue: WorkQueue, address: str = DEFAULT_ADDRESS):
+    """
+    Создаёт HTTP-сервер координатора, через который воркеры других машин
+    работают с очередью queue.
+
+    :param address: 'http://хост:порт' (порт 0 - любой свободный).
+    """
+    parsed = urllib.parse.urlsplit(address)
+    return _HTTPServer((parsed.hostname, parsed.port or 0), _make_handler(queue))
+
+
+def serve(queue: WorkQueue, address: str = DEFAULT_ADDRESS):
+    """Обслуживает запросы воркеров к очереди до прерывания."""
+    server = make_server(queue, address)
+    host, port = server.server_address[:2]
+    logger.info(f'Координатор очереди {queue.path} слушает http://{host}:{port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class RemoteWorkQueue:
+    """
+    Очередь задач на координаторе (см. serve) с интерфейсом WorkQueue для
+    воркера: lease, heartbeat, complete, fail и is_finished.
+    """
+
+    def __init__(self, address: str, timeout: float = REQUEST_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.lease_seconds = self._request('GET', '/info')['lease_seconds']
+
+    def _request(self, method: str, path: str, payload=None):
+        body = None if payload is None else json.dumps(payload).encode()
+        parsed = urllib.parse.urlsplit(self.address)
+        for attempt in range(REQUEST_RETRIES + 1):
+            connection = http.client.HTTPConnection(
+                parsed.hostname, parsed.port, timeout=self.timeout
+            )
+            try:
+                connection.request(
+                    method, path, body, {'Content-Type': 'application/json'}
+                )
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == REQUEST_RETRIES:
+                    raise CoordinatorError(
+                        f'Координатор {self.address} недоступен: {e}'
+                    ) from e
+                logger.warning(
+                    f'Координатор {self.address} недоступен: {e}, попытка {attempt + 1}'
+                )
+                time.sleep(min(RETRY_DELAY * 2**attempt, MAX_RETRY_DELAY))
+                continue
+            finally:
+                connection.close()
+            if response.status != 200:
+                raise CoordinatorError(
+                    f'Координатор ответил {response.status} на {path}: '
+                    f'{data.decode("utf-8", errors="replace")}'
+                )
+            return json.loads(data)
+
+    def lease(self, worker: str):
+        task = self._request('POST', '/lease', {'worker': worker})['task']
+        return tuple(task) if task is not None else None
+
+    def heartbeat(self, task_id: int, worker: str) -> bool:
+        return self._request(
+            'POST', '/heartbeat', {'task_id': task_id, 'worker': worker}
+        )['ok']
+
+    def complete(self, task_id: int, worker: str, result) -> bool:
+        return self._request(
+            'POST',
+            '/complete',
+            {'task_id': task_id, 'worker': worker, 'result': result},
+        )['ok']
+
+    def fail(self, task_id: int, worker: str, error: str):
+        self._request(
+            'POST', '/fail', {'task_id': task_id, 'worker': worker, 'error': error}
+        )
+
+    def counts(self) -> dict[str, int]:
+        return self._request('GET', '/info')['counts']
+
+    def is_finished(self) -> bool:
+        counts = self.counts()
+        return not counts.get('pending') and not counts.get('leased')
+
+
+class LeaseKeeper:
+    """Фоновый поток, продлевающий аренду задачи, пока она выполняется."""
+
+    def __init__(self, queue: 'WorkQueue | RemoteWorkQueue', task_id: int, worker: str):
+        self.queue = queue
+        self.task_id = task_id
+        self.worker = worker
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            try:
+                renewed = self.queue.heartbeat(self.task_id, self.worker)
+            except CoordinatorError as e:
+                # Аренда может пережить недоступность координатора
+                logger.warning(f'Не удалось продлить аренду задачи {self.task_id}: {e}')
+                continue
+            if not renewed:
+                logger.warning(f'Аренда задачи {self.task_id} потеряна')
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()